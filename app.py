@@ -1,10 +1,24 @@
-from aws_clutter import cli
+from aws_clutter import run
+
+# checked as the function starts rather than on every invocation
+if run.SHARDS and run.STATE_URL:
+    raise ValueError("CK_SHARDS doesn't go with CK_STATE (shards don't "
+                     "support incremental scans): unset one of them")
 
 
 def handler(event, context):
     print(event)
     print(context)
 
-    cli.watch()
+    # a shard of a run with $CK_SHARDS and $CK_SHARD_FUNCTION
+    if 'shard' in event:
+        import aws_clutter.shard as shard
+        return shard.run_shard(event['shard'], event.get('backend'))
+
+    if run.SHARDS:
+        run.watch()
+    else:
+        # publish what could be scanned before the function times out
+        run.watch(deadline=context.get_remaining_time_in_millis() / 1000)
 
     return {}
@@ -0,0 +1,54 @@
+import os
+
+# role assumed in each account given by ID (rather than by role ARN)
+ROLE_NAME = os.getenv('CK_ROLE_NAME', default='OrganizationAccountAccessRole')
+
+
+def role_arns(accounts=(), path=None, role_name=None):
+    '''
+    role ARNs to assume for the given account IDs / role ARNs, plus the ones
+    listed in the file at path (one per line, # for comments)
+    '''
+    entries = [entry for a in accounts for entry in a.split(',')]
+    if path:
+        with open(path) as f:
+            entries.extend(line.split('#', 1)[0] for line in f)
+    arns = []
+    for entry in entries:
+        entry = entry.strip()
+        if not entry:
+            continue
+        arn = (entry if entry.startswith('arn:')
+               else f"arn:aws:iam::{entry}:role/{role_name or ROLE_NAME}")
+        if arn not in arns:
+            arns.append(arn)
+    return arns
+
+
+def account_id(role_arn):
+    return role_arn.split(':')[4]
+
+
+def add_account_dimension(metric_data, account):
+    for datum in metric_data:
+        datum['Dimensions'].append({
+            'Name': 'AccountId',
+            'Value': account
+        })
+    return metric_data
+
+
+def merge(account_resources):
+    '''
+    merges {account: {clutter_type: {region: [resources]}}} into
+    {clutter_type: {region: [resources]}}, tagging each resource with its
+    AccountId
+    '''
+    merged = {}
+    for account, resources in account_resources.items():
+        for ct, regions in resources.items():
+            for region, rs in regions.items():
+                for r in rs:
+                    r['AccountId'] = account
+                merged.setdefault(ct, {}).setdefault(region, []).extend(rs)
+    return merged
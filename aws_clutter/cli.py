@@ -1,19 +1,15 @@
-import os
 import sys
-import boto3
-import json
 import click
-import asyncio
-import importlib_metadata
-import aws_clutter.clutter as clutter
-import aws_clutter.tools as tools
+import aws_clutter.run as run
+import aws_clutter.serve as daemon
+import aws_clutter.accounts as accounts
+from aws_clutter.scheduler import BACKEND, BACKENDS
 
-NAMESPACE = os.getenv('CK_NAMESPACE', default='CloudKeep')
-CLUTTER_TYPES = ['debs', 'ulbs']
+CLUTTER_TYPES = run.CLUTTER_TYPES
 
 
 @click.group()
-@click.version_option(version=importlib_metadata.version('aws_clutter'))
+@click.version_option(package_name='aws_clutter')
 def cli():
     '''
     `awsclutter` finds and calculates the costs of unused resources ("clutter")
@@ -25,87 +21,159 @@ def cli():
     pass
 
 
+backend_option = click.option(
+    '--backend', type=click.Choice(BACKENDS), default=BACKEND,
+    show_default=True,
+    help="I/O backend for AWS calls ('async' requires aiobotocore); "
+         "defaults to $CK_BACKEND")
+
+
+timing_option = click.option(
+    '-t', '--timing', is_flag=True, default=False,
+    help='Report per clutter type and per region scan timings on stderr')
+
+
+profile_option = click.option(
+    '--profile', is_flag=True, default=False,
+    help='Report the AWS calls (per service, operation and region) and the '
+         'time spent in each stage on stderr')
+
+
+def accounts_options(f):
+    '''
+    options to scan other accounts by assuming a role in each of them
+    '''
+    for option in reversed([
+        click.option('--accounts', 'account_ids', multiple=True,
+                     help='Account IDs (or role ARNs) to scan, '
+                          'comma-separated or repeated'),
+        click.option('--role-arns-file', type=click.Path(exists=True),
+                     help='File with the role ARNs (or account IDs) to '
+                          'scan, one per line'),
+        click.option('--role-name', envvar='CK_ROLE_NAME',
+                     default=accounts.ROLE_NAME, show_default=True,
+                     help='Role assumed in the accounts given by ID; '
+                          'defaults to $CK_ROLE_NAME'),
+        click.option('--account-workers', type=int,
+                     envvar='CK_ACCOUNT_WORKERS',
+                     help='Worker processes scanning accounts in parallel '
+                          '(defaults to $CK_ACCOUNT_WORKERS or the CPU '
+                          'count)')
+    ]):
+        f = option(f)
+    return f
+
+
+def check_clutter_type(clutter_type):
+    try:
+        return run.check_clutter_type(clutter_type)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+
 @click.argument('clutter_type', nargs=-1)
 @click.option('-s', '--summary', is_flag=True, default=False,
               help='Print just a summary')
+@click.option('--format', 'output_format', type=click.Choice(run.FORMATS),
+              default='json', show_default=True,
+              help="'ndjson' streams one resource per line as each region "
+                   "completes, then a summary record")
+@backend_option
+@timing_option
+@profile_option
+@accounts_options
 @cli.command()
-def list(clutter_type, summary):
+def list(clutter_type, summary, output_format, backend, timing, profile,
+         account_ids, role_arns_file, role_name, account_workers):
     '''
     list the discovered clutter resources
     '''
-    for ct in clutter_type:
-        if ct not in CLUTTER_TYPES:
-            print(f"Unknown clutter type {ct}")
-            sys.exit(1)
-
-    dvs = {}
-    ulbs = {}
-    result = {}
-    if len(clutter_type) == 0:
-        clutter_type = CLUTTER_TYPES
-
-    if 'debs' in clutter_type:
-        asyncio.run(clutter.debs.query(dvs))
-        result['debs'] = {
-            'description': 'Detached EBS Volumes',
-            'resources': dvs
-        }
-    if 'ulbs' in clutter_type:
-        asyncio.run(clutter.ulbs.query(ulbs))
-        result['ulbs'] = {
-            'description': 'Unused Load Balancers',
-            'resources': ulbs
-        }
-
-    if (summary):
-        if 'debs' in clutter_type:
-            clutter.debs.summarize(dvs)
-        if 'ulbs' in clutter_type:
-            clutter.ulbs.summarize(ulbs)
-    else:
-        print(json.dumps(result, sort_keys=True, indent=4,
-                         cls=tools.DateTimeJSONEncoder))
-
-
-async def get_metric_data(clutter_type, metric_data):
-    dvs = {}
-    ulbs = {}
-    queries = []
-    if 'debs' in clutter_type:
-        queries.append(clutter.debs.query(dvs))
-    if 'ulbs' in clutter_type:
-        queries.append(clutter.ulbs.query(ulbs))
-    await asyncio.gather(*queries)
-    if 'debs' in clutter_type:
-        metric_data.extend(clutter.debs.aggregate(dvs))
-    if 'ulbs' in clutter_type:
-        metric_data.extend(clutter.ulbs.aggregate(ulbs))
-    return metric_data
+    role_arns = accounts.role_arns(account_ids, role_arns_file, role_name)
+    run.list_clutter(check_clutter_type(clutter_type), summary, backend,
+                     timing, role_arns, account_workers, output_format,
+                     profile)
 
 
 @click.argument('clutter_type', nargs=-1)
 @click.option('--dry-run', is_flag=True, default=False,
               help='Just print the custom metrics, do not push to CloudWatch')
+@click.option('--compact', is_flag=True, default=False,
+              envvar='CK_COMPACT_METRICS',
+              help='Merge datums with identical dimensions into Values/Counts '
+                   'arrays when pushing')
+@click.option('--state', 'state_url', envvar='CK_STATE',
+              help='Scan incrementally against the state kept in this file, '
+                   's3://bucket/key or dynamodb://table/key; defaults to '
+                   '$CK_STATE')
+@click.option('--self-metrics', is_flag=True, default=False,
+              envvar='CK_SELF_METRICS',
+              help='Push the AWS call and stage stats of the run as metrics '
+                   'too')
+@click.option('--sink', type=click.Choice(run.SINKS), envvar='CK_SINK',
+              default='cloudwatch', show_default=True,
+              help="'emf' writes the metrics to stdout in the CloudWatch "
+                   "Embedded Metric Format instead of pushing them")
+@click.option('--deadline', type=float, envvar='CK_DEADLINE',
+              help='Seconds the run may take: the regions not scanned in '
+                   'time are left out, and the metrics flagged as partial')
+@click.option('--shards', type=int, envvar='CK_SHARDS', default=0,
+              help='Split the (account, region, clutter type) scans into '
+                   'this many shards, scanned and aggregated in parallel '
+                   'worker processes')
+@click.option('--shard-function', envvar='CK_SHARD_FUNCTION',
+              help='Lambda function running the shards, instead of the '
+                   'worker processes')
+@backend_option
+@timing_option
+@profile_option
+@accounts_options
 @cli.command()
-def watch(clutter_type, dry_run):
+def watch(clutter_type, dry_run, compact, state_url, self_metrics, sink,
+          deadline, shards, shard_function, backend, timing, profile,
+          account_ids, role_arns_file, role_name, account_workers):
     '''
     calculate and push CloudWatch metrics based on clutter resources
     '''
-    metric_data = []
-    asyncio.run(get_metric_data(clutter_type, metric_data))
-
-    if dry_run:
-        print(json.dumps(
-            metric_data, sort_keys=True, indent=4,
-            cls=tools.DateTimeJSONEncoder
-        ))
-
-    else:
-        # push metrics to CloudWatch
-        if len(metric_data):
-            client = boto3.client('cloudwatch')
-            for i in range(0, len(metric_data), 20):
-                client.put_metric_data(
-                    Namespace=NAMESPACE,
-                    MetricData=metric_data[i:i+20]
-                )
+    if shards and (state_url or deadline is not None):
+        raise click.UsageError('--shards goes with neither --state nor '
+                               '--deadline')
+    role_arns = accounts.role_arns(account_ids, role_arns_file, role_name)
+    run.watch(check_clutter_type(clutter_type), dry_run, compact, state_url,
+              backend, timing, role_arns, account_workers, profile,
+              self_metrics, sink, deadline, shards, shard_function)
+
+
+@click.argument('clutter_type', nargs=-1)
+@click.option('--interval', 'intervals', multiple=True,
+              help='Seconds between scans, for all the clutter types or for '
+                   'one as <clutter_type>=<seconds> (repeatable); defaults '
+                   'to $CK_SERVE_INTERVAL or 600')
+@click.option('--host', envvar='CK_SERVE_HOST', default=daemon.HOST,
+              show_default=True, help='Address to serve /metrics on')
+@click.option('--port', type=int, envvar='CK_SERVE_PORT',
+              default=daemon.PORT, show_default=True,
+              help='Port to serve /metrics on')
+@click.option('--push', is_flag=True, default=False,
+              help='Also push the metrics to CloudWatch after every scan')
+@click.option('--compact', is_flag=True, default=False,
+              envvar='CK_COMPACT_METRICS',
+              help='Merge datums with identical dimensions into Values/Counts '
+                   'arrays when pushing')
+@backend_option
+@accounts_options
+@cli.command()
+def serve(clutter_type, intervals, host, port, push, compact, backend,
+          account_ids, role_arns_file, role_name, account_workers):
+    '''
+    rescan periodically and serve the metrics in the Prometheus format
+    '''
+    role_arns = accounts.role_arns(account_ids, role_arns_file, role_name)
+    clutter_type = check_clutter_type(clutter_type)
+    try:
+        intervals = daemon.parse_intervals(intervals, clutter_type)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    daemon.serve(clutter_type, intervals, host, port, push, compact,
+                 backend, role_arns, account_workers)
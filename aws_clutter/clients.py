@@ -0,0 +1,236 @@
+import os
+import asyncio
+import threading
+import contextlib
+import contextvars
+import aws_clutter.instrument as instrument
+from aws_clutter.tools import THROTTLING_ERRORS, TokenBucket, check_deadline
+
+# HTTP connections per aiobotocore client (see AioClients)
+AIO_MAX_POOL_CONNECTIONS = int(os.getenv('CK_AIO_MAX_POOL_CONNECTIONS',
+                                         default='50'))
+# botocore retry mode of the clients, the one retry layer of the AWS calls:
+# 'standard' retries the throttled and transient failures with jittered
+# exponential backoff, up to $AWS_MAX_ATTEMPTS attempts. The calls are
+# paced by the API_RATE buckets; 'adaptive' would add botocore's own
+# limiter, which recovers from throttling much more slowly.
+RETRY_MODE = (os.getenv('CK_RETRY_MODE') or os.getenv('AWS_RETRY_MODE') or
+              'standard')
+# calls per second to each (service, region), shared by all the clients and
+# slowed down as they get throttled - 0 for no limit until they do, when
+# the limit starts at the rate they were made at
+API_RATE = float(os.getenv('CK_API_RATE', default='0'))
+
+# boto3 sessions are not thread-safe, but the clients created from them are.
+# Each thread gets its own session to build clients with, and the clients are
+# shared process-wide so that they survive across warm Lambda invocations.
+_local = threading.local()
+_lock = threading.Lock()
+_clients = {}
+# (service, region) -> TokenBucket pacing the calls of their clients
+_buckets = {}
+# (role ARN, refreshable credentials) of the role assumed in the current
+# context, if any - the context of a scan is copied into its tasks and
+# threads, so that concurrent scans of different accounts each keep theirs
+_role = contextvars.ContextVar('role', default=None)
+_assumed = {}
+ASSUME_ROLE_SESSION_NAME = os.getenv('CK_ASSUME_ROLE_SESSION_NAME',
+                                     default='awsclutter')
+
+
+def session():
+    '''
+    returns the boto3 session of the calling thread
+    '''
+    role = _role.get()
+    s = getattr(_local, 'session', None)
+    if s is None or getattr(_local, 'role', None) is not role:
+        import boto3
+        s = boto3.session.Session()
+        if role is not None:
+            # assumed role credentials are shared by all the sessions
+            s._session._credentials = role[1]
+            s._ck_role_arn = role[0]
+        _local.session = s
+        _local.role = role
+    return s
+
+
+def bucket(service, region):
+    '''
+    the TokenBucket of the calls to service in region
+    '''
+    b = _buckets.get((service, region))
+    if b is None:
+        with _lock:
+            b = _buckets.setdefault((service, region),
+                                    TokenBucket(API_RATE, adaptive=True))
+    return b
+
+
+def credentials_key(s):
+    # assumed role credentials are keyed by the role, as they get refreshed
+    role_arn = getattr(s, '_ck_role_arn', None)
+    if role_arn is not None:
+        return role_arn
+    creds = s.get_credentials()
+    return creds.access_key if creds is not None else None
+
+
+def assume_role(role_arn):
+    '''
+    makes the clients built from session() in the current context use the
+    credentials of role_arn, refreshed before they expire - or the ambient
+    credentials again if role_arn is None. Returns the contextvars.Token to
+    reset the role with (see assumed_role).
+    '''
+    if role_arn is None:
+        return _role.set(None)
+    if role_arn in _assumed:
+        return _role.set((role_arn, _assumed[role_arn]))
+    from botocore.credentials import RefreshableCredentials
+    # STS is called with the ambient credentials
+    import boto3
+    sts = boto3.session.Session().client('sts')
+
+    def refresh():
+        creds = sts.assume_role(
+            RoleArn=role_arn,
+            RoleSessionName=ASSUME_ROLE_SESSION_NAME)['Credentials']
+        return {
+            'access_key': creds['AccessKeyId'],
+            'secret_key': creds['SecretAccessKey'],
+            'token': creds['SessionToken'],
+            'expiry_time': creds['Expiration'].isoformat()
+        }
+
+    credentials = RefreshableCredentials.create_from_metadata(
+        metadata=refresh(), refresh_using=refresh, method='sts-assume-role')
+    with _lock:
+        credentials = _assumed.setdefault(role_arn, credentials)
+    return _role.set((role_arn, credentials))
+
+
+@contextlib.contextmanager
+def assumed_role(role_arn):
+    '''
+    assume_role(role_arn) for the body of the with statement - the role of
+    the context is restored after it
+    '''
+    token = assume_role(role_arn)
+    try:
+        yield
+    finally:
+        _role.reset(token)
+
+
+def client(service, region=None, s=None):
+    '''
+    returns a (lazily built) client keyed by (service, region, credentials)
+    '''
+    if s is None:
+        s = session()
+    key = (service, region, credentials_key(s))
+    c = _clients.get(key)
+    if c is None:
+        from botocore.config import Config
+        c = s.client(service, region_name=region,
+                     config=Config(retries={'mode': RETRY_MODE}))
+        instrument.attach(c.meta.events)
+        pace(c.meta.events, bucket(service, c.meta.region_name))
+        stop_at_deadline(c.meta.events)
+        with _lock:
+            c = _clients.setdefault(key, c)
+    return c
+
+
+def pace(events, bucket, event=None, aio=False):
+    '''
+    paces the requests of a (botocore, or with aio aiobotocore) client with
+    events - each attempt, retries included - at the rate of bucket, which
+    slows down as they get throttled. event narrows them down, e.g. to
+    'ec2.DescribeVolumes'. Pacing them again with the same bucket is a no-op.
+    '''
+    def before_send(**kwargs):
+        bucket.acquire()
+
+    async def before_send_async(**kwargs):
+        await bucket.acquire_async()
+
+    def needs_retry(response=None, **kwargs):
+        if (response is not None and response[1].get('Error', {}).get(
+                'Code') in THROTTLING_ERRORS):
+            bucket.throttled()
+
+    suffix = '' if event is None else f'.{event}'
+    unique_id = f'ck-pace-{id(bucket)}{suffix}'
+    events.register(f'before-send{suffix}',
+                    before_send_async if aio else before_send,
+                    unique_id=f'{unique_id}-before-send')
+    events.register(f'needs-retry{suffix}', needs_retry,
+                    unique_id=f'{unique_id}-needs-retry')
+
+
+def stop_at_deadline(events):
+    '''
+    makes each attempt of the requests of a client with events (retries
+    included) raise DeadlineExceeded once the deadline of their scan has
+    passed - so that the scans left running past it (see
+    scheduler.Scheduler) end with the calls they have in flight
+    '''
+    def before_send(**kwargs):
+        check_deadline()
+
+    events.register('before-send', before_send, unique_id='ck-deadline')
+
+
+def clear():
+    with _lock:
+        _clients.clear()
+        _buckets.clear()
+        _assumed.clear()
+    _role.set(None)
+
+
+class AioClients:
+    '''
+    aiobotocore clients keyed by (service, region) for the async backend.
+    All clients live on the event loop they were created on and share one
+    aiobotocore session; close them with aclose() before the loop ends.
+    Requires the optional aiobotocore package.
+    '''
+    def __init__(self):
+        from aiobotocore.session import get_session
+        from aiobotocore.config import AioConfig
+        self.session = get_session()
+        instrument.attach(self.session)
+        role = _role.get()
+        if role is not None:
+            # a snapshot of the assumed role credentials, valid for the scan
+            creds = role[1].get_frozen_credentials()
+            self.session.set_credentials(creds.access_key, creds.secret_key,
+                                         creds.token)
+        self.config = AioConfig(max_pool_connections=AIO_MAX_POOL_CONNECTIONS,
+                                retries={'mode': RETRY_MODE})
+        self.exit_stack = contextlib.AsyncExitStack()
+        self.clients = {}
+
+    async def client(self, service, region=None):
+        key = (service, region)
+        c = self.clients.get(key)
+        if c is None:
+            c = self.clients[key] = asyncio.ensure_future(
+                self.create_client(service, region))
+        return await c
+
+    async def create_client(self, service, region=None):
+        c = await self.exit_stack.enter_async_context(
+            self.session.create_client(service, region_name=region,
+                                       config=self.config))
+        pace(c.meta.events, bucket(service, c.meta.region_name), aio=True)
+        stop_at_deadline(c.meta.events)
+        return c
+
+    async def aclose(self):
+        await self.exit_stack.aclose()
+        self.clients.clear()
@@ -1,2 +1,13 @@
-from .debs import query, summarize, aggregate
-from .ulbs import query, summarize, aggregate
+import importlib
+
+# clutter type -> module providing NAME, DESCRIPTION, RESOURCE_ID, query(),
+# summarize() and aggregate(). The modules are imported on first use.
+CLUTTER_TYPES = {
+    'debs': 'aws_clutter.clutter.debs',
+    'ulbs': 'aws_clutter.clutter.ulbs',
+    'snaps': 'aws_clutter.clutter.snaps',
+}
+
+
+def get(clutter_type):
+    return importlib.import_module(CLUTTER_TYPES[clutter_type])
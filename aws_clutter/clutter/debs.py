@@ -1,42 +1,48 @@
 import os
-import boto3
+import sys
 import json
-import asyncio
-import concurrent.futures
-from importlib_resources import files
-from aws_clutter.tools import boto3_paginate, DateTimeJSONEncoder
+import functools
+import aws_clutter.clients as clients
+import aws_clutter.cube as cube
+import aws_clutter.instrument as instrument
+from aws_clutter.pricing import ebs_price_map, ebs_table
+from aws_clutter.scheduler import run_scan
+from aws_clutter.tools import (boto3_paginate, aio_paginate,
+                               DateTimeJSONEncoder)
 from datetime import datetime
-from collections import defaultdict
-
-EBS_PRICING = json.loads(
-    files('aws_clutter.data')
-    .joinpath('ebs_pricing.json')
-    .read_text()
-)
-PRICE_MAP = {price['rzCode']: price['ebs_prices'] for price in EBS_PRICING}
-DEBS_DIMS_DEFAULT = os.getenv('DEBS_DIMS', default="RZCode")
-
 
-async def query(dvs):
-    executor = concurrent.futures.ThreadPoolExecutor(max_workers=30)
-    loop = asyncio.get_event_loop()
-    await asyncio.wait(
-        [loop.run_in_executor(executor, list_dvs_region, *(dvs, region))
-         for region in list_regions()]
-    )
+NAME = 'debs'
+DESCRIPTION = 'Detached EBS Volumes'
+RESOURCE_ID = 'VolumeId'
+DEBS_DIMS_DEFAULT = os.getenv('DEBS_DIMS', default="RZCode")
+DVS_FILTERS = [
+    {
+        'Name': 'status',
+        'Values': ['available']
+    }
+]
+# detached volumes priced at once while streaming the describe_volumes pages
+ENRICH_BATCH = 1000
+# rollup dimensions of the metrics, in datum order (plus Tag:<key>)
+DIMENSIONS = ['RZCode', 'VolumeType', 'AccountId']
+# dimensions of the per-volume metrics (with VolumeId in DEBS_DIMS)
+VOLUME_DIMENSIONS = ['RZCode', 'VolumeType', 'VolumeId']
+# tags kept in the compact Volume records, for the Tag:<key> dimensions
+TAG_KEYS = cube.tag_keys(cube.parse_dims(DEBS_DIMS_DEFAULT))
+# the count and cost metrics
+METRICS = ('DetachedEBSCount', 'DetachedEBSMonthlyCost')
+
+
+async def query(dvs, scheduler=None):
+    compact = scheduler is not None and scheduler.compact_records
+    await run_scan(functools.partial(list_dvs_region, compact=compact), dvs,
+                   scheduler,
+                   functools.partial(list_dvs_region_async, compact=compact),
+                   NAME)
 
 
 def summarize(dvs):
-    summary = {}
-    for rz in dvs.keys():
-        if len(dvs[rz]):
-            rz_cost = sum(v["MonthlyCost"] for v in dvs[rz])
-            unit = dvs[rz][0]["MonthlyCostUnit"]
-            if not summary.get(unit):
-                summary[unit] = {'cost': 0.0, 'count': 0, 'rzs': []}
-            summary[unit]['cost'] += rz_cost
-            summary[unit]['count'] += len(dvs[rz])
-            summary[unit]['rzs'].append(rz)
+    summary = cube.Cube(['RZCode']).add_all(dvs).summary()
     units = summary.keys()
     if len(units) == 0:
         print("No Detached EBS Volumes found.")
@@ -47,104 +53,106 @@ def summarize(dvs):
                   f" in regions: {summary[unit]['rzs']}")
 
 
+def new_cube():
+    '''
+    the (empty) cube of the metrics, as set by DEBS_DIMS
+    '''
+    debs_dims = cube.parse_dims(DEBS_DIMS_DEFAULT)
+    return cube.Cube(
+        cube.rollup_dims(debs_dims, DIMENSIONS),
+        resource_dims=VOLUME_DIMENSIONS if 'VolumeId' in debs_dims else ())
+
+
 def aggregate(dvs):
-    debs_dims = [d.strip() for d in DEBS_DIMS_DEFAULT.split(',')]
-    timestamp = datetime.utcnow()
-    metric_data = []
-    debs_count = 0
-    debs_cost = defaultdict(float)
-    debs_count_rz = defaultdict(int)
-    debs_cost_rz = defaultdict(lambda: defaultdict(float))
-    debs_count_vtype = defaultdict(int)
-    debs_cost_vtype = defaultdict(lambda: defaultdict(float))
-    debs_count_rz_vtype = defaultdict(lambda: defaultdict(int))
-    debs_cost_rz_vtype = defaultdict(
-        lambda: defaultdict(lambda: defaultdict(float)))
-
-    for rz in dvs.keys():
-        for dv in dvs[rz]:
-            cost_unit = dv['MonthlyCostUnit']
-            cost = dv['MonthlyCost']
-            vol_type = dv['VolumeType']
-            vol_id = dv['VolumeId']
-
-            # create the most granular metrics
-            if 'VolumeId' in debs_dims:
-                metric_data_add_debs_unit_cost(metric_data, timestamp,
-                                               cost_unit, cost, rz=rz,
-                                               vol_type=vol_type,
-                                               vol_id=vol_id)
-
-            # update aggregations
-            debs_count_rz_vtype[rz][vol_type] += 1
-            debs_cost_rz_vtype[rz][vol_type][cost_unit] += cost
-            debs_count_vtype[vol_type] += 1
-            debs_cost_vtype[vol_type][cost_unit] += cost
-            debs_count_rz[rz] += 1
-            debs_cost_rz[rz][cost_unit] += cost
-            debs_count += 1
-            debs_cost[cost_unit] += cost
-
-        # create regional aggregate metrics
-        if 'RZCode' in debs_dims:
-            if debs_count_rz[rz]:
-                metric_data_add_debs_count(metric_data, timestamp,
-                                           debs_count_rz[rz], rz=rz)
-                metric_data_add_debs_cost(metric_data, timestamp,
-                                          debs_cost_rz[rz], rz=rz)
-            if 'VolumeType' in debs_dims:
-                for vol_type, count in debs_count_rz_vtype[rz].items():
-                    metric_data_add_debs_count(metric_data, timestamp, count,
-                                               rz=rz, vol_type=vol_type)
-                    metric_data_add_debs_cost(metric_data, timestamp,
-                                              debs_cost_rz_vtype[rz][vol_type],
-                                              rz=rz, vol_type=vol_type)
-
-    # add the vol_type aggregate (cross-regional) metrics
-    if 'VolumeType' in debs_dims:
-        for vol_type, count in debs_count_vtype.items():
-            metric_data_add_debs_count(metric_data, timestamp, count,
-                                       vol_type=vol_type)
-            metric_data_add_debs_cost(metric_data, timestamp,
-                                      debs_cost_vtype[vol_type],
-                                      vol_type=vol_type)
-
-    # add the total aggregate data
-    metric_data_add_debs_count(metric_data, timestamp, debs_count)
-    metric_data_add_debs_cost(metric_data, timestamp, debs_cost)
-
-    return metric_data
+    return new_cube().add_all(dvs).metric_data(*METRICS, datetime.utcnow())
 
 
 #
 # Helper Functions for query()
 #
-def list_regions():
-    client = boto3.client('ec2')
-    aws_regions_info = client.describe_regions()
-    return [region['RegionName'] for region in
-            aws_regions_info.get('Regions', [])]
-
-
-def list_dvs_region(dvs, region):
-    client = boto3.client('ec2', region_name=region)
-    volumes = [response for response in boto3_paginate(
-        client.describe_volumes,
-        Filters=[
-            {
-                'Name': 'status',
-                'Values': ['available']
-            }
-        ]
-    )]
-    dvs[region] = [enrich_vol_info(v, client.meta.region_name)
-                   for v in volumes if len(v["Attachments"]) == 0]
+def list_dvs_region(dvs, region, compact=False):
+    client = clients.client('ec2', region)
+    collector = VolumeCollector(client.meta.region_name, compact)
+    for volume in boto3_paginate(client.describe_volumes,
+                                 Filters=DVS_FILTERS):
+        collector.add(volume)
+    dvs[region] = collector.done()
+
+
+async def list_dvs_region_async(aio, dvs, region, compact=False):
+    client = await aio.client('ec2', region)
+    collector = VolumeCollector(client.meta.region_name, compact)
+    async for volume in aio_paginate(client.describe_volumes,
+                                     Filters=DVS_FILTERS):
+        collector.add(volume)
+    dvs[region] = collector.done()
+
+
+class Volume(cube.Record):
+    '''
+    compact record of a detached volume, with just what summarize(),
+    aggregate() and the incremental state read
+    '''
+    __slots__ = ('VolumeId', 'VolumeType', 'RZCode', 'MonthlyCost',
+                 'MonthlyCostUnit', 'AccountId', 'Tags')
+    tag_keys = TAG_KEYS
+
+    def __repr__(self):
+        return f"Volume({self.VolumeId})"
+
+
+class VolumeCollector:
+    '''
+    keeps the detached volumes of a region as they stream from the pages,
+    priced ENRICH_BATCH at a time - as compact Volume records (for the
+    metrics) or as the full describe_volumes payloads (for listing)
+    '''
+    def __init__(self, region, compact=False, batch_size=ENRICH_BATCH):
+        self.region = region
+        self.compact = compact
+        self.batch_size = batch_size
+        self.batch = []
+        self.volumes = []
+
+    def add(self, volume):
+        if len(volume['Attachments']) == 0:
+            self.batch.append(volume)
+            if len(self.batch) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        with instrument.Stage('enrich'):
+            enrich_vols(self.batch, self.region)
+        if self.compact:
+            self.volumes.extend(map(Volume, self.batch))
+        else:
+            self.volumes.extend(self.batch)
+        self.batch = []
+
+    def done(self):
+        if self.batch:
+            self.flush()
+        return self.volumes
+
+
+def enrich_vols(volumes, region):
+    '''
+    enrich_vol_info for all the volumes of a region, priced in one batch
+    '''
+    for volume, cost in zip(volumes, get_costs(volumes, region)):
+        if cost is None:
+            # not in the pricing tables - enrich_vol_info reports it
+            enrich_vol_info(volume, region)
+        else:
+            volume['RZCode'] = region
+            volume['MonthlyCostUnit'], volume['MonthlyCost'] = cost
+    return volumes
 
 
 def enrich_vol_info(volume, region):
     volume['RZCode'] = region
     try:
-        pricing = PRICE_MAP[region][volume['VolumeType']]
+        pricing = ebs_price_map()[region][volume['VolumeType']]
         unit, cost = {
             'gp2': get_cost_basic,
             'gp3': get_cost_gp3,
@@ -158,11 +166,12 @@ def enrich_vol_info(volume, region):
         volume['MonthlyCostUnit'] = unit
     except KeyError as e:
         print("Internal Error: Please report the following to "
-              "support@cloudkeep.io")
-        print(f"- Failed to calculate monthly cost for {volume['VolumeId']}.")
-        print(f"- KeyError: {e}")
-        print("- volume info:")
-        print(json.dumps(volume, cls=DateTimeJSONEncoder))
+              "support@cloudkeep.io", file=sys.stderr)
+        print(f"- Failed to calculate monthly cost for {volume['VolumeId']}.",
+              file=sys.stderr)
+        print(f"- KeyError: {e}", file=sys.stderr)
+        print("- volume info:", file=sys.stderr)
+        print(json.dumps(volume, cls=DateTimeJSONEncoder), file=sys.stderr)
     return volume
 
 
@@ -226,69 +235,104 @@ def get_cost_standard(volume, pricing):
 
 
 #
-# Helper Functions for aggregate()
+# Batch pricing - the same formulas as get_cost_*() above, evaluated on
+# whole columns of Size/Iops/Throughput with numpy when it's installed (or
+# volume by volume with ScalarOps otherwise) against ebs_table()
 #
-def metric_data_add_debs_count(metric_data, timestamp, count,
-                               rz=None, vol_type=None, vol_id=None):
-    dims = []
-    if rz:
-        dims.append({
-            'Name': 'RZCode',
-            'Value': rz
-        })
-    if vol_type:
-        dims.append({
-            'Name': 'VolumeType',
-            'Value': vol_type
-        })
-    if vol_id:
-        dims.append({
-            'Name': 'VolumeId',
-            'Value': vol_id
-        })
-    metric_data.append({
-        'MetricName': 'DetachedEBSCount',
-        'Dimensions': dims,
-        'Timestamp': timestamp,
-        'Unit': 'None',
-        'Value': count
-    })
-
-
-def metric_data_add_debs_cost(metric_data, timestamp, unit_cost_dict,
-                              rz=None, vol_type=None, vol_id=None):
-    for unit, cost in unit_cost_dict.items():
-        metric_data_add_debs_unit_cost(metric_data, timestamp, unit, cost,
-                                       rz=rz, vol_type=vol_type, vol_id=vol_id)
-
-
-def metric_data_add_debs_unit_cost(metric_data, timestamp, cost_unit, cost,
-                                   rz=None, vol_type=None, vol_id=None):
-    dims = [
-        {
-            'Name': 'Currency',
-            'Value': cost_unit
-        }
-    ]
-    if rz:
-        dims.append({
-            'Name': 'RZCode',
-            'Value': rz
-        })
-    if vol_type:
-        dims.append({
-            'Name': 'VolumeType',
-            'Value': vol_type
-        })
-    if vol_id:
-        dims.append({
-            'Name': 'VolumeId',
-            'Value': vol_id
-        })
-    metric_data.append({
-        'MetricName': 'DetachedEBSMonthlyCost',
-        'Dimensions': dims,
-        'Timestamp': timestamp,
-        'Unit': 'None',
-        'Value': cost
-    })
+numpy = ...  # not loaded yet
+
+
+def load_numpy():
+    '''
+    imports numpy on first use - returns None if it's not installed
+    '''
+    global numpy
+    if numpy is ...:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    return numpy
+
+
+class ScalarOps:
+    @staticmethod
+    def where(condition, x, y):
+        return x if condition else y
+
+    minimum = staticmethod(min)
+
+
+def cost_basic(xp, p, size, iops, throughput):
+    return p.gb * size
+
+
+def cost_gp3(xp, p, size, iops, throughput):
+    cost = p.gb * size
+    cost = cost + xp.where(iops > 3000, p.iops * (iops - 3000), 0.0)
+    cost = cost + xp.where(throughput > 125,
+                           p.gibps * (throughput - 125)/1024, 0.0)
+    return cost
+
+
+def cost_io1(xp, p, size, iops, throughput):
+    return p.gb * size + p.iops * iops
+
+
+def cost_io2(xp, p, size, iops, throughput):
+    cost = p.gb * size
+    cost = cost + xp.where(iops > 64000, p.tier3_iops * (iops - 64000), 0.0)
+    cost = cost + xp.where(iops > 32000,
+                           p.tier2_iops * xp.minimum(iops - 32000, 32000),
+                           0.0)
+    cost = cost + p.tier1_iops * xp.minimum(iops, 32000)
+    return cost
+
+
+COST_FUNCTIONS = {
+    'gp2': cost_basic,
+    'gp3': cost_gp3,
+    'io1': cost_io1,
+    'io2': cost_io2,
+    'st1': cost_basic,
+    'sc1': cost_basic,
+    'standard': cost_basic
+}
+
+
+def get_costs(volumes, region):
+    '''
+    prices all the volumes of a region at once - returns (unit, cost) per
+    volume, or None for a volume that is not in the pricing tables
+    '''
+    prices = ebs_table().get(region, {})
+    # one pass over the volumes, into per volume type columns of
+    # (index, Size, Iops, Throughput)
+    by_type = {}
+    for i, volume in enumerate(volumes):
+        columns = by_type.get(volume['VolumeType'])
+        if columns is None:
+            columns = by_type[volume['VolumeType']] = ([], [], [], [])
+        columns[0].append(i)
+        columns[1].append(volume['Size'])
+        columns[2].append(volume.get('Iops') or 0)
+        columns[3].append(volume.get('Throughput') or 0)
+
+    costs = [None] * len(volumes)
+    for vol_type, (idx, *columns) in by_type.items():
+        p = prices.get(vol_type)
+        cost_function = COST_FUNCTIONS.get(vol_type)
+        if p is None or cost_function is None:
+            continue
+        np = load_numpy()
+        if np is not None:
+            type_costs = cost_function(
+                np, p, *[np.array(c, dtype=np.int64)
+                         for c in columns]).tolist()
+        else:
+            type_costs = [cost_function(ScalarOps, p, *vol)
+                          for vol in zip(*columns)]
+        unit = p.currency
+        for i, cost in zip(idx, type_costs):
+            costs[i] = (unit, cost)
+    return costs
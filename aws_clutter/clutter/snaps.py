@@ -0,0 +1,190 @@
+import os
+import sys
+import functools
+import aws_clutter.clients as clients
+import aws_clutter.cube as cube
+from aws_clutter.pricing import snapshot_table
+from aws_clutter.scheduler import run_scan
+from aws_clutter.tools import boto3_paginate, aio_paginate
+from datetime import datetime
+
+NAME = 'snaps'
+DESCRIPTION = 'Orphaned EBS Snapshots'
+RESOURCE_ID = 'SnapshotId'
+SNAPS_DIMS_DEFAULT = os.getenv('SNAPS_DIMS', default="RZCode")
+# page sizes (the API maximums), to list millions of snapshots in as few
+# calls as possible
+SNAPSHOTS_PAGE = {'PageSize': 1000}
+IMAGES_PAGE = {'PageSize': 1000}
+VOLUMES_PAGE = {'PageSize': 500}
+# rollup dimensions of the metrics, in datum order (plus Tag:<key>)
+DIMENSIONS = ['RZCode', 'StorageTier', 'AccountId']
+# dimensions of the per-snapshot metrics (with SnapshotId in SNAPS_DIMS)
+SNAPSHOT_DIMENSIONS = ['RZCode', 'StorageTier', 'SnapshotId']
+# tags kept in the compact Snapshot records, for the Tag:<key> dimensions
+TAG_KEYS = cube.tag_keys(cube.parse_dims(SNAPS_DIMS_DEFAULT))
+# the count and cost metrics
+METRICS = ('OrphanedSnapshotCount', 'OrphanedSnapshotMonthlyCost')
+GIB = 1024 ** 3
+
+
+async def query(snaps, scheduler=None):
+    compact = scheduler is not None and scheduler.compact_records
+    await run_scan(functools.partial(list_snaps_region, compact=compact),
+                   snaps, scheduler,
+                   functools.partial(list_snaps_region_async,
+                                     compact=compact),
+                   NAME)
+
+
+def summarize(snaps):
+    summary = cube.Cube(['RZCode']).add_all(snaps).summary()
+    units = summary.keys()
+    if len(units) == 0:
+        print("No Orphaned EBS Snapshots found.")
+    else:
+        for unit in units:
+            print(f"[snaps] Found {summary[unit]['count']} orphaned EBS "
+                  f"snapshots with monthly storage cost of "
+                  f"{summary[unit]['cost']} {unit} in regions: "
+                  f"{summary[unit]['rzs']}")
+
+
+def new_cube():
+    '''
+    the (empty) cube of the metrics, as set by SNAPS_DIMS
+    '''
+    snaps_dims = cube.parse_dims(SNAPS_DIMS_DEFAULT)
+    return cube.Cube(
+        cube.rollup_dims(snaps_dims, DIMENSIONS),
+        resource_dims=SNAPSHOT_DIMENSIONS if 'SnapshotId' in snaps_dims
+        else ())
+
+
+def aggregate(snaps):
+    return new_cube().add_all(snaps).metric_data(*METRICS,
+                                                 datetime.utcnow())
+
+
+#
+# Helper Functions for query()
+#
+def list_snaps_region(snaps, region, compact=False):
+    '''
+    the snapshots are streamed page by page and joined against the sets of
+    the IDs of the live volumes and of the snapshots the AMIs use - only the
+    orphaned ones are kept
+    '''
+    client = clients.client('ec2', region)
+    volume_ids = {volume['VolumeId'] for volume in boto3_paginate(
+        client.describe_volumes,
+        PaginationConfig=VOLUMES_PAGE
+    )}
+    image_snapshot_ids = {snapshot_id for image in boto3_paginate(
+        client.describe_images,
+        Owners=['self'],
+        PaginationConfig=IMAGES_PAGE
+    ) for snapshot_id in image_snapshots(image)}
+    snaps[region] = [
+        enrich_snap_info(snap, client.meta.region_name, compact)
+        for snap in boto3_paginate(
+            client.describe_snapshots,
+            OwnerIds=['self'],
+            PaginationConfig=SNAPSHOTS_PAGE
+        ) if orphaned(snap, volume_ids, image_snapshot_ids)
+    ]
+    report_unpriced(snaps[region], region)
+
+
+async def list_snaps_region_async(aio, snaps, region, compact=False):
+    client = await aio.client('ec2', region)
+    volume_ids = {volume['VolumeId'] async for volume in aio_paginate(
+        client.describe_volumes,
+        PaginationConfig=VOLUMES_PAGE
+    )}
+    image_snapshot_ids = {snapshot_id async for image in aio_paginate(
+        client.describe_images,
+        Owners=['self'],
+        PaginationConfig=IMAGES_PAGE
+    ) for snapshot_id in image_snapshots(image)}
+    snaps[region] = [
+        enrich_snap_info(snap, client.meta.region_name, compact)
+        async for snap in aio_paginate(
+            client.describe_snapshots,
+            OwnerIds=['self'],
+            PaginationConfig=SNAPSHOTS_PAGE
+        ) if orphaned(snap, volume_ids, image_snapshot_ids)
+    ]
+    report_unpriced(snaps[region], region)
+
+
+def image_snapshots(image):
+    return [bdm['Ebs']['SnapshotId']
+            for bdm in image.get('BlockDeviceMappings', [])
+            if 'SnapshotId' in bdm.get('Ebs', {})]
+
+
+def orphaned(snap, volume_ids, image_snapshot_ids):
+    '''
+    a snapshot is orphaned when neither the volume it was taken from nor an
+    AMI using it exists anymore
+    '''
+    return (snap.get('VolumeId') not in volume_ids and
+            snap['SnapshotId'] not in image_snapshot_ids)
+
+
+class Snapshot(cube.Record):
+    '''
+    compact record of an orphaned snapshot, with just what summarize(),
+    aggregate() and the incremental state read
+    '''
+    __slots__ = ('SnapshotId', 'StorageTier', 'RZCode', 'MonthlyCost',
+                 'MonthlyCostUnit', 'AccountId', 'Tags')
+    tag_keys = TAG_KEYS
+
+    def __repr__(self):
+        return f"Snapshot({self.SnapshotId})"
+
+
+def enrich_snap_info(snap, region, compact=False):
+    '''
+    a snapshot of a region or storage tier without a price is kept without a
+    cost (see report_unpriced)
+    '''
+    snap['RZCode'] = region
+    snap['StorageTier'] = snap.get('StorageTier') or 'standard'
+    try:
+        unit, cost = get_snap_cost(snap, region)
+        snap['MonthlyCost'] = cost
+        snap['MonthlyCostUnit'] = unit
+    except KeyError:
+        pass
+    return Snapshot(snap) if compact else snap
+
+
+def report_unpriced(snaps, region):
+    '''
+    reports the snapshots of the region left without a cost on stderr, once
+    for the region
+    '''
+    tiers = sorted({snap['StorageTier'] for snap in snaps
+                    if 'MonthlyCost' not in snap})
+    if tiers:
+        count = sum(1 for snap in snaps if 'MonthlyCost' not in snap)
+        print(f"[snaps] No snapshot price for {region} ({', '.join(tiers)}):"
+              f" {count} orphaned snapshots counted without a cost",
+              file=sys.stderr)
+
+
+def get_snap_cost(snap, region):
+    '''
+    (currency, monthly cost) of storing the full snapshot - an upper bound,
+    as the blocks shared with earlier snapshots of the volume are only paid
+    for once. Raises KeyError for a region or storage tier without a price.
+    '''
+    prices = snapshot_table()[region][snap['StorageTier']]
+    if snap.get('FullSnapshotSizeInBytes'):
+        size = snap['FullSnapshotSizeInBytes'] / GIB
+    else:
+        size = snap['VolumeSize']
+    return (prices.currency, prices.gb * size)
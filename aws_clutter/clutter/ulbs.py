@@ -1,42 +1,75 @@
-import boto3
-import json
+import os
 import asyncio
+import threading
+import contextvars
 import concurrent.futures
-import os
-from importlib_resources import files
-from aws_clutter.tools import boto3_paginate
-from datetime import datetime
+import aws_clutter.clients as clients
+import aws_clutter.cube as cube
+import aws_clutter.instrument as instrument
+from aws_clutter.pricing import elb_table
+from aws_clutter.scheduler import run_scan
+from aws_clutter.tools import (boto3_paginate, aio_paginate, TokenBucket,
+                               check_deadline)
+from datetime import datetime, timedelta, timezone
 from collections import defaultdict
 
-ELB_PRICING = json.loads(
-    files('aws_clutter.data')
-    .joinpath('elb_pricing.json')
-    .read_text()
-)
+NAME = 'ulbs'
+DESCRIPTION = 'Unused Load Balancers'
+RESOURCE_ID = 'LoadBalancerArn'
 ULBS_DIMS_DEFAULT = os.getenv('ULBS_DIMS', default="RZCode")
+# per-region limit of the describe_target_health fan-out
+ULBS_TG_CONCURRENCY = int(os.getenv('ULBS_TG_CONCURRENCY', default='8'))
+# threads of the fan-out, shared by all the regions
+ULBS_TG_WORKERS = int(os.getenv('ULBS_TG_WORKERS', default='32'))
+# calls per second of the fan-out, across all the regions, slowed down as
+# they get throttled - 0 for no limit until they do (see tools.TokenBucket)
+ULBS_TG_RATE = float(os.getenv('ULBS_TG_RATE', default='0'))
+TG_BUCKET = TokenBucket(ULBS_TG_RATE, adaptive=True)
+# optional check of the LBs with targets for traffic, to also report the
+# idle ones
+ULBS_IDLE_CHECK = os.getenv('ULBS_IDLE_CHECK', default='').lower() in (
+    '1', 'true', 'yes', 'y', 'on')
+# lookback window of the traffic check, in days
+ULBS_IDLE_DAYS = int(os.getenv('ULBS_IDLE_DAYS', default='14'))
+# an LB is idle when none of its traffic metrics sums to more than these
+# over the lookback window
+ULBS_IDLE_THRESHOLDS = {
+    'RequestCount': float(os.getenv('ULBS_IDLE_REQUESTS', default='0')),
+    'ProcessedBytes': float(os.getenv('ULBS_IDLE_BYTES', default='0')),
+    'ActiveFlowCount': float(os.getenv('ULBS_IDLE_FLOWS', default='0')),
+}
+# CloudWatch namespace and traffic metrics of each LB type
+TRAFFIC_METRICS = {
+    'application': ('AWS/ApplicationELB', ['RequestCount', 'ProcessedBytes']),
+    'network': ('AWS/NetworkELB', ['ActiveFlowCount', 'ProcessedBytes']),
+    'gateway': ('AWS/GatewayELB', ['ActiveFlowCount', 'ProcessedBytes']),
+}
+# queries per get_metric_data call (the API maximum)
+MAX_METRIC_QUERIES = 500
+# why an LB is reported (the Reason dimension)
+REASON_NO_TARGETS = 'NoTargets'
+REASON_IDLE = 'Idle'
 HRS_IN_MONTH = 730
+# rollup dimensions of the metrics, in datum order (plus Tag:<key>)
+DIMENSIONS = ['RZCode', 'LBType', 'Reason', 'AccountId']
+# dimensions of the per-LB metrics (with LoadBalancerArn in ULBS_DIMS)
+LB_DIMENSIONS = ['RZCode', 'LBType', 'Reason', 'LoadBalancerArn']
+# resource keys of the dimensions named differently
+DIMENSION_KEYS = {'LBType': 'Type'}
+# the count and cost metrics
+METRICS = ('UnusedLBCount', 'UnusedLBMonthlyCost')
+# (pid, thread pool) of the fan-out (see tg_executor)
+_executor = None
+_executor_lock = threading.Lock()
 
 
-async def query(ulbs):
-    executor = concurrent.futures.ThreadPoolExecutor(max_workers=30)
-    loop = asyncio.get_event_loop()
-    await asyncio.wait(
-        [loop.run_in_executor(executor, list_ulbs_region, *(ulbs, region))
-         for region in list_regions()]
-    )
+async def query(ulbs, scheduler=None):
+    await run_scan(list_ulbs_region, ulbs, scheduler, list_ulbs_region_async,
+                   NAME)
 
 
 def summarize(ulbs):
-    summary = {}
-    for rz in ulbs.keys():
-        if len(ulbs[rz]):
-            rz_cost = sum(ulb["MonthlyCost"] for ulb in ulbs[rz])
-            unit = ulbs[rz][0]["MonthlyCostUnit"]
-            if not summary.get(unit):
-                summary[unit] = {'cost': 0.0, 'count': 0, 'rzs': []}
-            summary[unit]['cost'] += rz_cost
-            summary[unit]['count'] += len(ulbs[rz])
-            summary[unit]['rzs'].append(rz)
+    summary = cube.Cube(['RZCode']).add_all(ulbs).summary()
     units = summary.keys()
     if len(units) == 0:
         print("No Unused Load Balancers found.")
@@ -48,110 +81,297 @@ def summarize(ulbs):
                   f"{summary[unit]['rzs']}")
 
 
+def new_cube():
+    '''
+    the (empty) cube of the metrics, as set by ULBS_DIMS
+    '''
+    ulbs_dims = cube.parse_dims(ULBS_DIMS_DEFAULT)
+    return cube.Cube(
+        cube.rollup_dims(ulbs_dims, DIMENSIONS), DIMENSION_KEYS,
+        resource_dims=(LB_DIMENSIONS if 'LoadBalancerArn' in ulbs_dims
+                       else ()))
+
+
 def aggregate(ulbs):
-    ulbs_dims = [d.strip() for d in ULBS_DIMS_DEFAULT.split(',')]
-    timestamp = datetime.utcnow()
-    metric_data = []
-    ulbs_count = 0
-    ulbs_cost = defaultdict(float)
-    ulbs_count_rz = defaultdict(int)
-    ulbs_cost_rz = defaultdict(lambda: defaultdict(float))
-    ulbs_count_lbtype = defaultdict(int)
-    ulbs_cost_lbtype = defaultdict(lambda: defaultdict(float))
-    ulbs_count_rz_lbtype = defaultdict(lambda: defaultdict(int))
-    ulbs_cost_rz_lbtype = defaultdict(
-        lambda: defaultdict(lambda: defaultdict(float)))
-
-    for rz in ulbs.keys():
-        for lb in ulbs[rz]:
-            cost_unit = lb['MonthlyCostUnit']
-            cost = lb['MonthlyCost']
-            lb_type = lb['Type']
-
-            # update aggregations
-            ulbs_count_rz_lbtype[rz][lb_type] += 1
-            ulbs_cost_rz_lbtype[rz][lb_type][cost_unit] += cost
-            ulbs_count_lbtype[lb_type] += 1
-            ulbs_cost_lbtype[lb_type][cost_unit] += cost
-            ulbs_count_rz[rz] += 1
-            ulbs_cost_rz[rz][cost_unit] += cost
-            ulbs_count += 1
-            ulbs_cost[cost_unit] += cost
-
-        # create regional aggregate metrics
-        if 'RZCode' in ulbs_dims:
-            if ulbs_count_rz[rz]:
-                metric_data_add_ulbs_count(metric_data, timestamp,
-                                           ulbs_count_rz[rz], rz=rz)
-                metric_data_add_ulbs_cost(metric_data, timestamp,
-                                          ulbs_cost_rz[rz], rz=rz)
-            if 'LBType' in ulbs_dims:
-                for lb_type, count in ulbs_count_rz_lbtype[rz].items():
-                    metric_data_add_ulbs_count(metric_data, timestamp, count,
-                                               rz=rz, lb_type=lb_type)
-                    metric_data_add_ulbs_cost(metric_data, timestamp,
-                                              ulbs_cost_rz_lbtype[rz][lb_type],
-                                              rz=rz, lb_type=lb_type)
-
-    # add the lb_type aggregate (cross-regional) metrics
-    if 'LBType' in ulbs_dims:
-        for lb_type, count in ulbs_count_lbtype.items():
-            metric_data_add_ulbs_count(metric_data, timestamp, count,
-                                       lb_type=lb_type)
-            metric_data_add_ulbs_cost(metric_data, timestamp,
-                                      ulbs_cost_lbtype[lb_type],
-                                      lb_type=lb_type)
-
-    # add the total aggregate data
-    metric_data_add_ulbs_count(metric_data, timestamp, ulbs_count)
-    metric_data_add_ulbs_cost(metric_data, timestamp, ulbs_cost)
-
-    return metric_data
+    return new_cube().add_all(ulbs).metric_data(*METRICS, datetime.utcnow())
 
 
 #
 # Helper Functions for query()
 #
-def list_regions():
-    client = boto3.client('ec2')
-    aws_regions_info = client.describe_regions()
-    return [region['RegionName'] for region in
-            aws_regions_info.get('Regions', [])]
-
-
 def list_ulbs_region(ulbs, region):
-    client = boto3.client('elbv2', region_name=region)
+    client = clients.client('elbv2', region)
     lbs = [response for response in boto3_paginate(
         client.describe_load_balancers
     )]
     tgs = [response for response in boto3_paginate(
         client.describe_target_groups
     )]
+    lb_tgs = index_lb_tgs(tgs)
+    pace_tg_healths(client)
+    tg_healths = fetch_tg_healths(tgs, client)
+    reasons = {lb['LoadBalancerArn']: REASON_NO_TARGETS
+               for lb in lbs if lb_unused(lb, lb_tgs, tg_healths)}
+    if ULBS_IDLE_CHECK:
+        traffic = fetch_traffic(
+            [lb for lb in lbs if lb['LoadBalancerArn'] not in reasons],
+            clients.client('cloudwatch', region))
+        reasons.update(idle_reasons(traffic))
+    with instrument.Stage('enrich'):
+        ulbs[region] = [
+            enrich_lb_info(lb, client.meta.region_name,
+                           reasons[lb['LoadBalancerArn']])
+            for lb in lbs if lb['LoadBalancerArn'] in reasons
+        ]
+
+
+async def list_ulbs_region_async(aio, ulbs, region):
+    client = await aio.client('elbv2', region)
+    lbs = [response async for response in aio_paginate(
+        client.describe_load_balancers
+    )]
+    tgs = [response async for response in aio_paginate(
+        client.describe_target_groups
+    )]
+    lb_tgs = index_lb_tgs(tgs)
+    pace_tg_healths(client, aio=True)
+    tg_healths = await fetch_tg_healths_async(tgs, client)
+    reasons = {lb['LoadBalancerArn']: REASON_NO_TARGETS
+               for lb in lbs if lb_unused(lb, lb_tgs, tg_healths)}
+    if ULBS_IDLE_CHECK:
+        traffic = await fetch_traffic_async(
+            [lb for lb in lbs if lb['LoadBalancerArn'] not in reasons],
+            await aio.client('cloudwatch', region))
+        reasons.update(idle_reasons(traffic))
+    with instrument.Stage('enrich'):
+        ulbs[region] = [
+            enrich_lb_info(lb, client.meta.region_name,
+                           reasons[lb['LoadBalancerArn']])
+            for lb in lbs if lb['LoadBalancerArn'] in reasons
+        ]
+
+
+def index_lb_tgs(tgs):
+    '''
+    inverted index from LB ARN to the ARNs of the target groups attached to it
+    '''
+    lb_tgs = defaultdict(list)
+    for tg in tgs:
+        for lb_arn in tg['LoadBalancerArns']:
+            lb_tgs[lb_arn].append(tg['TargetGroupArn'])
+    return lb_tgs
+
+
+def pace_tg_healths(client, aio=False):
+    '''
+    paces the describe_target_health calls of the (shared) client with the
+    ones of the other regions, at ULBS_TG_RATE
+    '''
+    service_id = client.meta.service_model.service_id.hyphenize()
+    clients.pace(client.meta.events, TG_BUCKET,
+                 f'{service_id}.DescribeTargetHealth', aio)
+
+
+def tg_executor():
+    '''
+    the thread pool of the describe_target_health fan-out, ULBS_TG_WORKERS
+    threads shared by all the regions (made again in a forked process)
+    '''
+    global _executor
+    with _executor_lock:
+        if _executor is None or _executor[0] != os.getpid():
+            _executor = (os.getpid(), concurrent.futures.ThreadPoolExecutor(
+                max_workers=ULBS_TG_WORKERS, thread_name_prefix='ulbs-tg'))
+        return _executor[1]
+
+
+def fetch_tg_healths(tgs, client, concurrency=None):
+    '''
+    describe_target_health of the target groups attached to an LB, issued
+    concurrently on tg_executor() (up to concurrency calls of the region in
+    flight), each in a copy of the context of the scan - e.g., with its
+    deadline. A target group is skipped once all of its LBs are known to be
+    in use.
+    '''
+    lock = threading.Lock()
+    used_lbs = set()
     tg_healths = {}
-    ulbs[region] = [enrich_lb_info(lb, client.meta.region_name)
-                    for lb in lbs if lb_unused(lb, tgs, tg_healths, client)]
 
+    def probe(tg):
+        check_deadline()
+        with lock:
+            if used_lbs.issuperset(tg['LoadBalancerArns']):
+                return
+        r = client.describe_target_health(TargetGroupArn=tg['TargetGroupArn'])
+        with lock:
+            tg_healths[tg['TargetGroupArn']] = r
+            if len(r['TargetHealthDescriptions']):
+                used_lbs.update(tg['LoadBalancerArns'])
+
+    concurrency = concurrency or ULBS_TG_CONCURRENCY
+    executor = tg_executor()
+    pending = set()
+    try:
+        for tg in tgs:
+            if not tg['LoadBalancerArns']:
+                continue
+            if len(pending) >= concurrency:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            pending.add(executor.submit(contextvars.copy_context().run,
+                                        probe, tg))
+        for future in concurrent.futures.as_completed(pending):
+            future.result()
+    finally:
+        # the calls not started yet, after an error
+        for future in pending:
+            future.cancel()
+    return tg_healths
+
+
+async def fetch_tg_healths_async(tgs, client, concurrency=None):
+    '''
+    fetch_tg_healths for aiobotocore clients, on the event loop
+    '''
+    semaphore = asyncio.Semaphore(concurrency or ULBS_TG_CONCURRENCY)
+    used_lbs = set()
+    tg_healths = {}
 
-def lb_unused(lb, tgs, tg_healths, client):
-    lb_ths = [tg_health(tg, tg_healths, client) for tg in tgs
-              if lb['LoadBalancerArn'] in tg['LoadBalancerArns']]
-    for th in lb_ths:
-        if len(th['TargetHealthDescriptions']):
+    async def probe(tg):
+        async with semaphore:
+            if used_lbs.issuperset(tg['LoadBalancerArns']):
+                return
+            r = await client.describe_target_health(
+                TargetGroupArn=tg['TargetGroupArn'])
+        tg_healths[tg['TargetGroupArn']] = r
+        if len(r['TargetHealthDescriptions']):
+            used_lbs.update(tg['LoadBalancerArns'])
+
+    await asyncio.gather(*[probe(tg) for tg in tgs if tg['LoadBalancerArns']])
+    return tg_healths
+
+
+def lb_unused(lb, lb_tgs, tg_healths):
+    # any target group with targets registered makes the LB used
+    for tg_arn in lb_tgs.get(lb['LoadBalancerArn'], []):
+        th = tg_healths.get(tg_arn)
+        if th is not None and len(th['TargetHealthDescriptions']):
             return False
     return True
 
 
-def tg_health(tg, tg_healths, client):
-    tg_arn = tg['TargetGroupArn']
-    r = tg_healths.get(tg_arn)
-    if r is None:
-        r = client.describe_target_health(TargetGroupArn=tg_arn)
-        tg_healths[tg_arn] = r
-    return r
-
-
-def enrich_lb_info(lb, region):
+def traffic_window(days=None):
+    end = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    return end - timedelta(days=days or ULBS_IDLE_DAYS), end
+
+
+def traffic_queries(lbs, start, end):
+    '''
+    get_metric_data queries of the traffic metrics of the LBs created before
+    start, each summed over the window - with Ids of m<LB index>_<metric
+    index> into lbs
+    '''
+    period = int((end - start).total_seconds()) // 60 * 60
+    queries = []
+    for i, lb in enumerate(lbs):
+        if lb.get('CreatedTime') and lb['CreatedTime'] > start:
+            continue
+        namespace, metrics = TRAFFIC_METRICS.get(lb['Type'], (None, []))
+        # e.g., app/my-lb/50dc6c495c0c9188 for arn:...:loadbalancer/app/...
+        dimension = lb['LoadBalancerArn'].split(':loadbalancer/')[-1]
+        for j, metric in enumerate(metrics):
+            queries.append({
+                'Id': f'm{i}_{j}',
+                'MetricStat': {
+                    'Metric': {
+                        'Namespace': namespace,
+                        'MetricName': metric,
+                        'Dimensions': [{'Name': 'LoadBalancer',
+                                        'Value': dimension}]
+                    },
+                    'Period': period,
+                    'Stat': 'Sum'
+                },
+                'ReturnData': True
+            })
+    return queries
+
+
+def add_traffic(traffic, lbs, results):
+    '''
+    adds the values of get_metric_data results to traffic (LB ARN -> metric
+    name -> sum)
+    '''
+    for result in results:
+        i, j = map(int, result['Id'][1:].split('_'))
+        lb = lbs[i]
+        metric = TRAFFIC_METRICS[lb['Type']][1][j]
+        lb_traffic = traffic.setdefault(lb['LoadBalancerArn'], {})
+        lb_traffic[metric] = (lb_traffic.get(metric, 0.0) +
+                              sum(result.get('Values', [])))
+
+
+def fetch_traffic(lbs, client, days=None):
+    '''
+    traffic of the LBs (LB ARN -> metric name -> sum over the last days),
+    with the queries of all of them packed into as few get_metric_data calls
+    as possible. LBs younger than the window aren't checked.
+    '''
+    start, end = traffic_window(days)
+    queries = traffic_queries(lbs, start, end)
+    # the LBs without data points have had no traffic
+    traffic = {}
+    add_traffic(traffic, lbs, [{'Id': query['Id']} for query in queries])
+    for n in range(0, len(queries), MAX_METRIC_QUERIES):
+        kwargs = {}
+        while True:
+            r = client.get_metric_data(
+                MetricDataQueries=queries[n:n + MAX_METRIC_QUERIES],
+                StartTime=start, EndTime=end, **kwargs)
+            add_traffic(traffic, lbs, r['MetricDataResults'])
+            if not r.get('NextToken'):
+                break
+            kwargs['NextToken'] = r['NextToken']
+    return traffic
+
+
+async def fetch_traffic_async(lbs, client, days=None):
+    '''
+    fetch_traffic for aiobotocore clients
+    '''
+    start, end = traffic_window(days)
+    queries = traffic_queries(lbs, start, end)
+    traffic = {}
+    add_traffic(traffic, lbs, [{'Id': query['Id']} for query in queries])
+    for n in range(0, len(queries), MAX_METRIC_QUERIES):
+        kwargs = {}
+        while True:
+            r = await client.get_metric_data(
+                MetricDataQueries=queries[n:n + MAX_METRIC_QUERIES],
+                StartTime=start, EndTime=end, **kwargs)
+            add_traffic(traffic, lbs, r['MetricDataResults'])
+            if not r.get('NextToken'):
+                break
+            kwargs['NextToken'] = r['NextToken']
+    return traffic
+
+
+def idle_reasons(traffic, thresholds=None):
+    '''
+    LB ARN -> REASON_IDLE for the LBs whose traffic is within the thresholds
+    (metric name -> max sum, defaulting to ULBS_IDLE_THRESHOLDS)
+    '''
+    thresholds = {**ULBS_IDLE_THRESHOLDS, **(thresholds or {})}
+    return {lb_arn: REASON_IDLE for lb_arn, lb_traffic in traffic.items()
+            if all(total <= thresholds[metric]
+                   for metric, total in lb_traffic.items())}
+
+
+def enrich_lb_info(lb, region, reason=REASON_NO_TARGETS):
     lb['RZCode'] = region
+    lb['Reason'] = reason
     (currency, monthly_cost) = get_lb_base_cost(lb, region)
     lb['MonthlyCost'] = monthly_cost
     lb['MonthlyCostUnit'] = currency
@@ -166,69 +386,5 @@ def get_lb_base_cost(lb, region):
             location_type = 'outpost'
             break
 
-    base_pricing = (ELB_PRICING[region][elb_type]
-                               [location_type]['LoadBalancerUsage'])
-    pricing = base_pricing['pricePerUnit']
-    units = pricing.keys()
-    for unit in units:
-        monthly_cost = float(pricing[unit]) * HRS_IN_MONTH
-        return (unit, monthly_cost)
-
-
-#
-# Helper Functions for aggregate()
-#
-def metric_data_add_ulbs_count(metric_data, timestamp, count,
-                               rz=None, lb_type=None):
-    dims = []
-    if rz:
-        dims.append({
-            'Name': 'RZCode',
-            'Value': rz
-        })
-    if lb_type:
-        dims.append({
-            'Name': 'LBType',
-            'Value': lb_type
-        })
-    metric_data.append({
-        'MetricName': 'UnusedLBCount',
-        'Dimensions': dims,
-        'Timestamp': timestamp,
-        'Unit': 'None',
-        'Value': count
-    })
-
-
-def metric_data_add_ulbs_cost(metric_data, timestamp, unit_cost_dict,
-                              rz=None, lb_type=None):
-    for unit, cost in unit_cost_dict.items():
-        metric_data_add_ulbs_unit_cost(metric_data, timestamp, unit, cost,
-                                       rz=rz, lb_type=lb_type)
-
-
-def metric_data_add_ulbs_unit_cost(metric_data, timestamp, cost_unit, cost,
-                                   rz=None, lb_type=None):
-    dims = [
-        {
-            'Name': 'Currency',
-            'Value': cost_unit
-        }
-    ]
-    if rz:
-        dims.append({
-            'Name': 'RZCode',
-            'Value': rz
-        })
-    if lb_type:
-        dims.append({
-            'Name': 'LBType',
-            'Value': lb_type
-        })
-    metric_data.append({
-        'MetricName': 'UnusedLBMonthlyCost',
-        'Dimensions': dims,
-        'Timestamp': timestamp,
-        'Unit': 'None',
-        'Value': cost
-    })
+    prices = elb_table()[region][elb_type][location_type]
+    return (prices.currency, prices.hourly * HRS_IN_MONTH)
@@ -0,0 +1,443 @@
+'''
+Single pass group-by ("cube") over the resources of a clutter type: counts
+them and sums their monthly costs per currency for every rollup (subset) of
+the requested dimensions at once, in flat dicts keyed by (rollup, values).
+The same engine feeds the CloudWatch metric data and the --summary output.
+
+The costs are summed left to right within each region, and the regional
+sums are then added up in the order of the region names - so that cubes of
+the regions built apart (e.g. in separate processes) and merged give the
+same metrics as one cube of all of them.
+'''
+import os
+import heapq
+import operator
+import itertools
+
+# dimension for the value of a resource tag, e.g. Tag:team
+TAG_PREFIX = 'Tag:'
+# limits of the per-resource cost series: only the TOP_RESOURCES most
+# expensive resources (all of them when unset) of those costing at least
+# MIN_RESOURCE_COST get their own series; the rest are summed into OTHER
+TOP_RESOURCES = (int(os.getenv('CK_TOP_RESOURCES'))
+                 if os.getenv('CK_TOP_RESOURCES') else None)
+MIN_RESOURCE_COST = float(os.getenv('CK_MIN_RESOURCE_COST', default='0'))
+# resource id of the series of the resources left out
+OTHER = 'Other'
+
+
+def parse_dims(spec):
+    '''
+    dimension names of a comma-separated spec, e.g. $DEBS_DIMS
+    '''
+    return [d.strip() for d in spec.split(',') if d.strip()]
+
+
+def tag_keys(dims):
+    return {d[len(TAG_PREFIX):] for d in dims if d.startswith(TAG_PREFIX)}
+
+
+def rollup_dims(dims, dimensions):
+    '''
+    the requested dims that are rolled up, in datum order: the clutter type's
+    dimensions first, then the tag dimensions in the order requested
+    '''
+    return ([d for d in dimensions if d in dims] +
+            [d for d in dims if d.startswith(TAG_PREFIX)])
+
+
+def tag_value(resource, key):
+    for tag in resource.get('Tags') or ():
+        if tag['Key'] == key:
+            return tag['Value']
+    return None
+
+
+class Record:
+    '''
+    Compact resource record keeping just the keys in __slots__ (and, of the
+    Tags, the ones in tag_keys, for the Tag:<key> dimensions) - read and
+    written as a dict by the cube, summaries and incremental state.
+    Subclasses list the keys they keep in __slots__.
+    '''
+    __slots__ = ()
+    tag_keys = frozenset()
+
+    def __init__(self, resource):
+        for key in self.__slots__:
+            if key in resource and key != 'Tags':
+                setattr(self, key, resource[key])
+        tags = [tag for tag in resource.get('Tags') or ()
+                if tag['Key'] in self.tag_keys]
+        if tags:
+            self.Tags = tags
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return hasattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+
+class Cube:
+    '''
+    Counts and costs of resources for every subset of dims (the empty one
+    being the totals). RZCode is the region the resources are listed under;
+    the other dims are read from the resources through keys (dimension ->
+    resource key) or from their tags. Resources without a value for a
+    dimension are left out of the rollups with that dimension.
+
+    With resource_dims (ending with the resource id), each resource also
+    gets its own cost datum with these dimensions - or, when it is not one
+    of the top most expensive resources or costs less than min_cost, adds
+    to the datum of the same dimensions but for a resource id of OTHER.
+    top and min_cost default to $CK_TOP_RESOURCES and $CK_MIN_RESOURCE_COST.
+
+    Resources without a price (no MonthlyCostUnit, e.g. a volume type not in
+    the pricing tables of its region) are counted, but left out of the
+    costs.
+
+    state() is what a cube has added up, as JSON-able data, and merge()
+    adds such a state of a cube with the same settings to this one.
+    '''
+    def __init__(self, dims, keys=None, resource_dims=(), top=None,
+                 min_cost=None):
+        self.dims = [*dims]
+        self.keys = keys or {}
+        self.resource_dims = [*resource_dims]
+        self.top = TOP_RESOURCES if top is None else top
+        self.min_cost = MIN_RESOURCE_COST if min_cost is None else min_cost
+        self.rollups = [combo for n in range(len(self.dims) + 1)
+                        for combo in itertools.combinations(
+                            range(len(self.dims)), n)]
+        # rollup index -> (index of the same rollup without RZCode, position
+        # of RZCode) of the rollups with RZCode: within a region, their
+        # cells add up the same resources as the ones without
+        rz = self.dims.index('RZCode') if 'RZCode' in self.dims else None
+        self.regional = {
+            ri: (self.rollups.index(tuple(i for i in rollup if i != rz)),
+                 rollup.index(rz))
+            for ri, rollup in enumerate(self.rollups) if rz in rollup
+        }
+        # region -> ({((rollup index, values), currency): cell index},
+        # counts, costs) of the region's cells (the ones of the rollups with
+        # RZCode sharing the index of their rollup without)
+        self.regions = {}
+        # region -> per-resource (values, currency, cost)
+        self.resources = {}
+        # with top, region -> the (cost, -seq, region, values, currency) of
+        # the region's most expensive resources so far, in a min-heap,
+        # instead
+        self.heaps = {}
+        self.seq = 0
+        # region -> {(values, currency): cost} of the OTHER series
+        self.others = {}
+
+    def getter(self, dim):
+        if dim.startswith(TAG_PREFIX):
+            tag_key = dim[len(TAG_PREFIX):]
+            return lambda r: tag_value(r, tag_key)
+        return operator.methodcaller('get', self.keys.get(dim, dim))
+
+    def add_all(self, resources):
+        '''
+        adds {region: [resources]}
+        '''
+        for region, rs in resources.items():
+            self.add_region(region, rs)
+        return self
+
+    def add_region(self, region, resources):
+        _, counts, costs = self.region_cells(region)
+        getters = [self.getter(dim) for dim in self.dims if dim != 'RZCode']
+        getter = getters[0] if len(getters) == 1 else None
+        resource_getters = [None if dim == 'RZCode' else self.getter(dim)
+                            for dim in self.resource_dims]
+        region_resources = (self.resources[region]
+                            if self.resource_dims else None)
+        limited = self.top is not None or self.min_cost > 0
+        # (values, currency) -> indexes of the cells of all the rollups
+        cells = {}
+        for r in resources:
+            unit = r.get('MonthlyCostUnit')
+            cost = r.get('MonthlyCost', 0.0)
+            if region_resources is not None and unit is not None:
+                resource_values = tuple([region if g is None else g(r)
+                                         for g in resource_getters])
+                if limited:
+                    self.add_resource(region, resource_values, unit, cost)
+                else:
+                    region_resources.append((resource_values, unit, cost))
+            if getter is not None:
+                values = (getter(r),)
+            elif getters:
+                values = tuple([g(r) for g in getters])
+            else:
+                values = ()
+            indexes = cells.get((values, unit))
+            if indexes is None:
+                indexes = cells[(values, unit)] = self.cell_indexes(
+                    region, values, unit)
+            for i in indexes:
+                counts[i] += 1
+                costs[i] += cost
+
+    def region_cells(self, region):
+        cells = self.regions.get(region)
+        if cells is None:
+            cells = self.regions[region] = ({}, [], [])
+            self.resources.setdefault(region, [])
+        return cells
+
+    def add_resource(self, region, values, unit, cost):
+        '''
+        keeps the resource's cost datum if it is (so far) one of the top
+        most expensive of its region, folding the one it displaces (or
+        itself) into OTHER
+        '''
+        if cost < self.min_cost:
+            return self.add_other(region, values, unit, cost)
+        if self.top is None:
+            return self.resources[region].append((values, unit, cost))
+        self.seq += 1
+        # on equal costs, the first resources are kept
+        item = (cost, -self.seq, region, values, unit)
+        heap = self.heaps.setdefault(region, [])
+        if len(heap) < self.top:
+            heapq.heappush(heap, item)
+            return
+        if heap and heap[0] < item:
+            item = heapq.heapreplace(heap, item)
+        cost, _, region, values, unit = item
+        self.add_other(region, values, unit, cost)
+
+    def add_other(self, region, values, unit, cost, others=None):
+        key = (values[:-1] + (OTHER,), unit)
+        others = (self.others if others is None else others).setdefault(
+            region, {})
+        others[key] = others.get(key, 0.0) + cost
+
+    def resource_costs(self):
+        '''
+        region -> the (values, currency, cost) of the per-resource datums:
+        the resources kept, in the order added, then the OTHER ones
+        '''
+        if not self.heaps and not self.others:
+            return self.resources
+        # the top ones across the regions - on equal costs, those of the
+        # first region by name, then the first ones added
+        ranked = sorted((item for heap in self.heaps.values()
+                         for item in heap),
+                        key=lambda item: (-item[0], item[2], -item[1]))
+        kept = {}
+        for cost, _, region, values, unit in sorted(ranked[:self.top],
+                                                    key=lambda i: -i[1]):
+            kept.setdefault(region, []).append((values, unit, cost))
+        # the regions' top resources that aren't the top ones overall are
+        # folded into OTHER too, the most expensive first
+        others = {region: dict(others)
+                  for region, others in self.others.items()}
+        for cost, _, region, values, unit in ranked[self.top:]:
+            self.add_other(region, values, unit, cost, others)
+        return {region: rs + kept.get(region, []) + [
+                    (values, unit, cost) for (values, unit), cost in
+                    others.get(region, {}).items()]
+                for region, rs in self.resources.items()}
+
+    def state(self):
+        '''
+        what the cube has added up, as JSON-able data: {region: its cells,
+        resources, top resources and OTHER series}
+        '''
+        return {region: {
+            'cells': [[ri, values, unit, counts[i], costs[i]]
+                      for ((ri, values), unit), i in cells.items()],
+            'resources': self.resources[region],
+            # in the order added
+            'heap': [[cost, values, unit] for cost, _, _, values, unit in
+                     sorted(self.heaps.get(region, ()),
+                            key=lambda item: -item[1])],
+            'others': [[values, unit, cost] for (values, unit), cost in
+                       self.others.get(region, {}).items()],
+        } for region, (cells, counts, costs) in self.regions.items()}
+
+    def merge(self, state):
+        '''
+        adds the state() of a cube with the same settings, region by region
+        in the order of the state - returns self
+        '''
+        for region, s in state.items():
+            _, counts, costs = self.region_cells(region)
+            for ri, values, unit, count, cost in s['cells']:
+                i = self.cell_index(region, (ri, tuple(values)), unit)
+                if ri not in self.regional:
+                    counts[i] += count
+                    costs[i] += cost
+            self.resources[region].extend(
+                (tuple(values), unit, cost)
+                for values, unit, cost in s['resources'])
+            for cost, values, unit in s['heap']:
+                self.add_resource(region, tuple(values), unit, cost)
+            if s['others']:
+                others = self.others.setdefault(region, {})
+                for values, unit, cost in s['others']:
+                    key = (tuple(values), unit)
+                    others[key] = others.get(key, 0.0) + cost
+        return self
+
+    def cell_indexes(self, region, values, unit):
+        '''
+        the indexes of the cells of every rollup that a resource with the
+        given (non-region) values and currency adds to
+        '''
+        values = iter(values)
+        values = [region if dim == 'RZCode' else next(values)
+                  for dim in self.dims]
+        indexes = []
+        for ri, rollup in enumerate(self.rollups):
+            key = (ri, tuple(values[i] for i in rollup))
+            if None in key[1]:
+                continue
+            i = self.cell_index(region, key, unit)
+            if ri not in self.regional:
+                indexes.append(i)
+        return indexes
+
+    def cell_index(self, region, key, unit):
+        cells, counts, costs = self.regions[region]
+        i = cells.get((key, unit))
+        if i is None:
+            ri, values = key
+            if ri in self.regional:
+                base, pos = self.regional[ri]
+                i = self.cell_index(
+                    region, (base, values[:pos] + values[pos + 1:]), unit)
+            else:
+                i = len(counts)
+                counts.append(0)
+                costs.append(0.0)
+            cells[(key, unit)] = i
+        return i
+
+    def totals(self):
+        '''
+        (rollup index, values) -> (count, {currency: cost}), with the totals
+        always in - in the order the regions and their cells were first
+        added, and summed over the regions in the order of their names
+        '''
+        totals = {(0, ()): [0, {}]}
+        for cells, _, _ in self.regions.values():
+            for key, unit in cells:
+                total = totals.get(key)
+                if total is None:
+                    total = totals[key] = [0, {}]
+                if unit is not None:
+                    total[1].setdefault(unit, 0.0)
+        for region in sorted(self.regions):
+            cells, counts, costs = self.regions[region]
+            for (key, unit), i in cells.items():
+                total = totals[key]
+                total[0] += counts[i]
+                if unit is not None:
+                    total[1][unit] += costs[i]
+        return {key: (count, unit_costs)
+                for key, (count, unit_costs) in totals.items()}
+
+    def rollup(self, *dims):
+        '''
+        {values: (count, {currency: cost})} of the rollup by dims
+        '''
+        ri = self.rollups.index(tuple(self.dims.index(d) for d in dims))
+        return {values: total
+                for (i, values), total in self.totals().items() if i == ri}
+
+    def summary(self):
+        '''
+        {currency: {'cost', 'count', 'rzs'}} over the regions (requires
+        RZCode in dims)
+        '''
+        summary = {}
+        for (rz,), (count, costs) in self.rollup('RZCode').items():
+            for unit, cost in costs.items():
+                if not summary.get(unit):
+                    summary[unit] = {'cost': 0.0, 'count': 0, 'rzs': []}
+                summary[unit]['cost'] += cost
+                summary[unit]['count'] += count
+                summary[unit]['rzs'].append(rz)
+        return summary
+
+    def metric_data(self, count_metric, cost_metric, timestamp):
+        '''
+        the count and cost datums of all the rollups: for each region, the
+        per-resource datums and then the regional rollups, from the coarsest
+        to the finest; then the cross-regional rollups, from the finest to
+        the totals
+        '''
+        rz = self.dims.index('RZCode') if 'RZCode' in self.dims else None
+        regional = [ri for ri, rollup in enumerate(self.rollups)
+                    if rz in rollup]
+        cross_regional = sorted(
+            (ri for ri, rollup in enumerate(self.rollups)
+             if rz not in rollup),
+            key=lambda ri: -len(self.rollups[ri]))
+
+        totals = self.totals()
+        # region -> rollup index -> [values], in the order first seen
+        by_region = {}
+        for ri, values in totals:
+            if ri in regional:
+                pos = self.rollups[ri].index(rz)
+                (by_region.setdefault(values[pos], {})
+                 .setdefault(ri, []).append(values))
+
+        metric_data = []
+
+        def add(ri, values):
+            count, unit_costs = totals[(ri, values)]
+            dims = [{'Name': self.dims[i], 'Value': value}
+                    for i, value in zip(self.rollups[ri], values)]
+            metric_data.append({
+                'MetricName': count_metric,
+                'Dimensions': dims,
+                'Timestamp': timestamp,
+                'Unit': 'None',
+                'Value': count
+            })
+            for unit, cost in unit_costs.items():
+                metric_data.append({
+                    'MetricName': cost_metric,
+                    'Dimensions': [{'Name': 'Currency', 'Value': unit}] + dims,
+                    'Timestamp': timestamp,
+                    'Unit': 'None',
+                    'Value': cost
+                })
+
+        for region, rs in self.resource_costs().items():
+            for values, unit, cost in rs:
+                metric_data.append({
+                    'MetricName': cost_metric,
+                    'Dimensions': [{'Name': 'Currency', 'Value': unit}] + [
+                        {'Name': dim, 'Value': value}
+                        for dim, value in zip(self.resource_dims, values)
+                        if value is not None],
+                    'Timestamp': timestamp,
+                    'Unit': 'None',
+                    'Value': cost
+                })
+            for ri in regional:
+                for values in by_region.get(region, {}).get(ri, ()):
+                    add(ri, values)
+        for ri in cross_regional:
+            for (i, values) in totals:
+                if i == ri:
+                    add(ri, values)
+        return metric_data
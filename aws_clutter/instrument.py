@@ -0,0 +1,283 @@
+'''
+Per-call instrumentation of the AWS API calls, hooked into the botocore
+events of the clients (see aws_clutter.clients), and stage timings - for
+`--profile` and the self-metrics. The handlers do nothing until recording
+is enabled:
+
+    recorder = instrument.enable()
+    with instrument.Stage('scan'):
+        ...
+    recorder.report()
+'''
+import sys
+import time
+import bisect
+import datetime
+import threading
+import contextlib
+from aws_clutter.tools import THROTTLING_ERRORS
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                   float('inf')]
+# request members of the continuation token of the paginated operations
+PAGE_TOKENS = ('NextToken', 'Marker')
+# the stages reported, in order
+STAGES = ['discover', 'scan', 'enrich', 'aggregate', 'publish']
+
+
+class CallStats:
+    '''
+    stats of the calls of one (service, operation, region)
+    '''
+    __slots__ = ('calls', 'errors', 'retries', 'throttles', 'pages',
+                 'bytes', 'seconds', 'max_seconds', 'buckets')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.throttles = 0
+        self.pages = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def percentile(self, p):
+        '''
+        upper bound of the latency bucket of the p-th percentile
+        '''
+        rank = p / 100 * self.calls
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max_seconds)
+        return self.max_seconds
+
+
+class Recorder:
+    '''
+    thread-safe record of the API calls, by (service, operation, region),
+    and of the cumulative time spent in each stage
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.stages = {}
+
+    def stats(self, service, operation, region):
+        key = (service, operation, region)
+        stats = self.calls.get(key)
+        if stats is None:
+            stats = self.calls.setdefault(key, CallStats())
+        return stats
+
+    def call_done(self, model, context, http_response=None, parsed=None):
+        seconds = time.perf_counter() - context.get('ck_start',
+                                                    time.perf_counter())
+        meta = (parsed or {}).get('ResponseMetadata', {})
+        size = response_size(http_response)
+        with self.lock:
+            stats = self.stats(model.service_model.service_name, model.name,
+                               context.get('client_region'))
+            stats.calls += 1
+            stats.errors += int(http_response is None or
+                                http_response.status_code >= 300)
+            stats.retries += meta.get('RetryAttempts', 0)
+            stats.pages += int(context.get('ck_page', False))
+            stats.bytes += size
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            stats.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def throttled(self, model, region):
+        with self.lock:
+            self.stats(model.service_model.service_name, model.name,
+                       region).throttles += 1
+
+    def stage_done(self, name, seconds):
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def report(self, file=None):
+        file = file or sys.stderr
+        with self.lock:
+            stages = dict(self.stages)
+            calls = sorted(self.calls.items(), key=lambda c: -c[1].seconds)
+        for name in ([s for s in STAGES if s in stages] +
+                     sorted(s for s in stages if s not in STAGES)):
+            print(f"[profile] {name}: {stages[name]:.2f}s", file=file)
+        for (service, operation, region), stats in calls:
+            print(f"[profile] {service}.{operation} {region or '-'}: "
+                  f"{stats.calls} calls ({stats.pages} pages) in "
+                  f"{stats.seconds:.2f}s - p50 {stats.percentile(50):.3f}s, "
+                  f"p99 {stats.percentile(99):.3f}s, max "
+                  f"{stats.max_seconds:.3f}s; {stats.retries} retries, "
+                  f"{stats.throttles} throttled, {stats.errors} errors, "
+                  f"{stats.bytes / 1024:.1f} KiB", file=file)
+
+    def metric_data(self, timestamp=None):
+        '''
+        the self-metrics: per (Service, Operation) call stats, summed over
+        the regions, and per Stage seconds
+        '''
+        timestamp = timestamp or datetime.datetime.utcnow()
+        with self.lock:
+            totals = {}
+            for (service, operation, _), stats in self.calls.items():
+                total = totals.setdefault((service, operation),
+                                          [0, 0.0, 0, 0, 0, 0])
+                for i, value in enumerate([stats.calls, stats.seconds,
+                                           stats.retries, stats.throttles,
+                                           stats.pages, stats.bytes]):
+                    total[i] += value
+            stages = dict(self.stages)
+        metric_data = []
+        for (service, operation), total in totals.items():
+            dims = [{'Name': 'Service', 'Value': service},
+                    {'Name': 'Operation', 'Value': operation}]
+            for (name, unit), value in zip([
+                    ('ApiCalls', 'Count'), ('ApiCallSeconds', 'Seconds'),
+                    ('ApiRetries', 'Count'), ('ApiThrottles', 'Count'),
+                    ('ApiPages', 'Count'), ('ApiResponseBytes', 'Bytes')],
+                    total):
+                metric_data.append({
+                    'MetricName': name,
+                    'Dimensions': dims,
+                    'Timestamp': timestamp,
+                    'Unit': unit,
+                    'Value': value
+                })
+        for name, seconds in stages.items():
+            metric_data.append({
+                'MetricName': 'StageSeconds',
+                'Dimensions': [{'Name': 'Stage', 'Value': name}],
+                'Timestamp': timestamp,
+                'Unit': 'Seconds',
+                'Value': seconds
+            })
+        return metric_data
+
+
+def response_size(http_response):
+    '''
+    bytes of the response body, without reading streamed bodies
+    '''
+    if http_response is None:
+        return 0
+    content = getattr(http_response, '_content', None)
+    if isinstance(content, bytes):
+        return len(content)
+    return int(http_response.headers.get('Content-Length') or 0)
+
+
+_recorder = None
+
+
+def recorder():
+    '''
+    the active Recorder, or None when not enabled
+    '''
+    return _recorder
+
+
+def enable():
+    '''
+    starts recording (in a new Recorder) - returns the Recorder
+    '''
+    global _recorder
+    _recorder = Recorder()
+    return _recorder
+
+
+def disable():
+    global _recorder
+    _recorder = None
+
+
+@contextlib.contextmanager
+def recording(enabled=True, report=False, file=None):
+    '''
+    records while in the context (if enabled), yielding the Recorder (or
+    None) - and with report, prints its report on the way out
+    '''
+    if not enabled:
+        yield None
+        return
+    r = enable()
+    try:
+        yield r
+    finally:
+        disable()
+        if report:
+            r.report(file)
+
+
+#
+# botocore event handlers, recording into the active Recorder
+#
+def before_call(model, params, context, **kwargs):
+    if _recorder is not None:
+        context['ck_start'] = time.perf_counter()
+        # (after-call-error doesn't get the model)
+        context['ck_model'] = model
+        # a page of a paginated operation
+        context['ck_page'] = any(
+            member in model.input_shape.members for member in PAGE_TOKENS
+        ) if model.input_shape is not None else False
+
+
+def after_call(model, context, http_response, parsed, **kwargs):
+    if _recorder is not None and 'ck_start' in context:
+        _recorder.call_done(model, context, http_response, parsed)
+
+
+def after_call_error(context, **kwargs):
+    if _recorder is not None and 'ck_start' in context:
+        _recorder.call_done(context['ck_model'], context)
+
+
+def needs_retry(operation, request_dict, response=None, **kwargs):
+    if _recorder is not None and response is not None:
+        code = response[1].get('Error', {}).get('Code')
+        if code in THROTTLING_ERRORS:
+            _recorder.throttled(operation, request_dict['context'].get(
+                'client_region'))
+
+
+HANDLERS = [
+    ('before-call', before_call),
+    ('after-call', after_call),
+    ('after-call-error', after_call_error),
+    ('needs-retry', needs_retry),
+]
+
+
+def attach(events):
+    '''
+    registers the handlers with a (botocore or aiobotocore) client's or
+    session's events - registering them again is a no-op
+    '''
+    for event, handler in HANDLERS:
+        events.register(event, handler, unique_id=f'ck-instrument-{event}')
+
+
+class Stage:
+    '''
+    context manager adding the time spent in it to the stage of the active
+    Recorder (a no-op when not recording)
+    '''
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if _recorder is not None:
+            _recorder.stage_done(self.name, time.perf_counter() - self.start)
@@ -0,0 +1,103 @@
+import json
+import functools
+import collections
+from importlib_resources import files
+
+# EBS price components of one (region, volume type), per month, in currency
+EBSPrices = collections.namedtuple('EBSPrices', [
+    'currency', 'gb', 'iops', 'gibps', 'tier1_iops', 'tier2_iops',
+    'tier3_iops'
+])
+EBS_COMPONENTS = {
+    'gb': 'pricePerGBMonth',
+    'iops': 'pricePerIOPSMonth',
+    'gibps': 'pricePerGiBpsMonth',
+    'tier1_iops': 'pricePerTier1IOPSMonth',
+    'tier2_iops': 'pricePerTier2IOPSMonth',
+    'tier3_iops': 'pricePerTier3IOPSMonth',
+}
+# hourly price of one (region, LB type, location type)
+ELBPrices = collections.namedtuple('ELBPrices', ['currency', 'hourly'])
+# snapshot storage price of one (region, storage tier), per GB-month
+SnapshotPrices = collections.namedtuple('SnapshotPrices', ['currency', 'gb'])
+
+
+def load(name):
+    return json.loads(files('aws_clutter.data').joinpath(name).read_text())
+
+
+# The tables below are loaded on first use and kept for the life of the
+# process (i.e., across warm Lambda invocations).
+@functools.lru_cache(maxsize=None)
+def ebs_price_map():
+    '''
+    region -> volume type -> pricing, as published in ebs_pricing.json
+    '''
+    return {price['rzCode']: price['ebs_prices']
+            for price in load('ebs_pricing.json')}
+
+
+@functools.lru_cache(maxsize=None)
+def elb_price_map():
+    '''
+    region -> LB type -> location type -> usage type -> pricing, as
+    published in elb_pricing.json
+    '''
+    return load('elb_pricing.json')
+
+
+@functools.lru_cache(maxsize=None)
+def snapshot_price_map():
+    '''
+    region -> storage tier -> pricing, as published in snapshot_pricing.json
+    '''
+    return {price['rzCode']: price['snapshot_prices']
+            for price in load('snapshot_pricing.json')}
+
+
+@functools.lru_cache(maxsize=None)
+def ebs_table():
+    '''
+    region -> volume type -> EBSPrices, with the prices converted to floats
+    (0.0 for the components that don't apply to the volume type)
+    '''
+    table = {}
+    for region, vol_types in ebs_price_map().items():
+        for vol_type, pricing in vol_types.items():
+            currency = next(iter(pricing['pricePerGBMonth']))
+            table.setdefault(region, {})[vol_type] = EBSPrices(
+                currency,
+                **{component: float(pricing.get(key, {}).get(currency, 0))
+                   for component, key in EBS_COMPONENTS.items()})
+    return table
+
+
+@functools.lru_cache(maxsize=None)
+def elb_table():
+    '''
+    region -> LB type -> location type -> ELBPrices
+    '''
+    table = {}
+    for region, lb_types in elb_price_map().items():
+        for lb_type, locations in lb_types.items():
+            for location_type, usage in locations.items():
+                pricing = usage['LoadBalancerUsage']['pricePerUnit']
+                currency = next(iter(pricing))
+                (table.setdefault(region, {}).setdefault(lb_type, {})
+                 [location_type]) = ELBPrices(currency,
+                                              float(pricing[currency]))
+    return table
+
+
+@functools.lru_cache(maxsize=None)
+def snapshot_table():
+    '''
+    region -> storage tier -> SnapshotPrices
+    '''
+    table = {}
+    for region, tiers in snapshot_price_map().items():
+        for tier, pricing in tiers.items():
+            currency = next(iter(pricing['pricePerGBMonth']))
+            table.setdefault(region, {})[tier] = SnapshotPrices(
+                currency, float(pricing['pricePerGBMonth'][currency]))
+    return table
@@ -0,0 +1,172 @@
+import os
+import sys
+import datetime
+import concurrent.futures
+from aws_clutter.tools import dumps
+
+# PutMetricData limits: datums per request and request payload size
+MAX_DATUMS = 1000
+MAX_PAYLOAD_BYTES = 1000 * 1000
+# values per datum when compacted into Values/Counts arrays
+MAX_VALUES = 150
+# estimated request encoding overhead per datum (field names, member indexes)
+DATUM_OVERHEAD = 300
+# Embedded Metric Format limits: metrics per log event and values per metric
+EMF_MAX_METRICS = 100
+EMF_MAX_VALUES = 100
+PUBLISH_CONCURRENCY = int(os.getenv('CK_PUBLISH_CONCURRENCY', default='4'))
+
+
+def put_metric_data(client, namespace, metric_data, compact=False,
+                    concurrency=None):
+    '''
+    pushes metric_data to CloudWatch in as few PutMetricData calls as the
+    API limits allow, sending the batches concurrently. A failed batch is
+    retried on its own by the client (see clients.RETRY_MODE); if it still
+    fails, the error is raised once all the other batches have been sent.
+    '''
+    if compact:
+        metric_data = compact_metric_data(metric_data)
+
+    def send(batch):
+        client.put_metric_data(Namespace=namespace, MetricData=batch)
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=concurrency or PUBLISH_CONCURRENCY) as executor:
+        futures = [executor.submit(send, batch)
+                   for batch in batches(metric_data)]
+    errors = [f.exception() for f in futures if f.exception() is not None]
+    if errors:
+        raise errors[0]
+
+
+def batches(metric_data, max_datums=MAX_DATUMS,
+            max_payload_bytes=MAX_PAYLOAD_BYTES):
+    '''
+    splits metric_data into lists that fit in one PutMetricData call
+    '''
+    batch = []
+    size = 0
+    for datum in metric_data:
+        datum_size = estimate_size(datum)
+        if batch and (len(batch) == max_datums or
+                      size + datum_size > max_payload_bytes):
+            yield batch
+            batch = []
+            size = 0
+        batch.append(datum)
+        size += datum_size
+    if batch:
+        yield batch
+
+
+def estimate_size(datum):
+    return len(dumps(datum)) + DATUM_OVERHEAD
+
+
+def compact_metric_data(metric_data):
+    '''
+    merges the datums of the same metric, dimensions, unit and timestamp into
+    datums with Values/Counts arrays
+    '''
+    merged = {}
+    for datum in metric_data:
+        key = (datum['MetricName'],
+               tuple((d['Name'], d['Value']) for d in datum['Dimensions']),
+               datum['Unit'], datum['Timestamp'])
+        merged.setdefault(key, []).append(datum)
+
+    compacted = []
+    for datums in merged.values():
+        if len(datums) == 1:
+            compacted.append(datums[0])
+            continue
+        counts = {}
+        for datum in datums:
+            counts[datum['Value']] = counts.get(datum['Value'], 0) + 1
+        values = [*counts.items()]
+        for i in range(0, len(values), MAX_VALUES):
+            chunk = values[i:i+MAX_VALUES]
+            compacted.append({
+                'MetricName': datums[0]['MetricName'],
+                'Dimensions': datums[0]['Dimensions'],
+                'Timestamp': datums[0]['Timestamp'],
+                'Unit': datums[0]['Unit'],
+                'Values': [value for value, _ in chunk],
+                'Counts': [float(count) for _, count in chunk]
+            })
+    return compacted
+
+
+def emf_events(namespace, metric_data):
+    '''
+    metric_data as CloudWatch Embedded Metric Format log events: the datums
+    with the same dimensions and timestamp share events (of up to
+    EMF_MAX_METRICS metrics), and the values of a metric in one event are
+    an array (of up to EMF_MAX_VALUES values)
+    '''
+    groups = {}
+    for datum in metric_data:
+        key = (datum['Timestamp'],
+               tuple((d['Name'], d['Value']) for d in datum['Dimensions']))
+        unit, values = groups.setdefault(key, {}).setdefault(
+            datum['MetricName'], (datum['Unit'], []))
+        if 'Values' in datum:
+            for value, count in zip(datum['Values'], datum['Counts']):
+                values.extend([value] * int(count))
+        else:
+            values.append(datum['Value'])
+
+    for (timestamp, dims), metrics in groups.items():
+        most = max(len(values) for _, values in metrics.values())
+        # the values that don't fit go to the next events
+        for start in range(0, most, EMF_MAX_VALUES):
+            chunks = [(name, unit, values[start:start+EMF_MAX_VALUES])
+                      for name, (unit, values) in metrics.items()
+                      if len(values) > start]
+            for i in range(0, len(chunks), EMF_MAX_METRICS):
+                yield emf_event(namespace, timestamp, dims,
+                                chunks[i:i+EMF_MAX_METRICS])
+
+
+def emf_event(namespace, timestamp, dims, chunks):
+    '''
+    one EMF log event - chunks are the (metric name, unit, values) of
+    distinct metrics
+    '''
+    event = {
+        '_aws': {
+            'Timestamp': epoch_millis(timestamp),
+            'CloudWatchMetrics': [{
+                'Namespace': namespace,
+                'Dimensions': [[name for name, _ in dims]],
+                'Metrics': [{'Name': name, 'Unit': unit}
+                            for name, unit, _ in chunks]
+            }]
+        }
+    }
+    event.update(dims)
+    for name, _, values in chunks:
+        event[name] = values[0] if len(values) == 1 else values
+    return event
+
+
+def epoch_millis(timestamp):
+    '''
+    milliseconds since the epoch of a datetime, naive ones being in UTC
+    '''
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return int(timestamp.timestamp() * 1000)
+
+
+def write_emf(namespace, metric_data, file=None):
+    '''
+    writes metric_data as EMF log events, one JSON per line, to file
+    (stdout by default) - in Lambda, CloudWatch Logs extracts the metrics
+    asynchronously, without any PutMetricData call
+    '''
+    file = file or sys.stdout
+    for event in emf_events(namespace, metric_data):
+        print(dumps(event), file=file)
+    file.flush()
@@ -0,0 +1,591 @@
+'''
+Programmatic entry points behind the `awsclutter` commands - e.g., for the
+Lambda handler, which calls watch() without going through click:
+
+    from aws_clutter import run
+    run.watch()
+
+The heavy dependencies (boto3, numpy, the clutter type modules and the
+pricing tables) are only loaded once a run needs them, to keep the Lambda
+cold start short.
+'''
+import os
+import sys
+import time
+import asyncio
+import datetime
+import functools
+import concurrent.futures
+import aws_clutter.clutter as clutter
+import aws_clutter.accounts as accounts
+import aws_clutter.tools as tools
+import aws_clutter.clients as clients
+import aws_clutter.publish as publish
+import aws_clutter.state as state
+import aws_clutter.cube as cube
+import aws_clutter.instrument as instrument
+from aws_clutter.scheduler import Scheduler
+
+NAMESPACE = os.getenv('CK_NAMESPACE', default='CloudKeep')
+CLUTTER_TYPES = [*clutter.CLUTTER_TYPES]
+# the clutter types scanned when none are given - "snaps" lists every
+# snapshot and AMI of the regions, so it is only scanned when asked for
+DEFAULT_CLUTTER_TYPES = os.getenv('CK_CLUTTER_TYPES',
+                                  default='debs,ulbs').split(',')
+# `awsclutter list` output formats
+FORMATS = ['json', 'ndjson']
+COMPACT_METRICS = os.getenv('CK_COMPACT_METRICS', default='').lower() in (
+    '1', 'true', 'yes', 'y', 'on')
+STATE_URL = os.getenv('CK_STATE')
+# where `awsclutter watch` puts the metrics: PutMetricData calls, or
+# Embedded Metric Format log lines on stdout
+SINKS = ['cloudwatch', 'emf']
+SINK = os.getenv('CK_SINK', default='cloudwatch')
+# push the API call and stage stats of the runs as metrics too
+SELF_METRICS = os.getenv('CK_SELF_METRICS', default='').lower() in (
+    '1', 'true', 'yes', 'y', 'on')
+# seconds of a run's deadline kept for aggregating and publishing: the scans
+# are stopped that long before it
+DEADLINE_MARGIN = float(os.getenv('CK_DEADLINE_MARGIN', default='15'))
+# worker processes for multi-account scans
+ACCOUNT_WORKERS = int(os.getenv('CK_ACCOUNT_WORKERS', default='0'))
+# shards of `awsclutter watch` (0 for none), run by worker processes or by
+# invocations of the Lambda function CK_SHARD_FUNCTION (see app.handler)
+SHARDS = int(os.getenv('CK_SHARDS', default='0'))
+SHARD_FUNCTION = os.getenv('CK_SHARD_FUNCTION')
+
+
+def check_clutter_type(clutter_type):
+    '''
+    returns the clutter types to scan (DEFAULT_CLUTTER_TYPES if none are
+    given) - raises ValueError for an unknown clutter type
+    '''
+    if len(clutter_type) == 0:
+        clutter_type = DEFAULT_CLUTTER_TYPES
+    for ct in clutter_type:
+        if ct not in CLUTTER_TYPES:
+            raise ValueError(f"Unknown clutter type {ct}")
+    return clutter_type
+
+
+async def scan(clutter_type, backend=None, timing=False, skip_regions=None,
+               on_region=None, compact_records=False, regions=None,
+               deadline=None, region_order=None, timings=None):
+    '''
+    scans all the given clutter types concurrently with one scheduler -
+    returns {clutter_type: {region: [resources]}}. The regions in
+    skip_regions[clutter_type] are not scanned (and reported empty).
+    on_region(clutter_type, region, resources) is called as each region
+    completes. With compact_records, the resources only keep what the
+    summaries and metrics need. The regions are discovered unless given.
+
+    The regions are scanned in the order of region_order[clutter_type] (if
+    any), and the ones not done by deadline (a time.monotonic()) are left
+    out of the results. timings, if given, gets the Scheduler timings,
+    with these unfinished regions.
+    '''
+    results = {ct: {} for ct in clutter_type}
+    async with Scheduler(backend=backend, regions=regions) as scheduler:
+        scheduler.skip_regions = skip_regions or {}
+        scheduler.region_order = region_order or {}
+        scheduler.deadline = deadline
+        scheduler.on_region = on_region
+        scheduler.compact_records = compact_records
+        with instrument.Stage('scan'):
+            await asyncio.gather(*[
+                clutter.get(ct).query(results[ct], scheduler)
+                for ct in clutter_type
+            ])
+    if timing:
+        scheduler.report_timings()
+    if timings is not None:
+        timings.update(scheduler.timings)
+    return results
+
+
+def scan_account(role_arn, clutter_type, backend=None, timing=False,
+                 skip_regions=None, compact_records=False):
+    '''
+    scan() of the account of role_arn, with the role assumed - returns
+    (resources, timings), timings being the Scheduler timings (with the
+    errors of the failed regions)
+    '''
+    timings = {}
+    with clients.assumed_role(role_arn):
+        resources = asyncio.run(scan(clutter_type, backend, timing,
+                                     skip_regions,
+                                     compact_records=compact_records,
+                                     timings=timings))
+    return resources, timings
+
+
+def scan_accounts(role_arns, clutter_type, backend=None, timing=False,
+                  skip_regions=None, workers=None, on_account=None,
+                  compact_records=False, timings=None):
+    '''
+    scans the accounts of role_arns in parallel on a pool of worker processes
+    (or one after the other in this process with workers=1), each scanning
+    its regions with the given backend - returns
+    {account: {clutter_type: {region: [resources]}}}. on_account(account,
+    resources) is called as each account completes. timings, if given, gets
+    the {account: Scheduler timings}.
+    '''
+    workers = min(workers or ACCOUNT_WORKERS or os.cpu_count() or 1,
+                  len(role_arns))
+    results = {}
+    account_timings = {}
+
+    def done(role_arn, result):
+        account = accounts.account_id(role_arn)
+        resources, account_timings[account] = result
+        if on_account is not None:
+            on_account(account, resources)
+        results[account] = resources
+
+    if workers <= 1:
+        for role_arn in role_arns:
+            done(role_arn, scan_account(role_arn, clutter_type, backend,
+                                        timing, skip_regions,
+                                        compact_records))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers) as executor:
+            futures = {
+                executor.submit(scan_account, role_arn, clutter_type,
+                                backend, timing, skip_regions,
+                                compact_records): role_arn
+                for role_arn in role_arns
+            }
+            for future in concurrent.futures.as_completed(futures):
+                done(futures[future], future.result())
+    # in the order of role_arns
+    if timings is not None:
+        timings.update((account, account_timings[account])
+                       for account in map(accounts.account_id, role_arns))
+    return {account: results[account]
+            for account in map(accounts.account_id, role_arns)}
+
+
+async def get_metric_data(clutter_type, metric_data, backend=None,
+                          timing=False, incremental=None, events=None,
+                          role_arns=None, workers=None, regions=None,
+                          deadline=None, shards=None, shard_function=None):
+    '''
+    With incremental, the resources added/removed since the last run are
+    appended to events, and per-resource metrics are only kept for the
+    added resources (the aggregates are always refreshed). The regions are
+    then scanned in the order of their last scans' times and clutter, and
+    the regions left unfinished are scanned first in the next run.
+
+    With a deadline (a time.monotonic()), the regions not scanned by then
+    are left out, and a ScanComplete metric per clutter type tells whether
+    the metrics are complete (1) or partial (0); a Partial event lists the
+    regions left out.
+
+    A ScanErrors metric per clutter type counts the regions whose scans
+    failed (and are left out), and a ScanErrors event gives their errors.
+    With incremental, they are carried over like the unfinished ones.
+
+    With role_arns, the accounts of the roles are scanned, and the aggregate
+    metrics - ScanErrors included - are produced across all of them as well
+    as per account (with the AccountId dimension). The deadline doesn't
+    apply to them.
+
+    With shards, the work units are scanned and aggregated in that many
+    worker processes (or invocations of the Lambda shard_function, see
+    aws_clutter.shard) and only their cubes are merged here - which doesn't
+    go with incremental or a deadline.
+    '''
+    if shards:
+        if incremental is not None or deadline is not None:
+            raise ValueError("Shards don't support the state or a deadline")
+        import aws_clutter.shard as shard
+        cubes, errors = await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(shard.run_shards, clutter_type, shards,
+                                    role_arns, backend, regions,
+                                    shard_function))
+        for ct in clutter_type:
+            module = clutter.get(ct)
+            with instrument.Stage('aggregate'):
+                if role_arns:
+                    metric_data.extend(accounts_metric_data(module, cubes[ct]))
+                    metric_data.extend(accounts_scan_errors(ct, errors[ct],
+                                                            events))
+                else:
+                    metric_data.extend(cubes[ct][''].metric_data(
+                        *module.METRICS, datetime.datetime.utcnow()))
+                    metric_data.extend(scan_errors(ct, errors[ct][''],
+                                                   events))
+        return metric_data
+
+    skipped = ({ct: incremental.regions_to_skip(ct) for ct in clutter_type}
+               if incremental is not None else {})
+    region_order = ({ct: incremental.region_order(ct) for ct in clutter_type}
+                    if incremental is not None else {})
+    timings = {}
+    account_resources = {}
+    account_timings = {}
+    if role_arns:
+        account_resources = await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(scan_accounts, role_arns, clutter_type,
+                                    backend, timing, skipped, workers,
+                                    compact_records=True,
+                                    timings=account_timings))
+        resources = accounts.merge(account_resources)
+    else:
+        resources = await scan(clutter_type, backend, timing, skipped,
+                               compact_records=True, regions=regions,
+                               deadline=deadline, region_order=region_order,
+                               timings=timings)
+    for ct in clutter_type:
+        module = clutter.get(ct)
+        ct_timing = timings.get(ct, {})
+        unfinished = ct_timing.get('unfinished', [])
+        errors = ct_timing.get('errors', {})
+        account_errors = {account: at.get(ct, {}).get('errors', {})
+                          for account, at in account_timings.items()}
+        # the regions failed in any account are carried over
+        failed = sorted({*errors, *(region for e in account_errors.values()
+                                    for region in e)})
+        with instrument.Stage('aggregate'):
+            # the regions in the order of their names, as merged by shards
+            if account_resources:
+                ct_metric_data = accounts_metric_data(module, {
+                    account: module.new_cube().add_all(
+                        dict(sorted(ar[ct].items())))
+                    for account, ar in account_resources.items()
+                })
+            else:
+                ct_metric_data = module.aggregate(
+                    dict(sorted(resources.get(ct, {}).items())))
+        if incremental is not None:
+            ct_events = incremental.update(ct, resources.get(ct, {}),
+                                           module.RESOURCE_ID, skipped[ct],
+                                           [*unfinished, *failed],
+                                           ct_timing.get('regions'))
+            if events is not None:
+                events.extend(ct_events)
+            # the per-resource datums of the new resources only, with the
+            # OTHER ones of the resources outside the top ones
+            added = incremental.added[ct] | {cube.OTHER}
+            ct_metric_data = [
+                d for d in ct_metric_data
+                if all(dim['Value'] in added for dim in d['Dimensions']
+                       if dim['Name'] == module.RESOURCE_ID)
+            ]
+        if role_arns:
+            ct_metric_data.extend(accounts_scan_errors(ct, account_errors,
+                                                       events))
+        else:
+            ct_metric_data.extend(scan_errors(ct, errors, events))
+        if deadline is not None and not role_arns:
+            ct_metric_data.append(scan_complete(ct, not unfinished))
+            if unfinished and events is not None:
+                events.append({
+                    'Event': 'Partial',
+                    'ClutterType': ct,
+                    'Regions': unfinished,
+                    'Timestamp': ct_metric_data[-1]['Timestamp']
+                })
+        metric_data.extend(ct_metric_data)
+    return metric_data
+
+
+def accounts_metric_data(module, account_cubes):
+    '''
+    the metrics of the clutter type of module from {account: cube}: the
+    aggregates across all the accounts (their merged cubes), and the
+    metrics of each account, with the AccountId dimension
+    '''
+    timestamp = datetime.datetime.utcnow()
+    merged = module.new_cube()
+    for account_cube in account_cubes.values():
+        merged.merge(account_cube.state())
+    # per-resource metrics only come with their AccountId
+    metric_data = [
+        d for d in merged.metric_data(*module.METRICS, timestamp)
+        if all(dim['Name'] != module.RESOURCE_ID for dim in d['Dimensions'])
+    ]
+    for account, account_cube in account_cubes.items():
+        metric_data.extend(accounts.add_account_dimension(
+            account_cube.metric_data(*module.METRICS, timestamp), account))
+    return metric_data
+
+
+def scan_complete(clutter_type, complete):
+    '''
+    the ScanComplete datum of a clutter type: 1 when all its regions were
+    scanned, 0 when its metrics are partial
+    '''
+    return {
+        'MetricName': 'ScanComplete',
+        'Dimensions': [{'Name': 'ClutterType', 'Value': clutter_type}],
+        'Timestamp': datetime.datetime.utcnow(),
+        'Unit': 'None',
+        'Value': 1.0 if complete else 0.0
+    }
+
+
+def scan_errors(clutter_type, errors, events=None, account=None):
+    '''
+    the ScanErrors datum of a clutter type, from its {region: error} - with
+    events, the errors are appended to them as a ScanErrors event. With
+    account, both are for that account (with its AccountId).
+    '''
+    datum = {
+        'MetricName': 'ScanErrors',
+        'Dimensions': [{'Name': 'ClutterType', 'Value': clutter_type}],
+        'Timestamp': datetime.datetime.utcnow(),
+        'Unit': 'Count',
+        'Value': float(len(errors))
+    }
+    if errors and events is not None:
+        event = {
+            'Event': 'ScanErrors',
+            'ClutterType': clutter_type,
+            'Errors': errors,
+            'Timestamp': datum['Timestamp']
+        }
+        if account is not None:
+            event['AccountId'] = account
+        events.append(event)
+    if account is not None:
+        accounts.add_account_dimension([datum], account)
+    return [datum]
+
+
+def accounts_scan_errors(clutter_type, account_errors, events=None):
+    '''
+    the ScanErrors datums of a clutter type, from its {account: {region:
+    error}}: the failed regions across all the accounts, and the ones of
+    each account (with the AccountId dimension)
+    '''
+    metric_data = scan_errors(clutter_type, {})
+    metric_data[0]['Value'] = float(sum(map(len, account_errors.values())))
+    for account, errors in account_errors.items():
+        metric_data.extend(scan_errors(clutter_type, errors, events,
+                                       account))
+    return metric_data
+
+
+class NDJSONWriter:
+    '''
+    writes each resource as one JSON line as soon as its region is scanned,
+    keeping only per clutter type counts and costs for the trailing summary
+    record
+    '''
+    def __init__(self, clutter_type, file=None):
+        self.file = file or sys.stdout
+        self.summary = {
+            ct: {
+                'Description': clutter.get(ct).DESCRIPTION,
+                'Count': 0,
+                'MonthlyCost': {},
+                'Regions': []
+            } for ct in clutter_type
+        }
+
+    def write(self, record):
+        print(tools.dumps(record), file=self.file, flush=True)
+
+    def region_done(self, clutter_type, region, resources):
+        summary = self.summary[clutter_type]
+        for r in resources:
+            self.write({
+                'ClutterType': clutter_type,
+                'RZCode': region,
+                'Resource': r
+            })
+            unit = r.get('MonthlyCostUnit')
+            if unit is not None:
+                summary['MonthlyCost'][unit] = (
+                    summary['MonthlyCost'].get(unit, 0.0) + r['MonthlyCost'])
+        summary['Count'] += len(resources)
+        if resources:
+            summary['Regions'].append(region)
+
+    def close(self, timings=None, account_timings=None):
+        '''
+        writes the summary record - with the {region: error} of the failed
+        regions of each clutter type when given its scan timings, or their
+        {account: {region: error}} when given the timings of each account
+        '''
+        for ct, summary in self.summary.items():
+            summary['Regions'].sort()
+            if timings is not None:
+                summary['Errors'] = timings.get(ct, {}).get('errors', {})
+            if account_timings is not None:
+                summary['Errors'] = {
+                    account: t.get(ct, {}).get('errors', {})
+                    for account, t in account_timings.items()
+                }
+        self.write({'Summary': self.summary})
+
+
+def stream_clutter(clutter_type, backend=None, timing=False, role_arns=None,
+                   workers=None, file=None):
+    '''
+    `awsclutter list --format ndjson`
+    '''
+    writer = NDJSONWriter(clutter_type, file)
+
+    def region_done(ct, region, resources):
+        writer.region_done(ct, region, resources)
+        # written out, so no need to keep them
+        resources.clear()
+
+    def account_done(account, resources):
+        for ct, regions in accounts.merge({account: resources}).items():
+            for region, rs in regions.items():
+                region_done(ct, region, rs)
+
+    if role_arns:
+        # the regions are scanned in the account worker processes, so the
+        # resources are written as each account completes
+        account_timings = {}
+        scan_accounts(role_arns, clutter_type, backend, timing,
+                      workers=workers, on_account=account_done,
+                      timings=account_timings)
+        writer.close(account_timings=account_timings)
+    else:
+        timings = {}
+        asyncio.run(scan(clutter_type, backend, timing,
+                         on_region=region_done, timings=timings))
+        writer.close(timings)
+
+
+def list_clutter(clutter_type=(), summary=False, backend=None, timing=False,
+                 role_arns=None, workers=None, format='json', profile=False):
+    '''
+    `awsclutter list` - with profile, the AWS calls and the stages are
+    reported on stderr. The status of each region ('ok', 'skipped',
+    'failed' or 'unfinished') and the errors of the failed ones are listed
+    too - per account for multiple accounts.
+    '''
+    clutter_type = check_clutter_type(clutter_type)
+    timings = {}
+    account_timings = {}
+    with instrument.recording(profile, report=True):
+        if format == 'ndjson':
+            return stream_clutter(clutter_type, backend, timing, role_arns,
+                                  workers)
+        if role_arns:
+            resources = accounts.merge(scan_accounts(
+                role_arns, clutter_type, backend, timing, workers=workers,
+                compact_records=summary, timings=account_timings))
+            resources = {ct: resources.get(ct, {}) for ct in clutter_type}
+        else:
+            resources = asyncio.run(scan(clutter_type, backend, timing,
+                                         compact_records=summary,
+                                         timings=timings))
+
+    if (summary):
+        for ct in clutter_type:
+            clutter.get(ct).summarize(resources[ct])
+            for region, error in sorted(
+                    timings.get(ct, {}).get('errors', {}).items()):
+                print(f"[{ct}] Could not scan {region}: {error}")
+            for account, at in account_timings.items():
+                for region, error in sorted(
+                        at.get(ct, {}).get('errors', {}).items()):
+                    print(f"[{ct}] Could not scan {region} of {account}: "
+                          f"{error}")
+    else:
+        result = {
+            ct: {
+                'description': clutter.get(ct).DESCRIPTION,
+                'resources': resources[ct]
+            } for ct in clutter_type
+        }
+        for ct, ct_timing in timings.items():
+            result[ct]['regions'] = ct_timing['status']
+            result[ct]['errors'] = ct_timing['errors']
+        if account_timings:
+            for ct in clutter_type:
+                result[ct]['regions'] = {
+                    account: at.get(ct, {}).get('status', {})
+                    for account, at in account_timings.items()}
+                result[ct]['errors'] = {
+                    account: at.get(ct, {}).get('errors', {})
+                    for account, at in account_timings.items()}
+        print(tools.dumps(result, indent=4))
+
+
+def watch(clutter_type=(), dry_run=False, compact=None, state_url=None,
+          backend=None, timing=False, role_arns=None, workers=None,
+          profile=False, self_metrics=None, sink=None, deadline=None,
+          shards=None, shard_function=None):
+    '''
+    `awsclutter watch` - compact, state_url, self_metrics, sink, shards and
+    shard_function default to $CK_COMPACT_METRICS, $CK_STATE,
+    $CK_SELF_METRICS, $CK_SINK, $CK_SHARDS and $CK_SHARD_FUNCTION. With
+    profile, the AWS calls and the stages are reported on stderr; with
+    self_metrics, they are pushed as metrics too. With the 'emf' sink, the
+    metrics are written to stdout in the Embedded Metric Format instead of
+    being pushed.
+
+    With a deadline (in seconds from now, e.g. the remaining time of a
+    Lambda invocation), the scans are stopped DEADLINE_MARGIN seconds
+    before it, and the metrics of what was scanned by then are published.
+
+    With shards, the scans are split into that many shards, aggregated
+    apart and merged (see aws_clutter.shard).
+    '''
+    if deadline is not None:
+        deadline = time.monotonic() + max(0.0, deadline - DEADLINE_MARGIN)
+    clutter_type = check_clutter_type(clutter_type)
+    sink = sink or SINK
+    if sink not in SINKS:
+        raise ValueError(f"Unknown sink {sink}")
+    compact = COMPACT_METRICS if compact is None else compact
+    state_url = state_url or STATE_URL
+    self_metrics = SELF_METRICS if self_metrics is None else self_metrics
+    shards = SHARDS if shards is None else shards
+    shard_function = shard_function or SHARD_FUNCTION
+    metric_data = []
+    events = []
+    incremental = None
+    if state_url:
+        incremental = state.Incremental(state.open_store(state_url))
+    with instrument.recording(profile or self_metrics,
+                              report=profile) as recorder:
+        asyncio.run(get_metric_data(clutter_type, metric_data, backend,
+                                    timing, incremental, events, role_arns,
+                                    workers, deadline=deadline,
+                                    shards=shards,
+                                    shard_function=shard_function))
+
+        # resources added/removed since the last run, as log records
+        for event in events:
+            print(tools.dumps(event), file=sys.stderr)
+
+        if dry_run:
+            if self_metrics:
+                metric_data.extend(recorder.metric_data())
+            print(tools.dumps(metric_data, indent=4))
+
+        elif sink == 'emf':
+            # extracted from the log lines by CloudWatch Logs, with no API
+            # calls
+            with instrument.Stage('publish'):
+                publish.write_emf(NAMESPACE, metric_data)
+            if self_metrics:
+                publish.write_emf(NAMESPACE, recorder.metric_data())
+            if incremental:
+                incremental.save()
+
+        else:
+            # push metrics to CloudWatch
+            cloudwatch = clients.client('cloudwatch')
+            if len(metric_data):
+                with instrument.Stage('publish'):
+                    publish.put_metric_data(cloudwatch, NAMESPACE,
+                                            metric_data, compact=compact)
+            if self_metrics:
+                publish.put_metric_data(cloudwatch, NAMESPACE,
+                                        recorder.metric_data())
+
+            # the next run compares against this one only once it is
+            # published
+            if incremental:
+                incremental.save()
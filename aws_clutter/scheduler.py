@@ -0,0 +1,360 @@
+import os
+import sys
+import time
+import asyncio
+import threading
+import functools
+import contextvars
+import concurrent.futures
+import aws_clutter.clients as clients
+import aws_clutter.instrument as instrument
+from aws_clutter.tools import (DEADLINE, DeadlineExceeded, backoff_delay,
+                               check_deadline, is_transient)
+
+MAX_WORKERS = int(os.getenv('CK_MAX_WORKERS', default='30'))
+# 'threads' runs the boto3 calls on a worker pool, 'async' runs them natively
+# on the event loop with aiobotocore (optional dependency)
+BACKENDS = ['threads', 'async']
+BACKEND = os.getenv('CK_BACKEND', default='threads')
+# attempts at each region scan, and the base of the jittered backoff (in
+# seconds) between them
+REGION_ATTEMPTS = int(os.getenv('CK_REGION_ATTEMPTS', default='2'))
+REGION_BACKOFF = float(os.getenv('CK_REGION_BACKOFF', default='1'))
+# failures in a row (across the clutter types) after which the scans of a
+# region are given up for the run
+BREAKER_FAILURES = int(os.getenv('CK_BREAKER_FAILURES', default='3'))
+
+
+class CircuitOpen(Exception):
+    '''
+    raised by the attempts at scanning a region whose breaker is open
+    '''
+    def __str__(self):
+        return 'circuit open'
+
+
+class CircuitBreaker:
+    '''
+    thread-safe count of the failed scans in a row of each region - once it
+    reaches failures, the region is open: its scans are given up
+    '''
+    def __init__(self, failures=BREAKER_FAILURES):
+        self.failures = failures
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def is_open(self, region):
+        return self.counts.get(region, 0) >= self.failures
+
+    def failed(self, region):
+        with self.lock:
+            self.counts[region] = self.counts.get(region, 0) + 1
+
+    def succeeded(self, region):
+        with self.lock:
+            self.counts[region] = 0
+
+
+class Scheduler:
+    '''
+    Shared scan scheduler - discovers the regions once per run and
+    dispatches (clutter type x region) scans onto a single bounded
+    worker pool. Use it as a context manager so that the pool is shut down:
+
+    with Scheduler() as scheduler:
+        await asyncio.gather(debs.query(dvs, scheduler),
+                             ulbs.query(ulbs, scheduler))
+
+    With the 'async' backend the scans run as coroutines on the event loop
+    instead, and the scheduler must be closed on that loop:
+
+    async with Scheduler(backend='async') as scheduler:
+        ...
+
+    With a deadline, the region scans still running at the deadline are
+    cancelled (the ones on the pool stop at their next result), and
+    reported in the timings as unfinished.
+
+    A region scan failed by throttling or a transient error is retried (up
+    to REGION_ATTEMPTS), and any failed one is then reported in the timings
+    with its error - the scan of the other regions goes on. The failures
+    of a region, across the clutter types, trip its circuit breaker: the
+    attempts made once it is open are given up.
+    '''
+    def __init__(self, max_workers=MAX_WORKERS, regions=None,
+                 backend=None):
+        self.max_workers = max_workers
+        self.backend = backend or BACKEND
+        if self.backend not in BACKENDS:
+            raise ValueError(f"Unknown backend {self.backend}")
+        self._regions = regions
+        self._executor = None
+        self._aio = None
+        # clutter type -> {'total': seconds, 'regions': {region: seconds},
+        # 'unfinished': [regions], 'status': {region: 'ok', 'skipped',
+        # 'failed' or 'unfinished'}, 'errors': {region: error}}
+        self.timings = {}
+        self.breaker = CircuitBreaker()
+        # clutter type -> regions not to scan in this run (reported empty)
+        self.skip_regions = {}
+        # clutter type -> regions in the order to start their scans (the
+        # regions not in it first)
+        self.region_order = {}
+        # time.monotonic() by which the scans must be done, or None
+        self.deadline = None
+        self.expired = False
+        # on_region(clutter type, region, resources) is called on the event
+        # loop as soon as each region scan completes
+        self.on_region = None
+        # keep compact resource records, with just what the metrics need,
+        # rather than the full payloads
+        self.compact_records = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_workers)
+        return self._executor
+
+    @property
+    def aio(self):
+        if self._aio is None:
+            self._aio = clients.AioClients()
+        return self._aio
+
+    def shutdown(self):
+        if self._executor is not None:
+            # past the deadline, the stragglers are not waited for
+            self._executor.shutdown(wait=not self.expired)
+            self._executor = None
+
+    async def aclose(self):
+        if self._aio is not None:
+            await self._aio.aclose()
+            self._aio = None
+        self.shutdown()
+
+    def regions(self):
+        if self._regions is None:
+            self._regions = list_regions()
+        return self._regions
+
+    async def regions_async(self):
+        # concurrent scans share one in-flight discovery
+        if self._regions is None:
+            self._regions = asyncio.ensure_future(
+                list_regions_async(self.aio))
+        if isinstance(self._regions, asyncio.Future):
+            self._regions = await self._regions
+        return self._regions
+
+    async def scan(self, scan_region, results, scan_region_async=None,
+                   name=None):
+        '''
+        run scan_region(results, region) for every region on the pool, or
+        scan_region_async(aio, results, region) on the event loop when the
+        backend is 'async'. The timings are recorded under name.
+        '''
+        start = time.perf_counter()
+        name = name or scan_region.__name__
+        timing = self.timings.setdefault(name, {'total': 0.0, 'regions': {},
+                                                'unfinished': [],
+                                                'status': {}, 'errors': {}})
+        skip = self.skip_regions.get(name, ())
+        if self.backend == 'async' and scan_region_async is not None:
+            regions = await self.regions_async()
+        else:
+            regions = self.regions()
+        for region in skip:
+            if region in regions:
+                results[region] = []
+                timing['status'][region] = 'skipped'
+        regions = [region for region in regions if region not in skip]
+        # the regions that kept failing in this run are given up
+        for region in [r for r in regions if self.breaker.is_open(r)]:
+            regions.remove(region)
+            timing['status'][region] = 'failed'
+            timing['errors'][region] = 'circuit open'
+        order = self.region_order.get(name)
+        if order:
+            rank = {region: i for i, region in enumerate(order)}
+            regions.sort(key=lambda region: rank.get(region, -1))
+        # each region scans into its own dict, copied into results once
+        # it completes - so that a straggler can't add to them afterwards
+        region_results = {region: {} for region in regions}
+        if self.backend == 'async' and scan_region_async is not None:
+            futures = [asyncio.ensure_future(
+                           self._timed_async(timing, region,
+                                             region_results[region],
+                                             scan_region_async, self.aio,
+                                             region_results[region], region))
+                       for region in regions]
+        else:
+            loop = asyncio.get_running_loop()
+            # in a copy of the context of the scan each, e.g. with its role
+            futures = [loop.run_in_executor(self.executor,
+                                            contextvars.copy_context().run,
+                                            self._timed,
+                                            *(timing, region,
+                                              region_results[region],
+                                              scan_region,
+                                              region_results[region], region))
+                       for region in regions]
+        for region, future in zip(regions, futures):
+            future.add_done_callback(functools.partial(
+                self._region_done, timing, name, results,
+                region_results[region], region))
+        if futures:
+            timeout = (None if self.deadline is None else
+                       max(0.0, self.deadline - time.monotonic()))
+            _, pending = await asyncio.wait(futures, timeout=timeout)
+            if pending:
+                self.expired = True
+                for future in pending:
+                    future.cancel()
+                for region, future in zip(regions, futures):
+                    if future in pending:
+                        timing['unfinished'].append(region)
+                        timing['status'][region] = 'unfinished'
+        timing['total'] = time.perf_counter() - start
+
+    def _region_done(self, timing, name, results, region_results, region,
+                     future):
+        if future.cancelled():
+            return
+        e = future.exception()
+        if e is None:
+            timing['status'][region] = 'ok'
+            results[region] = region_results.get(region, [])
+            if self.on_region is not None:
+                self.on_region(name, region, results[region])
+        elif isinstance(e, DeadlineExceeded):
+            self.expired = True
+            timing['unfinished'].append(region)
+            timing['status'][region] = 'unfinished'
+        elif isinstance(e, CircuitOpen):
+            timing['status'][region] = 'failed'
+            timing['errors'][region] = str(e)
+        else:
+            timing['status'][region] = 'failed'
+            timing['errors'][region] = f"{type(e).__name__}: {e}"
+
+    def _check_breaker(self, region):
+        # checked by each attempt, as the scans of the other clutter types
+        # in the region may have failed since this one was dispatched
+        if self.breaker.is_open(region):
+            raise CircuitOpen(region)
+
+    def _retry(self, region, attempt, e):
+        '''
+        records the failed attempt at scanning region with the error e -
+        returns the seconds to wait before the next one, or None to give up
+        '''
+        self.breaker.failed(region)
+        if (not is_transient(e) or attempt + 1 >= REGION_ATTEMPTS or
+                self.breaker.is_open(region) or
+                (self.deadline is not None and
+                 time.monotonic() >= self.deadline)):
+            return None
+        return backoff_delay(attempt, REGION_BACKOFF)
+
+    def _timed(self, timing, region, region_results, fn, *args):
+        start = time.perf_counter()
+        token = DEADLINE.set(self.deadline)
+        try:
+            # queued scans that would start past the deadline don't
+            check_deadline()
+            for attempt in range(REGION_ATTEMPTS):
+                self._check_breaker(region)
+                try:
+                    r = fn(*args)
+                except DeadlineExceeded:
+                    raise
+                except Exception as e:
+                    delay = self._retry(region, attempt, e)
+                    if delay is None:
+                        raise
+                    region_results.clear()
+                    time.sleep(delay)
+                else:
+                    self.breaker.succeeded(region)
+                    return r
+        finally:
+            DEADLINE.reset(token)
+            timing['regions'][region] = time.perf_counter() - start
+
+    async def _timed_async(self, timing, region, region_results, fn, *args):
+        start = time.perf_counter()
+        try:
+            for attempt in range(REGION_ATTEMPTS):
+                self._check_breaker(region)
+                try:
+                    r = await fn(*args)
+                except Exception as e:
+                    delay = self._retry(region, attempt, e)
+                    if delay is None:
+                        raise
+                    region_results.clear()
+                    await asyncio.sleep(delay)
+                else:
+                    self.breaker.succeeded(region)
+                    return r
+        finally:
+            timing['regions'][region] = time.perf_counter() - start
+
+    def report_timings(self, file=None):
+        file = file or sys.stderr
+        for name, timing in self.timings.items():
+            print(f"[{name}] scanned {len(timing['regions'])} regions in "
+                  f"{timing['total']:.2f}s", file=file)
+            if timing['unfinished']:
+                print(f"[{name}] unfinished at the deadline: "
+                      f"{', '.join(timing['unfinished'])}", file=file)
+            for region, error in sorted(dict(timing['errors']).items()):
+                print(f"[{name}] {region} failed: {error}", file=file)
+            # (copied, as stragglers past a deadline may still add to it)
+            for region, seconds in sorted(dict(timing['regions']).items(),
+                                          key=lambda r: -r[1]):
+                print(f"[{name}]   {region}: {seconds:.2f}s", file=file)
+
+
+def list_regions():
+    client = clients.client('ec2')
+    with instrument.Stage('discover'):
+        aws_regions_info = client.describe_regions()
+    return [region['RegionName'] for region in
+            aws_regions_info.get('Regions', [])]
+
+
+async def list_regions_async(aio):
+    client = await aio.client('ec2')
+    with instrument.Stage('discover'):
+        aws_regions_info = await client.describe_regions()
+    return [region['RegionName'] for region in
+            aws_regions_info.get('Regions', [])]
+
+
+async def run_scan(scan_region, results, scheduler=None,
+                   scan_region_async=None, name=None):
+    '''
+    scan with the given scheduler, or with a private one if none is given
+    '''
+    if scheduler is not None:
+        await scheduler.scan(scan_region, results, scan_region_async, name)
+    else:
+        async with Scheduler() as scheduler:
+            await scheduler.scan(scan_region, results, scan_region_async,
+                                 name)
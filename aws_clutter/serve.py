@@ -0,0 +1,238 @@
+'''
+`awsclutter serve` - a resident process that rescans each clutter type on
+its own interval and serves the metrics of the last completed scans on an
+HTTP /metrics endpoint, in the Prometheus text format. A scan replaces the
+metrics of its clutter type only once it completes, so scrapes never wait
+on AWS.
+
+The boto3 clients (with the 'threads' backend), the pricing tables and the
+region list stay warm across scans.
+'''
+import os
+import re
+import sys
+import time
+import asyncio
+import threading
+import http.server
+import aws_clutter.run as run
+import aws_clutter.clients as clients
+import aws_clutter.publish as publish
+from aws_clutter.scheduler import list_regions
+
+HOST = os.getenv('CK_SERVE_HOST', default='0.0.0.0')
+PORT = int(os.getenv('CK_SERVE_PORT', default='9487'))
+# seconds between the starts of two scans of a clutter type
+INTERVAL = float(os.getenv('CK_SERVE_INTERVAL', default='600'))
+# seconds before the regions are discovered again
+REGIONS_TTL = float(os.getenv('CK_SERVE_REGIONS_TTL', default='86400'))
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def snake_case(name):
+    '''
+    Prometheus style name of a CloudWatch metric or dimension name, e.g.
+    detached_ebs_monthly_cost for DetachedEBSMonthlyCost
+    '''
+    name = re.sub(r'(?<=[a-z0-9])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])', '_',
+                  name)
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name).lower()
+
+
+def escape(value):
+    return (str(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+
+def labels(dims):
+    if not dims:
+        return ''
+    return '{' + ','.join(f'{snake_case(name)}="{escape(value)}"'
+                          for name, value in dims) + '}'
+
+
+def prometheus_text(metric_data, namespace=None):
+    '''
+    metric_data (as put to CloudWatch) as Prometheus gauges named
+    <namespace>_<metric name>, with the dimensions as labels
+    '''
+    prefix = snake_case(namespace or run.NAMESPACE)
+    samples = {}
+    for datum in metric_data:
+        samples.setdefault(datum['MetricName'], []).append(
+            labels([(d['Name'], d['Value']) for d in datum['Dimensions']]) +
+            f" {float(datum['Value'])!r}")
+    lines = []
+    for metric_name, metric_samples in samples.items():
+        name = f"{prefix}_{snake_case(metric_name)}"
+        lines.append(f"# HELP {name} {metric_name}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.extend(f"{name}{sample}" for sample in metric_samples)
+    return ''.join(f"{line}\n" for line in lines)
+
+
+def parse_intervals(specs, clutter_type, default=None):
+    '''
+    {clutter type: seconds} from specs of either <seconds> (for all the
+    clutter types) or <clutter type>=<seconds> - raises ValueError for an
+    unknown clutter type or a bad interval
+    '''
+    default = INTERVAL if default is None else default
+    intervals = {}
+    for spec in specs:
+        ct, _, seconds = spec.rpartition('=')
+        seconds = float(seconds)
+        if seconds <= 0:
+            raise ValueError(f"Bad interval {spec}")
+        if not ct:
+            default = seconds
+        elif ct not in clutter_type:
+            raise ValueError(f"Unknown clutter type {ct}")
+        else:
+            intervals[ct] = seconds
+    return {ct: intervals.get(ct, default) for ct in clutter_type}
+
+
+class Daemon:
+    '''
+    Scans the clutter types on their intervals and keeps the metrics of
+    their last completed scans for the /metrics endpoint.
+    '''
+    def __init__(self, clutter_type, intervals=None, push=False,
+                 compact=None, backend=None, role_arns=None, workers=None):
+        self.clutter_type = [*clutter_type]
+        self.intervals = intervals or parse_intervals((), clutter_type)
+        self.push = push
+        self.compact = run.COMPACT_METRICS if compact is None else compact
+        self.backend = backend
+        self.role_arns = role_arns
+        self.workers = workers
+        self.lock = threading.Lock()
+        # clutter type -> metric data of the last completed scan
+        self.metric_data = {}
+        # clutter type -> (end time, seconds) of the last completed scan
+        self.completed = {}
+        self.failures = {ct: 0 for ct in self.clutter_type}
+        self._regions = None
+        self._regions_time = 0.0
+
+    async def regions(self):
+        '''
+        the regions, discovered again every REGIONS_TTL seconds - None for
+        multi-account scans, where each account discovers its own
+        '''
+        if self.role_arns:
+            return None
+        if (self._regions is None or
+                time.monotonic() - self._regions_time > REGIONS_TTL):
+            self._regions = await asyncio.get_running_loop().run_in_executor(
+                None, list_regions)
+            self._regions_time = time.monotonic()
+        return self._regions
+
+    async def scan(self, ct):
+        start = time.perf_counter()
+        metric_data = []
+        await run.get_metric_data([ct], metric_data, self.backend,
+                                  role_arns=self.role_arns,
+                                  workers=self.workers,
+                                  regions=await self.regions())
+        with self.lock:
+            self.metric_data[ct] = metric_data
+            self.completed[ct] = (time.time(), time.perf_counter() - start)
+        if self.push and metric_data:
+            await asyncio.get_running_loop().run_in_executor(
+                None, lambda: publish.put_metric_data(
+                    clients.client('cloudwatch'), run.NAMESPACE, metric_data,
+                    compact=self.compact))
+
+    async def scan_forever(self, ct):
+        while True:
+            start = time.monotonic()
+            try:
+                await self.scan(ct)
+            except Exception as e:
+                # the last completed scan keeps being served
+                with self.lock:
+                    self.failures[ct] += 1
+                print(f"[{ct}] scan failed: {e!r}", file=sys.stderr)
+            await asyncio.sleep(max(0.0, self.intervals[ct] -
+                                    (time.monotonic() - start)))
+
+    async def run(self):
+        # discovered once for all the clutter types
+        await self.regions()
+        await asyncio.gather(*[self.scan_forever(ct)
+                               for ct in self.clutter_type])
+
+    def metrics(self):
+        '''
+        the /metrics response: the metrics of the last completed scans, and
+        the status of the scans - rendered together, as each metric (e.g.
+        ScanErrors) must come in one block across the clutter types
+        '''
+        with self.lock:
+            metric_data = [d for ct in self.clutter_type
+                           for d in self.metric_data.get(ct, [])]
+            completed = dict(self.completed)
+            failures = dict(self.failures)
+        prefix = snake_case(run.NAMESPACE)
+        status = []
+        for name, kind, values in [
+                ('last_scan_timestamp_seconds', 'gauge',
+                 {ct: end for ct, (end, _) in completed.items()}),
+                ('last_scan_duration_seconds', 'gauge',
+                 {ct: seconds for ct, (_, seconds) in completed.items()}),
+                ('scan_failures_total', 'counter', failures)]:
+            status.append(f"# TYPE {prefix}_{name} {kind}\n")
+            status.extend(f'{prefix}_{name}{labels([("ClutterType", ct)])} '
+                          f'{float(value)!r}\n'
+                          for ct, value in values.items())
+        return prometheus_text(metric_data) + ''.join(status)
+
+    def http_server(self, host=None, port=None):
+        '''
+        the (not yet started) HTTP server of the /metrics endpoint
+        '''
+        daemon = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                data = daemon.metrics().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return http.server.ThreadingHTTPServer(
+            (HOST if host is None else host, PORT if port is None else port),
+            Handler)
+
+
+def serve(clutter_type=(), intervals=None, host=None, port=None, push=False,
+          compact=None, backend=None, role_arns=None, workers=None):
+    '''
+    `awsclutter serve` - runs until interrupted. intervals is {clutter type:
+    seconds} (see parse_intervals)
+    '''
+    clutter_type = run.check_clutter_type(clutter_type)
+    daemon = Daemon(clutter_type, intervals, push, compact, backend,
+                    role_arns, workers)
+    server = daemon.http_server(host, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving metrics on http://{server.server_address[0]}:"
+          f"{server.server_port}/metrics", file=sys.stderr)
+    try:
+        asyncio.run(daemon.run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,201 @@
+'''
+Shard mode of `awsclutter watch`: the (account, region, clutter type) work
+units are split into shards, each scanned by its own worker process - or
+Lambda invocation, with `--shard-function` - and aggregated there into the
+state of the clutter type's cube. The coordinator only merges these states
+into one cube per clutter type (and account), so the metrics are the same
+as the ones of a single-process run:
+
+    cubes, errors = shard.run_shards(['debs'], shards=8)
+'''
+import os
+import json
+import time
+import asyncio
+import threading
+import functools
+import concurrent.futures
+import aws_clutter.clutter as clutter
+import aws_clutter.accounts as accounts
+import aws_clutter.clients as clients
+import aws_clutter.run as run
+from aws_clutter.scheduler import list_regions
+from aws_clutter.tools import backoff_delay, is_throttling
+
+# threads discovering the regions of the accounts
+DISCOVERY_WORKERS = int(os.getenv('CK_DISCOVERY_WORKERS', default='16'))
+# attempts of a throttled shard invocation, backing off from SHARD_BACKOFF
+# seconds
+SHARD_ATTEMPTS = int(os.getenv('CK_SHARD_ATTEMPTS', default='5'))
+SHARD_BACKOFF = float(os.getenv('CK_SHARD_BACKOFF', default='1'))
+# (pid, thread pool) of the discovery (see discovery_executor)
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def discovery_executor():
+    '''
+    the thread pool discovering the regions of the accounts, kept for the
+    life of the process (made again in a forked one): the shard processes
+    are forked right after the discovery, and a thread still exiting then
+    can leave them deadlocked (e.g., in OpenSSL)
+    '''
+    global _executor
+    with _executor_lock:
+        if _executor is None or _executor[0] != os.getpid():
+            _executor = (os.getpid(), concurrent.futures.ThreadPoolExecutor(
+                max_workers=DISCOVERY_WORKERS,
+                thread_name_prefix='discovery'))
+        return _executor[1]
+
+
+def work_units(clutter_type, role_arns=None, regions=None):
+    '''
+    the [role ARN (or None), region, clutter type] work units - the regions
+    of each account are discovered unless given, the accounts concurrently
+    '''
+    def account_regions(role_arn):
+        if role_arn is None and regions is not None:
+            return regions
+        with clients.assumed_role(role_arn):
+            return list_regions()
+
+    role_arns = role_arns or [None]
+    return [[role_arn, region, ct]
+            for role_arn, rs in zip(role_arns, discovery_executor().map(
+                account_regions, role_arns))
+            for region in rs for ct in clutter_type]
+
+
+def split(units, shards):
+    '''
+    the work units in (at most) shards lists - the clutter types of an
+    (account, region) go to the same shard, which scans them with one
+    scheduler
+    '''
+    groups = {}
+    for unit in units:
+        groups.setdefault((unit[0], unit[1]), []).append(unit)
+    split_units = [[] for _ in range(min(shards, len(groups)))]
+    for i, group in enumerate(groups.values()):
+        split_units[i % len(split_units)].extend(group)
+    return split_units
+
+
+def run_shard(units, backend=None):
+    '''
+    scans and aggregates the work units of a shard - returns
+    {'cubes': {clutter type: {account (or ''): cube state}}, 'errors':
+    {clutter type: {account (or ''): {region: error}}}}, as JSON-able data
+    '''
+    by_role = {}
+    for role_arn, region, ct in units:
+        by_role.setdefault(role_arn, {}).setdefault(ct, []).append(region)
+    states = {}
+    errors = {}
+    for role_arn, ct_regions in by_role.items():
+        regions = sorted({r for rs in ct_regions.values() for r in rs})
+        skip_regions = {ct: [r for r in regions if r not in rs]
+                        for ct, rs in ct_regions.items()}
+        timings = {}
+        with clients.assumed_role(role_arn):
+            resources = asyncio.run(run.scan(
+                [*ct_regions], backend, skip_regions=skip_regions,
+                compact_records=True, regions=regions, timings=timings))
+        account = accounts.account_id(role_arn) if role_arn else ''
+        for ct, rs in ct_regions.items():
+            ct_resources = {region: resources[ct].get(region, [])
+                            for region in rs}
+            if role_arn:
+                for rs in ct_resources.values():
+                    for r in rs:
+                        r['AccountId'] = account
+            states.setdefault(ct, {})[account] = clutter.get(
+                ct).new_cube().add_all(ct_resources).state()
+            errors.setdefault(ct, {})[account] = timings[ct]['errors']
+    return {'cubes': states, 'errors': errors}
+
+
+class LambdaExecutor(concurrent.futures.ThreadPoolExecutor):
+    '''
+    runs shards in invocations of the Lambda function_name (which calls
+    run_shard) - submit_shard() returns the future of the run_shard result.
+    A throttled invocation, which never ran, is tried again (up to
+    SHARD_ATTEMPTS times); other failures, e.g. timeouts after which the
+    shard may still be running, are not.
+    '''
+    def __init__(self, function_name, max_workers=None):
+        super().__init__(max_workers=max_workers)
+        self.function_name = function_name
+        from botocore.config import Config
+        # a shard can take up to the function's timeout
+        self.client = clients.session().client('lambda', config=Config(
+            read_timeout=900, retries={'max_attempts': 0}))
+
+    def submit_shard(self, units, backend=None):
+        return self.submit(self.invoke, units, backend)
+
+    def invoke(self, units, backend=None):
+        for attempt in range(SHARD_ATTEMPTS):
+            try:
+                response = self.client.invoke(
+                    FunctionName=self.function_name,
+                    Payload=json.dumps({'shard': units, 'backend': backend}))
+                break
+            except Exception as e:
+                if not is_throttling(e) or attempt + 1 >= SHARD_ATTEMPTS:
+                    raise
+                time.sleep(backoff_delay(attempt, SHARD_BACKOFF))
+        payload = json.load(response['Payload'])
+        if 'FunctionError' in response:
+            raise RuntimeError(f"Shard failed in {self.function_name}: "
+                               f"{payload}")
+        return payload
+
+
+def run_shards(clutter_type, shards=None, role_arns=None, backend=None,
+               regions=None, function_name=None):
+    '''
+    scans the work units of the clutter types in shards worker processes
+    (or invocations of the Lambda function_name) - returns ({clutter type:
+    {account (or ''): merged cube}}, {clutter type: {account (or ''):
+    {region: error}}})
+    '''
+    split_units = split(work_units(clutter_type, role_arns, regions),
+                        shards or os.cpu_count() or 1)
+    # clutter type -> account -> the cube states of its regions
+    states = {ct: {} for ct in clutter_type}
+    errors = {ct: {} for ct in clutter_type}
+    if function_name:
+        executor = LambdaExecutor(function_name, len(split_units) or 1)
+        submit = executor.submit_shard
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=len(split_units) or 1)
+        submit = functools.partial(executor.submit, run_shard)
+    with executor:
+        futures = [submit(units, backend) for units in split_units]
+        for future in futures:
+            result = future.result()
+            # (the regions of an account are each scanned by one shard)
+            for ct, account_states in result['cubes'].items():
+                for account, s in account_states.items():
+                    states[ct].setdefault(account, {}).update(s)
+            for ct, account_errors in result['errors'].items():
+                for account, region_errors in account_errors.items():
+                    errors[ct].setdefault(account, {}).update(region_errors)
+    all_accounts = ([accounts.account_id(a) for a in role_arns]
+                    if role_arns else [''])
+    cubes = {}
+    for ct, account_states in states.items():
+        # in the order of role_arns, with the accounts without regions too,
+        # and merged in the order of the region names - as a single process
+        # aggregates them
+        cubes[ct] = {
+            account: clutter.get(ct).new_cube().merge(
+                dict(sorted(account_states.get(account, {}).items())))
+            for account in all_accounts
+        }
+        errors[ct] = {account: errors[ct].get(account, {})
+                      for account in all_accounts}
+    return cubes, errors
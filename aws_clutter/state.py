@@ -0,0 +1,221 @@
+import os
+import json
+import datetime
+import uuid
+import urllib.parse
+import aws_clutter.clients as clients
+
+# regions with no clutter and no change for this many runs are only scanned
+# every QUIET_RUNS runs
+QUIET_RUNS = int(os.getenv('CK_QUIET_RUNS', default='6'))
+
+
+class FileStore:
+    '''
+    keeps the scan state in a local JSON file
+    '''
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, state):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.path)
+
+
+class S3Store:
+    '''
+    keeps the scan state in an S3 (or S3-compatible) object
+    '''
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+
+    def load(self):
+        client = clients.client('s3')
+        try:
+            r = client.get_object(Bucket=self.bucket, Key=self.key)
+        except client.exceptions.NoSuchKey:
+            return None
+        return json.loads(r['Body'].read())
+
+    def save(self, state):
+        clients.client('s3').put_object(Bucket=self.bucket, Key=self.key,
+                                        Body=json.dumps(state).encode())
+
+
+class DynamoDBStore:
+    '''
+    keeps the scan state in DynamoDB items with the string hash key 'id':
+    the state is written in chunks of up to ITEM_CHARS, as items
+    <key>#<generation>#<n>, then the <key> item is pointed at them - so a
+    state over the 400 KB item limit can be kept, and an interrupted save
+    leaves the previous state in place
+    '''
+    # JSON (ASCII) characters per item, below the 400 KB item limit
+    ITEM_CHARS = 350 * 1024
+
+    def __init__(self, table, key):
+        self.table = table
+        self.key = key
+
+    def get_item(self, item_id):
+        r = clients.client('dynamodb').get_item(
+            TableName=self.table, Key={'id': {'S': item_id}},
+            ConsistentRead=True)
+        return r.get('Item')
+
+    def chunk_ids(self, head):
+        generation = head['generation']['S']
+        return [f"{self.key}#{generation}#{n}"
+                for n in range(int(head['chunks']['N']))]
+
+    def load(self):
+        head = self.get_item(self.key)
+        if head is None:
+            return None
+        if 'state' in head:
+            # a state saved in a single item
+            return json.loads(head['state']['S'])
+        return json.loads(''.join(self.get_item(item_id)['chunk']['S']
+                                  for item_id in self.chunk_ids(head)))
+
+    def save(self, state):
+        client = clients.client('dynamodb')
+        body = json.dumps(state)
+        chunks = [body[i:i + self.ITEM_CHARS]
+                  for i in range(0, len(body), self.ITEM_CHARS)]
+        generation = uuid.uuid4().hex
+        for n, chunk in enumerate(chunks):
+            client.put_item(TableName=self.table, Item={
+                'id': {'S': f"{self.key}#{generation}#{n}"},
+                'chunk': {'S': chunk}})
+        previous = self.get_item(self.key)
+        client.put_item(TableName=self.table, Item={
+            'id': {'S': self.key}, 'generation': {'S': generation},
+            'chunks': {'N': str(len(chunks))}})
+        if previous is not None and 'generation' in previous:
+            for item_id in self.chunk_ids(previous):
+                client.delete_item(TableName=self.table,
+                                   Key={'id': {'S': item_id}})
+
+
+class MemoryStore:
+    '''
+    in-process stand-in for the other stores
+    '''
+    def __init__(self, state=None):
+        self.state = state
+
+    def load(self):
+        return json.loads(json.dumps(self.state)) if self.state else None
+
+    def save(self, state):
+        self.state = json.loads(json.dumps(state))
+
+
+def open_store(url):
+    '''
+    store for a path or a file://, s3://bucket/key or dynamodb://table/key URL
+    '''
+    u = urllib.parse.urlparse(url)
+    if u.scheme == 's3':
+        return S3Store(u.netloc, u.path.lstrip('/'))
+    if u.scheme == 'dynamodb':
+        return DynamoDBStore(u.netloc, u.path.lstrip('/') or 'awsclutter')
+    if u.scheme in ('', 'file'):
+        return FileStore(u.path if u.scheme else url)
+    raise ValueError(f"Unsupported state store {url}")
+
+
+class Incremental:
+    '''
+    Compares each scan with the last one kept in a store:
+    - regions_to_skip() lists the regions that had no clutter and no change
+      for quiet_runs runs, and are not due for a scan in this run
+    - region_order() orders the regions to scan: the ones left unfinished
+      by the last run first, then the slowest and most cluttered
+    - update() records the scanned resources (and scan times) and returns
+      the resources added/removed since the last scan as events
+    - save() persists the state for the next run
+    '''
+    def __init__(self, store, quiet_runs=QUIET_RUNS):
+        self.store = store
+        self.quiet_runs = quiet_runs
+        self.state = store.load() or {'run': 0, 'types': {}}
+        self.state['run'] += 1
+        self.run = self.state['run']
+        self.added = {}
+
+    def regions_to_skip(self, clutter_type):
+        skip = set()
+        for region, rs in self.state['types'].get(clutter_type, {}).items():
+            if (self.quiet_runs and rs['quiet_runs'] >= self.quiet_runs and
+                    self.run - rs['last_scan'] < self.quiet_runs and
+                    not rs.get('unfinished')):
+                skip.add(region)
+        return skip
+
+    def region_order(self, clutter_type):
+        regions = self.state['types'].get(clutter_type, {})
+        return sorted(regions, key=lambda region: (
+            not regions[region].get('unfinished'),
+            -regions[region].get('seconds', 0.0),
+            -len(regions[region]['ids'])))
+
+    def update(self, clutter_type, resources, id_key, skipped=(),
+               unfinished=(), seconds=None):
+        '''
+        unfinished are the regions whose scans were cut short (and are
+        carried over to the next run), and seconds the {region: seconds}
+        the scans took
+        '''
+        timestamp = datetime.datetime.utcnow()
+        regions = self.state['types'].setdefault(clutter_type, {})
+        added = self.added.setdefault(clutter_type, set())
+        seconds = seconds or {}
+        for region in unfinished:
+            previous = regions.setdefault(region, {
+                'ids': [], 'quiet_runs': 0, 'last_scan': 0})
+            previous['unfinished'] = True
+            # at least as slow as that
+            previous['seconds'] = max(previous.get('seconds', 0.0),
+                                      seconds.get(region, 0.0))
+        events = []
+        for region, rs in resources.items():
+            if region in skipped or region in unfinished:
+                continue
+            ids = sorted(r[id_key] for r in rs)
+            previous = regions.get(region, {'ids': [], 'quiet_runs': 0})
+            old_ids = set(previous['ids'])
+            new_ids = set(ids)
+            for event, changed in [('Added', new_ids - old_ids),
+                                   ('Removed', old_ids - new_ids)]:
+                for resource_id in sorted(changed):
+                    events.append({
+                        'Event': event,
+                        'ClutterType': clutter_type,
+                        'RZCode': region,
+                        'ResourceId': resource_id,
+                        'Timestamp': timestamp
+                    })
+            added.update(new_ids - old_ids)
+            quiet = not ids and not old_ids
+            regions[region] = {
+                'ids': ids,
+                'quiet_runs': previous['quiet_runs'] + 1 if quiet else 0,
+                'last_scan': self.run,
+                'seconds': seconds.get(region, previous.get('seconds', 0.0))
+            }
+        return events
+
+    def save(self):
+        self.store.save(self.state)
@@ -1,6 +1,28 @@
-import pendulum
 import json
+import time
+import random
+import asyncio
 import datetime
+import threading
+import contextvars
+import collections
+import botocore.exceptions
+
+# monotonic time by which the scan running in this context must be done
+# (see aws_clutter.scheduler), or None
+DEADLINE = contextvars.ContextVar('deadline', default=None)
+
+
+class DeadlineExceeded(Exception):
+    '''
+    raised by boto3_paginate once the deadline of its scan has passed
+    '''
+
+
+def check_deadline():
+    deadline = DEADLINE.get()
+    if deadline is not None and time.monotonic() >= deadline:
+        raise DeadlineExceeded()
 
 
 def boto3_paginate(method, **kwargs):
@@ -14,14 +36,208 @@ def boto3_paginate(method, **kwargs):
     paginator = client.get_paginator(method.__name__)
     for page in paginator.paginate(**kwargs).result_key_iters():
         for result in page:
+            # the scans on worker threads can't be cancelled - they stop
+            # here instead
+            check_deadline()
             yield result
 
 
+async def aio_paginate(method, **kwargs):
+    '''
+    async counterpart of boto3_paginate for aiobotocore clients:
+    async for vol in aio_paginate(ec2.describe_volumes):
+        print(vol)
+    '''
+    client = method.__self__
+    paginator = client.get_paginator(method.__name__)
+    for page in paginator.paginate(**kwargs).result_key_iters():
+        async for result in page:
+            yield result
+
+
+def isoformat_utc(dt):
+    '''
+    ISO-8601 string of dt in UTC, e.g. 2021-11-01T12:00:00Z - naive datetimes
+    are taken to be in UTC already
+    '''
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return dt.isoformat() + 'Z'
+
+
 # Serialize datetime in UTC
 class DateTimeJSONEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, datetime.datetime):
-            dt = pendulum.instance(obj).in_tz('UTC')
-            return dt.to_iso8601_string()
+            return isoformat_utc(obj)
         else:
             return super(DateTimeJSONEncoder, self).default(obj)
+
+
+def json_default(obj):
+    if isinstance(obj, datetime.datetime):
+        return isoformat_utc(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} "
+                    f"is not JSON serializable")
+
+
+orjson = ...  # not loaded yet
+
+
+def load_orjson():
+    '''
+    imports orjson on first use - returns None if it's not installed
+    '''
+    global orjson
+    if orjson is ...:
+        try:
+            import orjson
+        except ImportError:
+            orjson = None
+    return orjson
+
+
+def dumps(obj, indent=None):
+    '''
+    JSON of obj with sorted keys and datetimes in UTC (as
+    DateTimeJSONEncoder), indented by indent spaces as ever - or compact, in
+    UTF-8, and encoded natively by orjson when it's installed, with the
+    same output as the stdlib fallback but for floats printed with an
+    exponent (e.g. 1e-05), which orjson writes differently.
+    '''
+    if indent is not None:
+        return json.dumps(obj, sort_keys=True, indent=indent,
+                          default=json_default)
+    fast = load_orjson()
+    if fast is None:
+        return json.dumps(obj, sort_keys=True, separators=(',', ':'),
+                          ensure_ascii=False, default=json_default)
+    return fast.dumps(obj, default=json_default,
+                      option=fast.OPT_SORT_KEYS |
+                      fast.OPT_PASSTHROUGH_DATETIME).decode()
+
+
+THROTTLING_ERRORS = ('Throttling', 'ThrottlingException',
+                     'RequestLimitExceeded', 'TooManyRequestsException')
+
+
+class TokenBucket:
+    '''
+    thread-safe token bucket - rate is in tokens per second, and a rate of 0
+    means unlimited. The rate is halved on throttled() calls, at most once
+    per cooldown seconds (as the calls in flight get throttled together),
+    and doubles back to the configured rate every cooldown seconds without
+    any.
+
+    With adaptive, a rate of 0 means unlimited until the calls get
+    throttled: the rate then starts from half the one of the last second,
+    and is unlimited again once it has doubled back past twice that.
+    '''
+    def __init__(self, rate, capacity=None, cooldown=1.0, adaptive=False):
+        self.max_rate = rate
+        self.rate = rate
+        # the rate the halvings and the burst capacity are relative to
+        self.base = rate
+        self.capacity = capacity
+        self.cooldown = cooldown
+        self.adaptive = adaptive
+        self.tokens = capacity or max(rate, 1)
+        self.last = time.monotonic()
+        # (time, rate) of the last halving of the rate
+        self.last_throttled = None
+        self.throttled_rate = None
+        # times of the last calls while unlimited, to measure their rate
+        self.calls = collections.deque(maxlen=1000)
+        self.lock = threading.Lock()
+
+    def recover(self, now):
+        if self.last_throttled is None:
+            return
+        rate = self.throttled_rate * 2 ** ((now - self.last_throttled) /
+                                           self.cooldown)
+        if rate < 2 * self.base:
+            self.rate = min(rate, self.max_rate or rate)
+        else:
+            self.rate = self.max_rate
+        if self.rate == self.max_rate:
+            self.last_throttled = None
+            self.calls.clear()
+
+    def take(self):
+        '''
+        takes a token if one is available - returns the seconds to wait
+        before trying again otherwise (0 when the token was taken)
+        '''
+        if not self.rate:
+            if self.adaptive:
+                self.calls.append(time.monotonic())
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.recover(now)
+            if not self.rate:
+                return 0
+            capacity = self.capacity or max(self.base, 1)
+            self.tokens = min(capacity,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        wait = self.take()
+        while wait:
+            time.sleep(wait)
+            wait = self.take()
+
+    async def acquire_async(self):
+        wait = self.take()
+        while wait:
+            await asyncio.sleep(wait)
+            wait = self.take()
+
+    def throttled(self):
+        with self.lock:
+            now = time.monotonic()
+            if (self.last_throttled is not None and
+                    now - self.last_throttled < self.cooldown):
+                return
+            self.recover(now)
+            if not self.rate:
+                if not self.adaptive:
+                    return
+                # limited from now on, from the rate of the last second
+                self.base = max(sum(now - t <= 1 for t in self.calls), 1)
+                self.rate = self.base
+                self.tokens = 0
+                self.last = now
+            self.last_throttled = now
+            self.rate = self.throttled_rate = max(self.rate / 2,
+                                                  self.base / 16)
+
+
+# the connection and timeout errors worth retrying
+TRANSIENT_ERRORS = (botocore.exceptions.EndpointConnectionError,
+                    botocore.exceptions.ConnectTimeoutError,
+                    botocore.exceptions.ReadTimeoutError,
+                    botocore.exceptions.ConnectionClosedError,
+                    ConnectionError, TimeoutError)
+
+
+def is_throttling(e, retryable=THROTTLING_ERRORS):
+    return (isinstance(e, botocore.exceptions.ClientError) and
+            e.response.get('Error', {}).get('Code') in retryable)
+
+
+def is_transient(e):
+    '''
+    whether e is a throttling, connection or timeout error - unlike, e.g.,
+    AccessDenied or OptInRequired, which would fail again
+    '''
+    return is_throttling(e) or isinstance(e, TRANSIENT_ERRORS)
+
+
+def backoff_delay(attempt, base_delay):
+    return random.uniform(0, base_delay * 2 ** attempt)
@@ -0,0 +1,71 @@
+'''
+benchmark aggregating synthetic clutter resources into CloudWatch metric
+data with debs.aggregate / ulbs.aggregate, for several dimension settings
+
+    python benchmarks/bench_aggregate.py [resources]
+'''
+import sys
+import time
+import random
+import aws_clutter.clutter.debs as debs
+import aws_clutter.clutter.ulbs as ulbs
+
+REGIONS = ['us-east-1', 'us-east-2', 'us-west-1', 'us-west-2', 'eu-west-1',
+           'eu-central-1', 'ap-southeast-1', 'ap-northeast-1', 'sa-east-1',
+           'cn-north-1']
+VOL_TYPES = ['gp2', 'gp3', 'io1', 'io2', 'st1', 'sc1', 'standard']
+LB_TYPES = ['application', 'network', 'gateway']
+
+
+def synthetic_dvs(n):
+    rng = random.Random(0)
+    dvs = {region: [] for region in REGIONS}
+    for i in range(n):
+        region = rng.choice(REGIONS)
+        dvs[region].append(debs.Volume({
+            'VolumeId': f'vol-{i:017x}',
+            'VolumeType': rng.choice(VOL_TYPES),
+            'RZCode': region,
+            'MonthlyCost': rng.uniform(0.1, 2000.0),
+            'MonthlyCostUnit': 'CNY' if region.startswith('cn-') else 'USD'
+        }))
+    return dvs
+
+
+def synthetic_ulbs(n):
+    rng = random.Random(0)
+    lbs = {region: [] for region in REGIONS}
+    for i in range(n):
+        region = rng.choice(REGIONS)
+        lbs[region].append({
+            'LoadBalancerArn': f'arn:lb/{i}',
+            'Type': rng.choice(LB_TYPES),
+            'RZCode': region,
+            'MonthlyCost': rng.choice([16.43, 18.25, 21.9]),
+            'MonthlyCostUnit': 'USD'
+        })
+    return lbs
+
+
+def measure(label, aggregate, resources):
+    start = time.perf_counter()
+    metric_data = aggregate(resources)
+    print(f"{label:36} {time.perf_counter() - start:8.3f}s "
+          f"({len(metric_data)} datums)")
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    dvs = synthetic_dvs(n)
+    lbs = synthetic_ulbs(n)
+    for dims in ['RZCode', 'RZCode,VolumeType', 'RZCode,VolumeType,VolumeId']:
+        debs.DEBS_DIMS_DEFAULT = dims
+        measure(f"debs [{dims}]", debs.aggregate, dvs)
+    for dims in ['RZCode', 'RZCode,LBType']:
+        ulbs.ULBS_DIMS_DEFAULT = dims
+        measure(f"ulbs [{dims}]", ulbs.aggregate, lbs)
+    print(f"({n} resources)")
+
+
+if __name__ == '__main__':
+    main()
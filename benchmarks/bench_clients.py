@@ -0,0 +1,64 @@
+'''
+micro-benchmark: boto3 client construction per (service, region) per run
+versus the shared client pool in aws_clutter.clients
+
+    python benchmarks/bench_clients.py [runs]
+'''
+import os
+import sys
+import time
+import boto3
+from botocore.stub import Stubber
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import aws_clutter.clients as clients  # noqa: E402
+
+REGIONS = ['us-east-1', 'us-east-2', 'us-west-1', 'us-west-2', 'eu-west-1',
+           'eu-west-2', 'eu-central-1', 'ap-northeast-1', 'ap-southeast-1',
+           'ap-southeast-2', 'sa-east-1', 'ca-central-1']
+SERVICES = ['ec2', 'elbv2']
+
+
+STUBBED_CALLS = {
+    'ec2': ('describe_regions', {'Regions': []}),
+    'elbv2': ('describe_load_balancers', {'LoadBalancers': []}),
+}
+
+
+def stubbed_call(client):
+    # one stubbed call per client so that the comparison includes loading
+    # the operation model as well as constructing the client
+    operation, response = STUBBED_CALLS[client.meta.service_model
+                                        .service_name]
+    with Stubber(client) as stubber:
+        stubber.add_response(operation, response)
+        getattr(client, operation)()
+
+
+def run(make_client, runs):
+    start = time.perf_counter()
+    for _ in range(runs):
+        for service in SERVICES:
+            for region in REGIONS:
+                stubbed_call(make_client(service, region))
+    return time.perf_counter() - start
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    before = run(lambda s, r: boto3.client(s, region_name=r), runs)
+    clients.clear()
+    after = run(clients.client, runs)
+    n = runs * len(SERVICES) * len(REGIONS)
+    print(f"{n} client lookups over {runs} runs")
+    print(f"boto3.client per call: {before:8.3f}s "
+          f"({before / n * 1000:.2f} ms/client)")
+    print(f"clients.client pool:   {after:8.3f}s "
+          f"({after / n * 1000:.2f} ms/client)")
+
+
+if __name__ == '__main__':
+    main()
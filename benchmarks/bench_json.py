@@ -0,0 +1,76 @@
+'''
+benchmark serializing a synthetic `awsclutter list` inventory of detached
+volumes: json.dumps with DateTimeJSONEncoder versus tools.dumps (stdlib
+fallback, and orjson when it's installed), indented and one line per
+volume
+
+    python benchmarks/bench_json.py [volumes]
+'''
+import sys
+import json
+import time
+import random
+import datetime
+import aws_clutter.tools as tools
+
+VOL_TYPES = ['gp2', 'gp3', 'io1', 'io2', 'st1', 'sc1', 'standard']
+
+
+def synthetic_inventory(n):
+    rng = random.Random(0)
+    created = datetime.datetime(2021, 11, 1, 12, 0, 0,
+                                tzinfo=datetime.timezone.utc)
+    volumes = [{
+        'VolumeId': f'vol-{i:017x}',
+        'VolumeType': rng.choice(VOL_TYPES),
+        'Size': rng.randint(1, 16384),
+        'Iops': rng.randint(100, 100000),
+        'State': 'available',
+        'AvailabilityZone': 'us-east-1a',
+        'CreateTime': created + datetime.timedelta(seconds=i),
+        'Encrypted': False,
+        'Attachments': [],
+        'Tags': [{'Key': 'Name', 'Value': f'volume {i}'}],
+        'RZCode': 'us-east-1',
+        'MonthlyCost': rng.uniform(0.1, 2000.0),
+        'MonthlyCostUnit': 'USD'
+    } for i in range(n)]
+    return {'debs': {'description': 'Detached EBS Volumes',
+                     'resources': {'us-east-1': volumes}}}
+
+
+def measure(label, fn):
+    start = time.perf_counter()
+    fn()
+    print(f"{label:40} {time.perf_counter() - start:8.3f}s")
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    inventory = synthetic_inventory(n)
+    volumes = inventory['debs']['resources']['us-east-1']
+    orjson = tools.load_orjson()
+
+    measure('json.dumps indent=4 (DateTimeJSONEncoder)',
+            lambda: json.dumps(inventory, sort_keys=True, indent=4,
+                               cls=tools.DateTimeJSONEncoder))
+    measure('json.dumps per line (DateTimeJSONEncoder)',
+            lambda: [json.dumps(v, sort_keys=True,
+                                cls=tools.DateTimeJSONEncoder)
+                     for v in volumes])
+    tools.orjson = None
+    measure('tools.dumps indent=4 (stdlib)',
+            lambda: tools.dumps(inventory, indent=4))
+    measure('tools.dumps per line (stdlib)',
+            lambda: [tools.dumps(v) for v in volumes])
+    tools.orjson = orjson
+    if orjson is not None:
+        measure('tools.dumps indent=2 (orjson)',
+                lambda: tools.dumps(inventory, indent=2))
+        measure('tools.dumps per line (orjson)',
+                lambda: [tools.dumps(v) for v in volumes])
+    print(f"({n} volumes)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+'''
+benchmark the peak memory (tracemalloc) of scanning synthetic detached
+volumes: materializing the describe_volumes pages and keeping the full
+payloads, versus streaming them through debs.VolumeCollector into compact
+Volume records
+
+    python benchmarks/bench_memory.py [volumes]
+'''
+import sys
+import time
+import random
+import datetime
+import tracemalloc
+import aws_clutter.clutter.debs as debs
+
+VOL_TYPES = ['gp2', 'gp3', 'io1', 'io2', 'st1', 'sc1', 'standard']
+
+
+def synthetic_pages(n, page_size=500):
+    '''
+    describe_volumes result pages, generated one page at a time like the
+    paginator does
+    '''
+    rng = random.Random(0)
+    created = datetime.datetime(2021, 11, 1, 12, 0, 0)
+    for start in range(0, n, page_size):
+        yield [{
+            'VolumeId': f'vol-{i:017x}',
+            'VolumeType': rng.choice(VOL_TYPES),
+            'Size': rng.randint(1, 16384),
+            'Iops': rng.randint(100, 100000),
+            'Throughput': rng.randint(125, 1000),
+            'State': 'available',
+            'AvailabilityZone': 'us-east-1a',
+            'CreateTime': created,
+            'Encrypted': False,
+            'MultiAttachEnabled': False,
+            'Attachments': [],
+            'Tags': [{'Key': 'Name', 'Value': f'volume {i}'},
+                     {'Key': 'team', 'Value': 'storage'}]
+        } for i in range(start, min(start + page_size, n))]
+
+
+def synthetic_volumes(n):
+    for page in synthetic_pages(n):
+        yield from page
+
+
+def materialized(n, region):
+    volumes = [v for v in synthetic_volumes(n)]
+    return debs.enrich_vols([v for v in volumes
+                             if len(v['Attachments']) == 0], region)
+
+
+def streamed(n, region, compact):
+    collector = debs.VolumeCollector(region, compact)
+    for volume in synthetic_volumes(n):
+        collector.add(volume)
+    return collector.done()
+
+
+def measure(label, fn, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    dvs = {'us-east-1': fn(*args)}
+    debs.aggregate(dvs)
+    seconds = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:28} peak {peak / 2**20:8.1f} MiB, "
+          f"kept {current / 2**20:8.1f} MiB, {seconds:6.2f}s")
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    region = 'us-east-1'
+    # load the pricing tables (and numpy) outside of the measurements
+    debs.get_costs(next(synthetic_pages(1)), region)
+
+    measure('materialized, full payloads', materialized, n, region)
+    measure('streamed, full payloads', streamed, n, region, False)
+    measure('streamed, compact records', streamed, n, region, True)
+    print(f"({n} volumes)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+'''
+benchmark pricing synthetic detached volumes: enrich_vol_info per volume
+versus the batch debs.get_costs (with and without numpy)
+
+    python benchmarks/bench_pricing.py [volumes]
+'''
+import sys
+import time
+import random
+import aws_clutter.clutter.debs as debs
+
+VOL_TYPES = ['gp2', 'gp3', 'io1', 'io2', 'st1', 'sc1', 'standard']
+
+
+def synthetic_volumes(n):
+    rng = random.Random(0)
+    return [{
+        'VolumeId': f'vol-{i:017x}',
+        'VolumeType': rng.choice(VOL_TYPES),
+        'Size': rng.randint(1, 16384),
+        'Iops': rng.randint(100, 100000),
+        'Throughput': rng.randint(125, 1000)
+    } for i in range(n)]
+
+
+def per_volume(volumes, region):
+    return [debs.enrich_vol_info(v, region) for v in volumes]
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    volumes = synthetic_volumes(n)
+    region = 'us-east-1'
+    numpy = debs.load_numpy()
+
+    start = time.perf_counter()
+    per_volume(volumes, region)
+    print(f"enrich_vol_info per volume: {time.perf_counter() - start:8.3f}s")
+
+    if numpy is not None:
+        start = time.perf_counter()
+        debs.get_costs(volumes, region)
+        print(f"get_costs (numpy):          "
+              f"{time.perf_counter() - start:8.3f}s")
+
+    debs.numpy = None
+    start = time.perf_counter()
+    debs.get_costs(volumes, region)
+    print(f"get_costs (no numpy):       {time.perf_counter() - start:8.3f}s")
+    debs.numpy = numpy
+    print(f"({n} volumes)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+'''
+end-to-end benchmark of `awsclutter list` and `awsclutter watch --dry-run`
+against a synthetic account served offline by fake_aws.FakeAWS (regions x
+volumes x load balancers x snapshots, with injectable latency and
+throttling). Each run is done in a fresh process; the wall time, API calls
+by action, throttled calls, peak memory (max RSS of the process) and the
+number of resources / metric data points are reported, and written as JSON
+with --output to compare across versions with --compare:
+
+    python benchmarks/bench_scale.py --regions 8 --volumes 20000 --lbs 500
+    python benchmarks/bench_scale.py --preset large --output new.json \\
+        --compare old.json
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import subprocess
+import importlib.metadata
+from fake_aws import Account, FakeAWS
+
+PRESETS = {
+    # regions, volumes, lbs and snapshots per region
+    'small': (4, 1000, 50, 1000),
+    'medium': (8, 10000, 200, 10000),
+    'large': (16, 50000, 1000, 50000),
+}
+COMMANDS = ['list', 'watch']
+
+
+class Counter:
+    '''
+    stdout stand-in that only counts what's written
+    '''
+    def __init__(self):
+        self.chars = 0
+        self.parts = []
+
+    def write(self, s):
+        self.chars += len(s)
+        self.parts.append(s)
+
+    def flush(self):
+        pass
+
+
+def child(command, backend):
+    '''
+    runs the command in this (fresh) process - prints its measurements as
+    JSON on the real stdout
+    '''
+    import aws_clutter.run as run
+    out = Counter()
+    stdout, sys.stdout = sys.stdout, out
+    start = time.perf_counter()
+    try:
+        # all the clutter types, "snaps" included
+        if command == 'list':
+            run.list_clutter(run.CLUTTER_TYPES, backend=backend)
+        else:
+            run.watch(run.CLUTTER_TYPES, dry_run=True, backend=backend)
+    finally:
+        sys.stdout = stdout
+    seconds = time.perf_counter() - start
+    output = json.loads(''.join(out.parts))
+    if command == 'list':
+        count = sum(len(rs) for ct in output.values()
+                    for rs in ct['resources'].values())
+    else:
+        count = len(output)
+    print(json.dumps({
+        'seconds': seconds,
+        'max_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        / 1024,
+        'count': count,
+        'output_bytes': out.chars,
+    }))
+
+
+def measure(args, command, account):
+    fake = FakeAWS(account, latency=args.latency / 1000,
+                   throttle=args.throttle).start()
+    env = dict(os.environ,
+               AWS_ENDPOINT_URL=fake.url,
+               AWS_ACCESS_KEY_ID='benchmark',
+               AWS_SECRET_ACCESS_KEY='benchmark',
+               AWS_DEFAULT_REGION='us-east-1',
+               AWS_MAX_ATTEMPTS='10')
+    try:
+        r = subprocess.run([sys.executable, __file__, '--child', command,
+                            '--backend', args.backend],
+                           env=env, capture_output=True, text=True)
+        if r.returncode:
+            sys.exit(r.stderr)
+        result = json.loads(r.stdout.splitlines()[-1])
+    finally:
+        fake.stop()
+    result.update({
+        'command': command,
+        'api_calls': dict(sorted(fake.calls.items())),
+        'throttled_calls': fake.throttled,
+    })
+    return result
+
+
+def compare(results, path):
+    with open(path) as f:
+        previous = {r['command']: r for r in json.load(f)['results']}
+    for r in results:
+        p = previous.get(r['command'])
+        if p is None:
+            continue
+        print(f"{r['command']:6} vs {path}: time "
+              f"{r['seconds'] / p['seconds']:5.2f}x, memory "
+              f"{r['max_rss_mib'] / p['max_rss_mib']:5.2f}x, API calls "
+              f"{sum(r['api_calls'].values())} vs "
+              f"{sum(p['api_calls'].values())}, count {r['count']} vs "
+              f"{p['count']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--preset', choices=PRESETS, default='small')
+    parser.add_argument('--regions', type=int)
+    parser.add_argument('--volumes', type=int, help='per region')
+    parser.add_argument('--lbs', type=int, help='per region')
+    parser.add_argument('--snapshots', type=int, help='per region')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='milliseconds added to every call')
+    parser.add_argument('--throttle', type=float, default=0.0,
+                        help='fraction of the calls throttled')
+    parser.add_argument('--backend', default='threads')
+    parser.add_argument('--commands', nargs='+', choices=COMMANDS,
+                        default=COMMANDS)
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('--compare', help='results JSON of a previous run')
+    parser.add_argument('--child', choices=COMMANDS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args.child, args.backend)
+
+    regions, volumes, lbs, snapshots = PRESETS[args.preset]
+    account = Account(
+        regions=args.regions or regions,
+        volumes=volumes if args.volumes is None else args.volumes,
+        lbs=lbs if args.lbs is None else args.lbs,
+        snapshots=snapshots if args.snapshots is None else args.snapshots)
+    params = {
+        'regions': len(account.regions),
+        'volumes': account.volumes,
+        'lbs': account.lbs,
+        'snapshots': account.snapshots,
+        'latency_ms': args.latency,
+        'throttle': args.throttle,
+        'backend': args.backend,
+    }
+    results = []
+    for command in args.commands:
+        r = measure(args, command, account)
+        results.append(r)
+        print(f"{command:6} {r['seconds']:7.2f}s, peak "
+              f"{r['max_rss_mib']:7.1f} MiB, "
+              f"{sum(r['api_calls'].values())} API calls "
+              f"({r['throttled_calls']} throttled), {r['count']} "
+              f"{'resources' if command == 'list' else 'data points'}")
+    print(f"({params})")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'version': importlib.metadata.version('aws_clutter'),
+                'python': platform.python_version(),
+                'params': params,
+                'results': results,
+            }, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
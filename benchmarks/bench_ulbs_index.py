@@ -0,0 +1,77 @@
+'''
+synthetic-scale benchmark for deciding unused LBs in a region: the previous
+LB x TG scan versus the LB ARN -> TG ARN index in ulbs.index_lb_tgs
+
+    python benchmarks/bench_ulbs_index.py [lbs] [tgs]
+'''
+import sys
+import time
+import aws_clutter.clutter.ulbs as ulbs
+
+
+class StubELBv2Client:
+    # stubbed describe_target_health: target groups whose number is a
+    # multiple of 6 have a target
+    def describe_target_health(self, TargetGroupArn):
+        n = int(TargetGroupArn.rsplit('/', 1)[1])
+        return {'TargetHealthDescriptions':
+                [{'Target': {'Id': f'i-{n}'}}] if n % 6 == 0 else []}
+
+
+def synthetic_region(n_lbs, n_tgs):
+    lbs = [{'LoadBalancerArn': f'arn:lb/{i}'} for i in range(n_lbs)]
+    # spread target groups round-robin over the LBs, leaving every 10th
+    # target group detached
+    tgs = [{'TargetGroupArn': f'arn:tg/{i}',
+            'LoadBalancerArns': [f'arn:lb/{i % n_lbs}'] if i % 10 else []}
+           for i in range(n_tgs)]
+    return lbs, tgs
+
+
+def tg_health(tg_arn, tg_healths, client):
+    r = tg_healths.get(tg_arn)
+    if r is None:
+        r = client.describe_target_health(TargetGroupArn=tg_arn)
+        tg_healths[tg_arn] = r
+    return r
+
+
+def lb_unused_scan(lb, tgs, tg_healths, client):
+    # the implementation before the ARN index
+    lb_ths = [tg_health(tg['TargetGroupArn'], tg_healths, client)
+              for tg in tgs
+              if lb['LoadBalancerArn'] in tg['LoadBalancerArns']]
+    for th in lb_ths:
+        if len(th['TargetHealthDescriptions']):
+            return False
+    return True
+
+
+def bench_scan(lbs, tgs, client):
+    tg_healths = {}
+    return [lb for lb in lbs if lb_unused_scan(lb, tgs, tg_healths, client)]
+
+
+def bench_index(lbs, tgs, client):
+    lb_tgs = ulbs.index_lb_tgs(tgs)
+    tg_healths = ulbs.fetch_tg_healths(tgs, client)
+    return [lb for lb in lbs if ulbs.lb_unused(lb, lb_tgs, tg_healths)]
+
+
+def main():
+    n_lbs = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    n_tgs = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    lbs, tgs = synthetic_region(n_lbs, n_tgs)
+    client = StubELBv2Client()
+    results = {}
+    for name, fn in [('index', bench_index), ('scan', bench_scan)]:
+        start = time.perf_counter()
+        results[name] = fn(lbs, tgs, client)
+        elapsed = time.perf_counter() - start
+        print(f"{name:6s} {n_lbs} LBs / {n_tgs} TGs: {elapsed:8.3f}s "
+              f"({len(results[name])} unused)")
+    assert(results['index'] == results['scan'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+'''
+Local stand-in for the EC2 and ELBv2 endpoints serving a synthetic account,
+for the offline benchmarks: regions x volumes x load balancers (one target
+group each) x snapshots, paginated like the real APIs, with injectable
+latency and throttling. The responses are generated page by page, so large
+accounts don't have to be held in memory.
+
+    server = FakeAWS(Account(regions=4, volumes=10000, lbs=200)).start()
+    os.environ['AWS_ENDPOINT_URL'] = server.url
+'''
+import re
+import time
+import random
+import threading
+import http.server
+import urllib.parse
+
+EC2_NS = 'http://ec2.amazonaws.com/doc/2016-11-15/'
+ELBV2_NS = 'http://elasticloadbalancing.amazonaws.com/doc/2015-12-01/'
+REGIONS = ['us-east-1', 'us-east-2', 'us-west-1', 'us-west-2', 'eu-west-1',
+           'eu-west-2', 'eu-west-3', 'eu-central-1', 'eu-north-1',
+           'ap-northeast-1', 'ap-northeast-2', 'ap-northeast-3',
+           'ap-southeast-1', 'ap-southeast-2', 'ap-south-1', 'sa-east-1',
+           'ca-central-1']
+VOL_TYPES = ['gp2', 'gp3', 'io1', 'io2', 'st1', 'sc1', 'standard']
+LB_TYPES = ['application', 'network']
+# default page sizes when the request doesn't set one
+EC2_PAGE = 1000
+ELBV2_PAGE = 400
+# region of a request, from its SigV4 credential scope
+SCOPE = re.compile(r'Credential=[^/]+/\d+/([^/]+)/')
+
+
+class Account:
+    '''
+    the synthetic resources of each region, derived from their index so that
+    nothing is stored: every attached_every-th volume is attached, every
+    used_every-th LB has a target, and the snapshots alternate between
+    ones of live volumes, of deleted volumes and of AMIs
+    '''
+    def __init__(self, regions=4, volumes=1000, lbs=100, snapshots=0,
+                 attached_every=2, used_every=2):
+        self.regions = REGIONS[:regions]
+        self.volumes = volumes
+        self.lbs = lbs
+        self.snapshots = snapshots
+        self.attached_every = attached_every
+        self.used_every = used_every
+
+    def volume(self, region, i):
+        rng = random.Random(f'{region}/{i}')
+        vol_type = rng.choice(VOL_TYPES)
+        return {
+            'id': f'vol-{self.regions.index(region):02x}{i:015x}',
+            'type': vol_type,
+            'size': rng.randint(1, 16384),
+            'iops': rng.randint(100, 64000) if vol_type != 'standard' else 0,
+            'attached': i % self.attached_every == 0,
+        }
+
+    def lb_arn(self, region, i):
+        lb_type = LB_TYPES[i % len(LB_TYPES)]
+        kind = 'app' if lb_type == 'application' else 'net'
+        return (f'arn:aws:elasticloadbalancing:{region}:111111111111:'
+                f'loadbalancer/{kind}/lb-{i}/{i:016x}')
+
+    def tg_arn(self, region, i):
+        return (f'arn:aws:elasticloadbalancing:{region}:111111111111:'
+                f'targetgroup/tg-{i}/{i:016x}')
+
+    def lb_used(self, i):
+        return i % self.used_every == 0
+
+
+class FakeAWS:
+    '''
+    the HTTP server - counts the calls by action, sleeps latency seconds
+    per call and fails a throttle fraction of them with a throttling error
+    '''
+    def __init__(self, account, latency=0.0, throttle=0.0, seed=0):
+        self.account = account
+        self.latency = latency
+        self.throttle = throttle
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.throttled = 0
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      Handler)
+        self.server.fake = self
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def call(self, action):
+        '''
+        counts the call - returns whether to throttle it
+        '''
+        with self.lock:
+            self.calls[action] = self.calls.get(action, 0) + 1
+            throttled = self.rng.random() < self.throttle
+            self.throttled += throttled
+        return throttled
+
+    def respond(self, action, region, params):
+        return getattr(self, action)(region, params)
+
+    #
+    # EC2
+    #
+    def DescribeRegions(self, region, params):
+        items = ''.join(f'<item><regionName>{r}</regionName></item>'
+                        for r in self.account.regions)
+        return ec2_response('DescribeRegions',
+                            f'<regionInfo>{items}</regionInfo>')
+
+    def DescribeVolumes(self, region, params):
+        available = 'available' in filter_values(params, 'status')
+        start, end, token = page(params, self.account.volumes, EC2_PAGE)
+        items = []
+        for i in range(start, end):
+            v = self.account.volume(region, i)
+            if available and v['attached']:
+                continue
+            attachments = (f'<item><volumeId>{v["id"]}</volumeId>'
+                           f'<instanceId>i-{i:017x}</instanceId>'
+                           f'<status>attached</status></item>'
+                           if v['attached'] else '')
+            items.append(
+                f'<item><volumeId>{v["id"]}</volumeId>'
+                f'<size>{v["size"]}</size>'
+                f'<volumeType>{v["type"]}</volumeType>'
+                f'<iops>{v["iops"]}</iops>'
+                f'<status>{"in-use" if v["attached"] else "available"}'
+                f'</status><availabilityZone>{region}a</availabilityZone>'
+                f'<createTime>2021-11-01T12:00:00.000Z</createTime>'
+                f'<attachmentSet>{attachments}</attachmentSet>'
+                f'<tagSet><item><key>team</key><value>t{i % 8}</value>'
+                f'</item></tagSet></item>')
+        return ec2_response('DescribeVolumes',
+                            f'<volumeSet>{"".join(items)}</volumeSet>'
+                            + next_token(token))
+
+    def DescribeSnapshots(self, region, params):
+        start, end, token = page(params, self.account.snapshots, EC2_PAGE)
+        items = []
+        for i in range(start, end):
+            # of a live volume, of a deleted volume, or of an AMI
+            volume_id = (self.account.volume(region, i)['id']
+                         if i % 3 == 0 and i < self.account.volumes
+                         else f'vol-gone{i:012x}')
+            items.append(
+                f'<item><snapshotId>snap-{i:017x}</snapshotId>'
+                f'<volumeId>{volume_id}</volumeId>'
+                f'<status>completed</status>'
+                f'<startTime>2021-11-01T12:00:00.000Z</startTime>'
+                f'<volumeSize>{8 + i % 100}</volumeSize>'
+                f'<ownerId>111111111111</ownerId>'
+                f'<storageTier>standard</storageTier></item>')
+        return ec2_response('DescribeSnapshots',
+                            f'<snapshotSet>{"".join(items)}</snapshotSet>'
+                            + next_token(token))
+
+    def DescribeImages(self, region, params):
+        items = ''.join(
+            f'<item><imageId>ami-{i:017x}</imageId><blockDeviceMapping>'
+            f'<item><deviceName>/dev/xvda</deviceName><ebs><snapshotId>'
+            f'snap-{i:017x}</snapshotId></ebs></item></blockDeviceMapping>'
+            f'</item>'
+            for i in range(2, self.account.snapshots, 3))
+        return ec2_response('DescribeImages',
+                            f'<imagesSet>{items}</imagesSet>')
+
+    #
+    # ELBv2
+    #
+    def DescribeLoadBalancers(self, region, params):
+        start, end, marker = page(params, self.account.lbs, ELBV2_PAGE,
+                                  'Marker', 'PageSize')
+        members = ''.join(
+            f'<member><LoadBalancerArn>{self.account.lb_arn(region, i)}'
+            f'</LoadBalancerArn><LoadBalancerName>lb-{i}</LoadBalancerName>'
+            f'<Type>{LB_TYPES[i % len(LB_TYPES)]}</Type>'
+            f'<CreatedTime>2021-11-01T12:00:00.000Z</CreatedTime>'
+            f'<AvailabilityZones><member><ZoneName>{region}a</ZoneName>'
+            f'</member></AvailabilityZones></member>'
+            for i in range(start, end))
+        return elbv2_response(
+            'DescribeLoadBalancers',
+            f'<LoadBalancers>{members}</LoadBalancers>'
+            + (f'<NextMarker>{marker}</NextMarker>' if marker else ''))
+
+    def DescribeTargetGroups(self, region, params):
+        start, end, marker = page(params, self.account.lbs, ELBV2_PAGE,
+                                  'Marker', 'PageSize')
+        members = ''.join(
+            f'<member><TargetGroupArn>{self.account.tg_arn(region, i)}'
+            f'</TargetGroupArn><LoadBalancerArns><member>'
+            f'{self.account.lb_arn(region, i)}</member></LoadBalancerArns>'
+            f'</member>'
+            for i in range(start, end))
+        return elbv2_response(
+            'DescribeTargetGroups',
+            f'<TargetGroups>{members}</TargetGroups>'
+            + (f'<NextMarker>{marker}</NextMarker>' if marker else ''))
+
+    def DescribeTargetHealth(self, region, params):
+        i = int(params['TargetGroupArn'][0].rsplit('/', 1)[1], 16)
+        targets = ('<member><Target><Id>i-1</Id></Target></member>'
+                   if self.account.lb_used(i) else '')
+        return elbv2_response(
+            'DescribeTargetHealth',
+            f'<TargetHealthDescriptions>{targets}</TargetHealthDescriptions>')
+
+
+def page(params, total, default_size, token_name='NextToken',
+         size_name='MaxResults'):
+    '''
+    (start, end, next token or None) of the requested page
+    '''
+    start = int(params.get(token_name, ['0'])[0])
+    size = int(params.get(size_name, [default_size])[0])
+    end = min(start + size, total)
+    return start, end, (str(end) if end < total else None)
+
+
+def filter_values(params, name):
+    for key, value in params.items():
+        m = re.fullmatch(r'Filter\.(\d+)\.Name', key)
+        if m and value[0] == name:
+            return [v[0] for k, v in params.items()
+                    if k.startswith(f'Filter.{m.group(1)}.Value.')]
+    return []
+
+
+def next_token(token):
+    return f'<nextToken>{token}</nextToken>' if token else ''
+
+
+def ec2_response(action, body):
+    return (f'<{action}Response xmlns="{EC2_NS}"><requestId>fake</requestId>'
+            f'{body}</{action}Response>')
+
+
+def elbv2_response(action, body):
+    return (f'<{action}Response xmlns="{ELBV2_NS}"><{action}Result>{body}'
+            f'</{action}Result><ResponseMetadata><RequestId>fake</RequestId>'
+            f'</ResponseMetadata></{action}Response>')
+
+
+def throttling_error(action):
+    if action in ('DescribeLoadBalancers', 'DescribeTargetGroups',
+                  'DescribeTargetHealth'):
+        return ('<ErrorResponse><Error><Type>Sender</Type><Code>Throttling'
+                '</Code><Message>Rate exceeded</Message></Error>'
+                '<RequestId>fake</RequestId></ErrorResponse>')
+    return ('<Response><Errors><Error><Code>RequestLimitExceeded</Code>'
+            '<Message>Request limit exceeded.</Message></Error></Errors>'
+            '<RequestID>fake</RequestID></Response>')
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        fake = self.server.fake
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        params = urllib.parse.parse_qs(body.decode())
+        action = params['Action'][0]
+        m = SCOPE.search(self.headers.get('Authorization', ''))
+        region = m.group(1) if m else 'us-east-1'
+        if fake.latency:
+            time.sleep(fake.latency)
+        if fake.call(action):
+            status, response = 400, throttling_error(action)
+        else:
+            status, response = 200, fake.respond(action, region, params)
+        data = response.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
@@ -0,0 +1,100 @@
+'''
+generates aws_clutter/data/snapshot_pricing.json from the AWS Pricing API -
+the 'Storage Snapshot' products of AmazonEC2, per region and storage tier
+
+    python scripts/update_snapshot_pricing.py > \
+        aws_clutter/data/snapshot_pricing.json
+
+The China regions are priced by the aws-cn Pricing API, queried with the
+AWS profile in AWS_CN_PROFILE; without it they are left out (and their
+snapshots are reported as unpriced).
+'''
+import os
+import sys
+import json
+import boto3
+
+# usage type suffix -> storage tier
+TIERS = {
+    'EBS:SnapshotUsage': 'standard',
+    'EBS:SnapshotArchiveStorage': 'archive',
+}
+# the Pricing API endpoints of the partitions
+ENDPOINTS = {
+    'aws': 'us-east-1',
+    'aws-cn': 'cn-northwest-1',
+}
+PARTITIONS = ['aws', 'aws-us-gov', 'aws-cn']
+
+
+def partition(region):
+    if region.startswith('cn-'):
+        return 'aws-cn'
+    if region.startswith('us-gov-'):
+        return 'aws-us-gov'
+    return 'aws'
+
+
+def snapshot_products(session, pricing_region):
+    client = session.client('pricing', region_name=pricing_region)
+    paginator = client.get_paginator('get_products')
+    for page in paginator.paginate(ServiceCode='AmazonEC2', Filters=[{
+            'Type': 'TERM_MATCH', 'Field': 'productFamily',
+            'Value': 'Storage Snapshot'}]):
+        for product in page['PriceList']:
+            yield json.loads(product)
+
+
+def snapshot_prices(products):
+    '''
+    [{snapshot_prices, location, partition, rzCode, rzType}] of the regions
+    of the products, in the format of ebs_pricing.json
+    '''
+    prices = {}
+    for product in products:
+        attributes = product['product']['attributes']
+        tier = next((tier for suffix, tier in TIERS.items()
+                     if attributes.get('usagetype', '').endswith(suffix)),
+                    None)
+        region = attributes.get('regionCode')
+        if tier is None or region is None or \
+                attributes.get('locationType') != 'AWS Region':
+            continue
+        for term in product['terms'].get('OnDemand', {}).values():
+            for dimension in term['priceDimensions'].values():
+                if dimension['unit'] != 'GB-Mo':
+                    continue
+                entry = prices.setdefault(region, {
+                    'snapshot_prices': {},
+                    'location': attributes['location'],
+                    'partition': partition(region),
+                    'rzCode': region,
+                    'rzType': 'region'
+                })
+                entry['snapshot_prices'][tier] = {
+                    'pricePerGBMonth': dimension['pricePerUnit']
+                }
+    for entry in prices.values():
+        tiers = entry['snapshot_prices']
+        entry['snapshot_prices'] = {tier: tiers[tier]
+                                    for tier in TIERS.values()
+                                    if tier in tiers}
+    return sorted(prices.values(), key=lambda p: (
+        PARTITIONS.index(p['partition']), p['rzCode']))
+
+
+def main():
+    products = list(snapshot_products(boto3.Session(), ENDPOINTS['aws']))
+    if os.getenv('AWS_CN_PROFILE'):
+        products.extend(snapshot_products(
+            boto3.Session(profile_name=os.getenv('AWS_CN_PROFILE')),
+            ENDPOINTS['aws-cn']))
+    else:
+        print("AWS_CN_PROFILE not set: leaving out the China regions",
+              file=sys.stderr)
+    json.dump(snapshot_prices(products), sys.stdout, indent=4)
+    print()
+
+
+if __name__ == '__main__':
+    main()
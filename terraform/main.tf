@@ -77,7 +77,8 @@ data "aws_iam_policy_document" "lambda" {
       "logs:CreateLogGroup",
       "logs:CreateLogStream",
       "logs:PutLogEvents",
-      "cloudwatch:PutMetricData"
+      "cloudwatch:PutMetricData",
+      "cloudwatch:GetMetricData"
     ]
     effect    = "Allow"
     resources = ["*"]
@@ -87,11 +88,22 @@ data "aws_iam_policy_document" "lambda" {
     actions = [
       "ec2:DescribeRegions",
       "ec2:DescribeVolumes",
+      "ec2:DescribeSnapshots",
+      "ec2:DescribeImages",
       "elasticloadbalancing:DescribeLoadBalancers"
     ]
     effect    = "Allow"
     resources = ["*"]
   }
+
+  # the shards of a run (CK_SHARDS) are invocations of the function itself
+  statement {
+    actions = [
+      "lambda:InvokeFunction"
+    ]
+    effect    = "Allow"
+    resources = ["arn:aws:lambda:${data.aws_region.current.id}:${data.aws_caller_identity.current.account_id}:function:${local.function_name}"]
+  }
 }
 
 resource "aws_iam_policy" "lambda" {
@@ -118,7 +130,10 @@ resource "aws_lambda_function" "lambda" {
   # Env Vars
   environment {
     variables = {
-      DEBS_DIMS = var.DEBS_DIMS
+      DEBS_DIMS         = var.DEBS_DIMS
+      CK_SINK           = var.CK_SINK
+      CK_SHARDS         = var.CK_SHARDS
+      CK_SHARD_FUNCTION = local.function_name
     }
   }
 }
@@ -16,3 +16,14 @@ variable "DEBS_DIMS" {
   default     = "RZCode"
 }
 
+variable "CK_SINK" {
+  type        = string
+  description = "Where the Lambda function puts the metrics: 'cloudwatch' (PutMetricData calls) or 'emf' (Embedded Metric Format log lines, extracted by CloudWatch Logs)."
+  default     = "cloudwatch"
+}
+
+variable "CK_SHARDS" {
+  type        = string
+  description = "Shards of the scans, each run by its own invocation of the Lambda function and merged by the scheduled one ('0' for none)."
+  default     = "0"
+}
@@ -0,0 +1,195 @@
+import threading
+import urllib.parse
+import http.server
+import pytest
+import aws_clutter.clients as clients
+
+EC2_NS = 'http://ec2.amazonaws.com/doc/2016-11-15/'
+ELBV2_NS = 'http://elasticloadbalancing.amazonaws.com/doc/2015-12-01/'
+STS_NS = 'https://sts.amazonaws.com/doc/2011-06-15/'
+
+STUB_REGIONS = ['us-east-1', 'us-west-2']
+
+STUB_RESPONSES = {
+    'DescribeRegions': f'''
+<DescribeRegionsResponse xmlns="{EC2_NS}">
+  <requestId>stub</requestId>
+  <regionInfo>
+    {"".join(f"<item><regionName>{r}</regionName></item>"
+             for r in STUB_REGIONS)}
+  </regionInfo>
+</DescribeRegionsResponse>''',
+    'DescribeVolumes': f'''
+<DescribeVolumesResponse xmlns="{EC2_NS}">
+  <requestId>stub</requestId>
+  <volumeSet>
+    <item>
+      <volumeId>vol-detached</volumeId>
+      <size>100</size>
+      <volumeType>gp2</volumeType>
+      <status>available</status>
+      <createTime>2021-11-01T12:00:00.000Z</createTime>
+      <attachmentSet/>
+    </item>
+  </volumeSet>
+</DescribeVolumesResponse>''',
+    'DescribeLoadBalancers': f'''
+<DescribeLoadBalancersResponse xmlns="{ELBV2_NS}">
+  <DescribeLoadBalancersResult>
+    <LoadBalancers>
+      <member>
+        <LoadBalancerArn>arn:lb/used</LoadBalancerArn>
+        <Type>application</Type>
+        <AvailabilityZones><member><ZoneName>a</ZoneName></member>
+        </AvailabilityZones>
+      </member>
+      <member>
+        <LoadBalancerArn>arn:lb/unused</LoadBalancerArn>
+        <Type>network</Type>
+        <AvailabilityZones><member><ZoneName>a</ZoneName></member>
+        </AvailabilityZones>
+      </member>
+    </LoadBalancers>
+  </DescribeLoadBalancersResult>
+  <ResponseMetadata><RequestId>stub</RequestId></ResponseMetadata>
+</DescribeLoadBalancersResponse>''',
+    'DescribeTargetGroups': f'''
+<DescribeTargetGroupsResponse xmlns="{ELBV2_NS}">
+  <DescribeTargetGroupsResult>
+    <TargetGroups>
+      <member>
+        <TargetGroupArn>arn:tg/used</TargetGroupArn>
+        <LoadBalancerArns><member>arn:lb/used</member></LoadBalancerArns>
+      </member>
+      <member>
+        <TargetGroupArn>arn:tg/unused</TargetGroupArn>
+        <LoadBalancerArns><member>arn:lb/unused</member></LoadBalancerArns>
+      </member>
+    </TargetGroups>
+  </DescribeTargetGroupsResult>
+  <ResponseMetadata><RequestId>stub</RequestId></ResponseMetadata>
+</DescribeTargetGroupsResponse>''',
+    'DescribeSnapshots': f'''
+<DescribeSnapshotsResponse xmlns="{EC2_NS}">
+  <requestId>stub</requestId>
+  <snapshotSet>
+    <item>
+      <snapshotId>snap-orphaned</snapshotId>
+      <volumeId>vol-deleted</volumeId>
+      <status>completed</status>
+      <startTime>2021-11-01T12:00:00.000Z</startTime>
+      <volumeSize>100</volumeSize>
+      <ownerId>111111111111</ownerId>
+      <storageTier>standard</storageTier>
+    </item>
+    <item>
+      <snapshotId>snap-of-volume</snapshotId>
+      <volumeId>vol-detached</volumeId>
+      <status>completed</status>
+      <startTime>2021-11-01T12:00:00.000Z</startTime>
+      <volumeSize>100</volumeSize>
+      <ownerId>111111111111</ownerId>
+    </item>
+    <item>
+      <snapshotId>snap-of-image</snapshotId>
+      <volumeId>vol-deleted</volumeId>
+      <status>completed</status>
+      <startTime>2021-11-01T12:00:00.000Z</startTime>
+      <volumeSize>8</volumeSize>
+      <ownerId>111111111111</ownerId>
+    </item>
+  </snapshotSet>
+</DescribeSnapshotsResponse>''',
+    'DescribeImages': f'''
+<DescribeImagesResponse xmlns="{EC2_NS}">
+  <requestId>stub</requestId>
+  <imagesSet>
+    <item>
+      <imageId>ami-1</imageId>
+      <blockDeviceMapping>
+        <item>
+          <deviceName>/dev/xvda</deviceName>
+          <ebs><snapshotId>snap-of-image</snapshotId></ebs>
+        </item>
+        <item>
+          <deviceName>/dev/xvdb</deviceName>
+          <virtualName>ephemeral0</virtualName>
+        </item>
+      </blockDeviceMapping>
+    </item>
+  </imagesSet>
+</DescribeImagesResponse>''',
+    'AssumeRole': f'''
+<AssumeRoleResponse xmlns="{STS_NS}">
+  <AssumeRoleResult>
+    <Credentials>
+      <AccessKeyId>assumed</AccessKeyId>
+      <SecretAccessKey>assumed</SecretAccessKey>
+      <SessionToken>assumed</SessionToken>
+      <Expiration>2099-01-01T00:00:00Z</Expiration>
+    </Credentials>
+    <AssumedRoleUser>
+      <AssumedRoleId>AROASTUB:awsclutter</AssumedRoleId>
+      <Arn>arn:aws:sts::111111111111:assumed-role/stub/awsclutter</Arn>
+    </AssumedRoleUser>
+  </AssumeRoleResult>
+  <ResponseMetadata><RequestId>stub</RequestId></ResponseMetadata>
+</AssumeRoleResponse>''',
+}
+
+TARGET_HEALTH = '''
+<DescribeTargetHealthResponse xmlns="{ns}">
+  <DescribeTargetHealthResult>
+    <TargetHealthDescriptions>{targets}</TargetHealthDescriptions>
+  </DescribeTargetHealthResult>
+  <ResponseMetadata><RequestId>stub</RequestId></ResponseMetadata>
+</DescribeTargetHealthResponse>'''
+
+
+class StubAWSHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    answers the EC2, ELBv2 and STS query-protocol calls made by the scans
+    '''
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        params = urllib.parse.parse_qs(body.decode())
+        action = params['Action'][0]
+        self.server.calls.append(action)
+        if action == 'DescribeTargetHealth':
+            tg_arn = params['TargetGroupArn'][0]
+            targets = ('<member><Target><Id>i-1</Id></Target></member>'
+                       if tg_arn == 'arn:tg/used' else '')
+            response = TARGET_HEALTH.format(ns=ELBV2_NS, targets=targets)
+        else:
+            response = STUB_RESPONSES[action]
+        data = response.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_endpoint(monkeypatch):
+    '''
+    local stand-in for the AWS endpoints - returns the list of actions called
+    '''
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                             StubAWSHandler)
+    server.calls = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setenv('AWS_ENDPOINT_URL',
+                       f'http://127.0.0.1:{server.server_port}')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    clients.clear()
+    yield server.calls
+    clients.clear()
+    server.shutdown()
+    server.server_close()
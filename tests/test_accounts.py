@@ -0,0 +1,156 @@
+import json
+import asyncio
+import threading
+from click.testing import CliRunner
+import aws_clutter.accounts as accounts
+import aws_clutter.clients as clients
+import aws_clutter.cli as cli
+import aws_clutter.run as run
+import aws_clutter.scheduler as scheduler
+import aws_clutter.clutter.debs as debs
+
+
+def test_role_arns(tmp_path):
+    path = tmp_path / 'roles.txt'
+    path.write_text('# audit roles\n'
+                    'arn:aws:iam::333333333333:role/audit  # prod\n'
+                    '\n'
+                    '111111111111\n')
+    arns = accounts.role_arns(['111111111111,222222222222'], str(path),
+                              role_name='scanner')
+    assert(arns == ['arn:aws:iam::111111111111:role/scanner',
+                    'arn:aws:iam::222222222222:role/scanner',
+                    'arn:aws:iam::333333333333:role/audit'])
+    assert(accounts.account_id(arns[2]) == '333333333333')
+
+
+def test_merge():
+    merged = accounts.merge({
+        '1': {'debs': {'us-east-1': [{'VolumeId': 'a'}]}},
+        '2': {'debs': {'us-east-1': [{'VolumeId': 'b'}], 'us-west-2': []}},
+    })
+    assert(merged == {'debs': {
+        'us-east-1': [{'VolumeId': 'a', 'AccountId': '1'},
+                      {'VolumeId': 'b', 'AccountId': '2'}],
+        'us-west-2': []
+    }})
+
+
+def test_assume_role(stub_endpoint):
+    arn = 'arn:aws:iam::111111111111:role/scanner'
+    clients.assume_role(arn)
+    s = clients.session()
+    assert(clients.credentials_key(s) == arn)
+    assert(s.get_credentials().access_key == 'assumed')
+    clients.assume_role(None)
+    clients.assume_role(arn)
+    assert(stub_endpoint.count('AssumeRole') == 1)
+    clients.assume_role(None)
+    assert(clients.credentials_key(clients.session()) == 'testing')
+
+
+def test_assumed_role_per_scan(stub_endpoint):
+    # concurrent scans of different accounts, e.g. by `awsclutter serve`
+    arns = accounts.role_arns(['111111111111', '222222222222'])
+    barrier = threading.Barrier(2)
+    keys = {}
+
+    def scan_region(results, region):
+        barrier.wait(timeout=10)
+        results[region] = [clients.credentials_key(clients.session())]
+
+    def scan_account(role_arn):
+        async def scan():
+            async with scheduler.Scheduler(regions=['us-east-1'],
+                                           backend='threads') as s:
+                results = {}
+                await s.scan(scan_region, results)
+            return results
+
+        with clients.assumed_role(role_arn):
+            keys[role_arn] = asyncio.run(scan())['us-east-1']
+
+    threads = [threading.Thread(target=scan_account, args=(arn,))
+               for arn in arns]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert(keys == {arn: [arn] for arn in arns})
+    assert(clients._role.get() is None)
+
+
+def test_scan_accounts(stub_endpoint):
+    arns = accounts.role_arns(['111111111111', '222222222222'])
+    resources = run.scan_accounts(arns, ['debs'], workers=1)
+    assert(sorted(resources) == ['111111111111', '222222222222'])
+    assert(stub_endpoint.count('AssumeRole') == 2)
+    assert(clients._role.get() is None)
+    merged = accounts.merge(resources)
+    assert(sorted(v['AccountId'] for v in merged['debs']['us-east-1']) ==
+           ['111111111111', '222222222222'])
+
+
+def test_scan_accounts_processes(stub_endpoint):
+    arns = accounts.role_arns(['111111111111', '222222222222'])
+    resources = run.scan_accounts(arns, ['ulbs'], workers=2)
+    for account in ['111111111111', '222222222222']:
+        lbs = resources[account]['ulbs']['us-west-2']
+        assert([lb['LoadBalancerArn'] for lb in lbs] == ['arn:lb/unused'])
+
+
+def test_watch_accounts(stub_endpoint):
+    result = CliRunner().invoke(cli.cli, [
+        'watch', 'debs', '--dry-run', '--accounts', '111111111111',
+        '--accounts', '222222222222', '--account-workers', '1'])
+    assert(result.exit_code == 0)
+    metric_data = json.loads(result.stdout)
+    totals = [d for d in metric_data
+              if d['MetricName'] == 'DetachedEBSCount' and
+              all(dim['Name'] in ('AccountId',) for dim in d['Dimensions'])]
+    assert(sorted(d['Value'] for d in totals) == [2, 2, 4])
+    for d in metric_data:
+        names = [dim['Name'] for dim in d['Dimensions']]
+        if 'VolumeId' in names:
+            assert('AccountId' in names)
+
+
+def test_accounts_scan_errors(stub_endpoint, monkeypatch):
+    list_dvs_region = debs.list_dvs_region
+
+    def failing(dvs, region, compact=False):
+        if region == 'us-west-2':
+            raise RuntimeError('boom')
+        list_dvs_region(dvs, region, compact)
+
+    monkeypatch.setattr(debs, 'list_dvs_region', failing)
+    monkeypatch.setattr(scheduler, 'REGION_ATTEMPTS', 1)
+    arns = accounts.role_arns(['111111111111', '222222222222'])
+    metric_data, events = [], []
+    asyncio.run(run.get_metric_data(['debs'], metric_data, events=events,
+                                    role_arns=arns, workers=1))
+    errors = {tuple(dim['Value'] for dim in d['Dimensions']): d['Value']
+              for d in metric_data if d['MetricName'] == 'ScanErrors'}
+    assert(errors == {('debs',): 2.0, ('debs', '111111111111'): 1.0,
+                      ('debs', '222222222222'): 1.0})
+    assert([(e['AccountId'], e['Errors']) for e in events] == [
+        (account, {'us-west-2': 'RuntimeError: boom'})
+        for account in ['111111111111', '222222222222']])
+    result = CliRunner().invoke(cli.cli, [
+        'list', 'debs', '--accounts', '111111111111', '--account-workers',
+        '1'])
+    listing = json.loads(result.stdout)
+    assert(listing['debs']['regions'] == {
+        '111111111111': {'us-east-1': 'ok', 'us-west-2': 'failed'}})
+    assert(listing['debs']['errors'] == {
+        '111111111111': {'us-west-2': 'RuntimeError: boom'}})
+
+
+def test_sharded_accounts_scan_errors(stub_endpoint):
+    arns = accounts.role_arns(['111111111111', '222222222222'])
+    metric_data = asyncio.run(run.get_metric_data(['debs'], [],
+                                                  role_arns=arns, shards=2))
+    errors = [d for d in metric_data if d['MetricName'] == 'ScanErrors']
+    assert([[dim['Value'] for dim in d['Dimensions']] for d in errors] == [
+        ['debs'], ['debs', '111111111111'], ['debs', '222222222222']])
+    assert(all(d['Value'] == 0.0 for d in errors))
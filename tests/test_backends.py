@@ -0,0 +1,35 @@
+import asyncio
+import pytest
+import aws_clutter.run as run
+
+
+def scan(backend):
+    resources = asyncio.run(run.scan(['debs', 'ulbs'], backend))
+    return resources['debs'], resources['ulbs']
+
+
+def check_resources(dvs, ulbs):
+    assert(sorted(dvs) == sorted(ulbs) == ['us-east-1', 'us-west-2'])
+    for region in dvs:
+        assert([v['VolumeId'] for v in dvs[region]] == ['vol-detached'])
+        assert(dvs[region][0]['RZCode'] == region)
+        assert(dvs[region][0]['MonthlyCost'] > 0)
+        assert([lb['LoadBalancerArn'] for lb in ulbs[region]]
+               == ['arn:lb/unused'])
+
+
+def test_threads_backend(stub_endpoint):
+    check_resources(*scan('threads'))
+    assert(stub_endpoint.count('DescribeRegions') == 1)
+
+
+def test_async_backend(stub_endpoint):
+    pytest.importorskip('aiobotocore')
+    check_resources(*scan('async'))
+    assert(stub_endpoint.count('DescribeRegions') == 1)
+    assert(stub_endpoint.count('DescribeTargetHealth') == 4)
+
+
+def test_backends_agree(stub_endpoint):
+    pytest.importorskip('aiobotocore')
+    assert(scan('threads') == scan('async'))
@@ -0,0 +1,179 @@
+import time
+import asyncio
+import json
+from click.testing import CliRunner
+import aws_clutter.cli as cli
+import aws_clutter.run as run
+import aws_clutter.state as state
+import aws_clutter.cube as cube
+import aws_clutter.scheduler as scheduler
+import aws_clutter.clutter.debs as debs
+
+
+def test_list(stub_endpoint):
+    result = CliRunner().invoke(cli.cli, ['list'])
+    assert(result.exit_code == 0)
+    # indented as ever
+    assert(result.stdout.startswith('{\n    "debs": {\n'))
+    listing = json.loads(result.stdout)
+    # snaps only when asked for
+    assert(sorted(listing) == ['debs', 'ulbs'])
+    assert(listing['debs']['description'] == 'Detached EBS Volumes')
+    assert(sorted(listing['ulbs']['resources']) == ['us-east-1', 'us-west-2'])
+    assert(stub_endpoint.count('DescribeRegions') == 1)
+    assert(listing['debs']['regions'] == {'us-east-1': 'ok',
+                                          'us-west-2': 'ok'})
+    assert(listing['debs']['errors'] == {})
+
+
+def test_list_timing(stub_endpoint):
+    result = CliRunner().invoke(cli.cli, ['list', '--summary', '--timing'])
+    assert(result.exit_code == 0)
+    assert('[debs] Found 2 detached EBS volumes' in result.stdout)
+    assert('[ulbs] scanned 2 regions in' in result.stderr)
+    assert('[debs]   us-west-2:' in result.stderr)
+
+
+def test_watch_dry_run(stub_endpoint):
+    result = CliRunner().invoke(cli.cli, ['watch', '--dry-run'])
+    assert(result.exit_code == 0)
+    names = [m['MetricName'] for m in json.loads(result.stdout)]
+    assert(names.count('DetachedEBSCount') == 3)
+    assert(names.count('UnusedLBCount') == 3)
+
+
+def test_watch_emf(stub_endpoint):
+    result = CliRunner().invoke(cli.cli, ['watch', '--sink', 'emf'])
+    assert(result.exit_code == 0)
+    events = [json.loads(line) for line in result.stdout.splitlines()]
+    names = [m['Name'] for e in events
+             for d in e['_aws']['CloudWatchMetrics'] for m in d['Metrics']]
+    assert(names.count('DetachedEBSCount') == 3)
+    assert(names.count('UnusedLBCount') == 3)
+    for e in events:
+        for d in e['_aws']['CloudWatchMetrics']:
+            assert(d['Namespace'] == 'CloudKeep')
+            assert(all(name in e for names in d['Dimensions']
+                       for name in names))
+            assert(all(m['Name'] in e for m in d['Metrics']))
+
+
+def test_unknown_clutter_type():
+    result = CliRunner().invoke(cli.cli, ['watch', 'nope'])
+    assert(result.exit_code == 1)
+
+
+def test_get_metric_data_incremental(stub_endpoint):
+    store = state.MemoryStore()
+    for i in range(2):
+        metric_data, events = [], []
+        incremental = state.Incremental(store)
+        asyncio.run(run.get_metric_data(run.CLUTTER_TYPES, metric_data,
+                                        incremental=incremental,
+                                        events=events))
+        incremental.save()
+        assert(len(events) == (6 if i == 0 else 0))
+        # with a ScanErrors datum per clutter type
+        assert(len(metric_data) == 21)
+
+
+def test_incremental_keeps_other(stub_endpoint, monkeypatch):
+    # every volume is folded into the Other series of its region
+    monkeypatch.setattr(debs, 'DEBS_DIMS_DEFAULT', 'RZCode,VolumeId')
+    monkeypatch.setattr(cube, 'MIN_RESOURCE_COST', 1e9)
+    store = state.MemoryStore()
+    for i in range(2):
+        metric_data = []
+        incremental = state.Incremental(store)
+        asyncio.run(run.get_metric_data(['debs'], metric_data,
+                                        incremental=incremental))
+        incremental.save()
+        others = [d for d in metric_data
+                  if {'Name': 'VolumeId', 'Value': cube.OTHER}
+                  in d['Dimensions']]
+        assert(len(others) == 2)
+
+
+def test_watch_deadline(stub_endpoint):
+    result = CliRunner().invoke(cli.cli, ['watch', '--dry-run',
+                                          '--deadline', '600'])
+    assert(result.exit_code == 0)
+    complete = {m['Dimensions'][0]['Value']: m['Value']
+                for m in json.loads(result.stdout)
+                if m['MetricName'] == 'ScanComplete'}
+    assert(complete == {'debs': 1.0, 'ulbs': 1.0})
+
+
+def test_watch_shards(stub_endpoint):
+    result = CliRunner().invoke(cli.cli, ['watch', 'debs', '--dry-run',
+                                          '--shards', '2'])
+    assert(result.exit_code == 0)
+    names = [m['MetricName'] for m in json.loads(result.stdout)]
+    assert(names.count('DetachedEBSCount') == 3)
+    result = CliRunner().invoke(cli.cli, ['watch', '--shards', '2',
+                                          '--deadline', '600'])
+    assert(result.exit_code == 2)
+
+
+def test_get_metric_data_scan_errors(stub_endpoint, monkeypatch):
+    list_dvs_region = debs.list_dvs_region
+
+    def failing(dvs, region, compact=False):
+        if region == 'us-west-2':
+            raise RuntimeError('boom')
+        list_dvs_region(dvs, region, compact)
+
+    monkeypatch.setattr(debs, 'list_dvs_region', failing)
+    monkeypatch.setattr(scheduler, 'REGION_ATTEMPTS', 1)
+    metric_data, events = [], []
+    asyncio.run(run.get_metric_data(['debs'], metric_data, events=events))
+    assert(metric_data[-1]['MetricName'] == 'ScanErrors')
+    assert(metric_data[-1]['Value'] == 1.0)
+    assert(events[0]['Errors'] == {'us-west-2': 'RuntimeError: boom'})
+    # the other region is still in
+    counts = [d for d in metric_data if d['MetricName'] == 'DetachedEBSCount'
+              and not d['Dimensions']]
+    assert(counts[0]['Value'] == 1)
+
+
+def test_get_metric_data_partial(stub_endpoint):
+    metric_data, events = [], []
+    # already past
+    asyncio.run(run.get_metric_data(['debs'], metric_data, events=events,
+                                    deadline=time.monotonic()))
+    assert(metric_data[-1]['MetricName'] == 'ScanComplete')
+    assert(metric_data[-1]['Value'] == 0.0)
+    assert(metric_data[0]['MetricName'] == 'DetachedEBSCount')
+    assert(metric_data[0]['Value'] == 0)
+    assert(events[0]['Event'] == 'Partial')
+    assert(sorted(events[0]['Regions']) == ['us-east-1', 'us-west-2'])
+
+
+def test_list_ndjson(stub_endpoint):
+    result = CliRunner().invoke(cli.cli, ['list', 'debs', 'snaps', 'ulbs',
+                                          '--format', 'ndjson'])
+    assert(result.exit_code == 0)
+    records = [json.loads(line) for line in result.stdout.splitlines()]
+    resources = records[:-1]
+    assert(sorted((r['ClutterType'], r['RZCode']) for r in resources) == [
+        ('debs', 'us-east-1'), ('debs', 'us-west-2'),
+        ('snaps', 'us-east-1'), ('snaps', 'us-west-2'),
+        ('ulbs', 'us-east-1'), ('ulbs', 'us-west-2')])
+    assert(resources[0]['Resource']['MonthlyCost'] > 0)
+    summary = records[-1]['Summary']
+    assert(summary['debs']['Count'] == 2)
+    assert(summary['ulbs']['Regions'] == ['us-east-1', 'us-west-2'])
+    assert(summary['ulbs']['Errors'] == {})
+    assert(summary['debs']['MonthlyCost']['USD'] == sum(
+        r['Resource']['MonthlyCost'] for r in resources
+        if r['ClutterType'] == 'debs'))
+
+
+def test_scan_on_region(stub_endpoint):
+    completed = []
+    resources = asyncio.run(run.scan(
+        ['debs'], on_region=lambda ct, region, rs: completed.append(
+            (ct, region, len(rs)))))
+    assert(sorted(completed) == [('debs', 'us-east-1', 1),
+                                 ('debs', 'us-west-2', 1)])
+    assert(len(resources['debs']['us-east-1']) == 1)
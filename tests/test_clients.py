@@ -0,0 +1,86 @@
+import threading
+import pytest
+import botocore.hooks
+import aws_clutter.clients as clients
+import aws_clutter.instrument as instrument
+import aws_clutter.tools as tools
+
+
+@pytest.fixture(autouse=True)
+def fake_credentials(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    clients.clear()
+    yield
+    clients.clear()
+
+
+def test_client_reused():
+    c = clients.client('ec2', 'us-west-2')
+    assert(clients.client('ec2', 'us-west-2') is c)
+    assert(clients.client('ec2', 'us-east-2') is not c)
+    assert(clients.client('elbv2', 'us-west-2') is not c)
+    assert(c.meta.region_name == 'us-west-2')
+    # throttled calls are retried by botocore only
+    assert(c.meta.config.retries['mode'] == clients.RETRY_MODE == 'standard')
+    # and paced per (service, region)
+    assert(clients.bucket('ec2', 'us-west-2') is clients._buckets[
+        ('ec2', 'us-west-2')])
+    assert(clients.bucket('ec2', 'us-west-2') is not
+           clients.bucket('ec2', 'us-east-2'))
+
+
+def test_client_shared_across_threads():
+    found = []
+
+    def worker():
+        found.append((clients.session(), clients.client('ec2', 'eu-west-1')))
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert(len({id(s) for s, _ in found}) == 4)
+    assert(len({id(c) for _, c in found}) == 1)
+
+
+def test_pace():
+    events = botocore.hooks.HierarchicalEmitter()
+    bucket = tools.TokenBucket(10)
+    event = 'elastic-load-balancing-v2.DescribeTargetHealth'
+    for _ in range(2):
+        clients.pace(events, bucket, event)
+
+    def attempt(operation, code=None):
+        events.emit(f'before-send.{operation}', request=None)
+        events.emit(f'needs-retry.{operation}', response=(
+            None, {'Error': {'Code': code}} if code else {}))
+
+    # only the paced calls
+    attempt('elastic-load-balancing-v2.DescribeLoadBalancers', 'Throttling')
+    assert(bucket.rate == bucket.tokens == 10)
+    attempt(event, 'Throttling')
+    assert(round(bucket.rate) == 5)
+    assert(bucket.tokens < 10)
+
+
+def test_stop_at_deadline():
+    c = clients.client('ec2', 'us-west-2')
+    token = tools.DEADLINE.set(0.0)
+    try:
+        # before any request is sent
+        with pytest.raises(tools.DeadlineExceeded):
+            c.describe_regions()
+    finally:
+        tools.DEADLINE.reset(token)
+    # and recorded as a failed call
+    with instrument.recording() as r:
+        token = tools.DEADLINE.set(0.0)
+        try:
+            with pytest.raises(tools.DeadlineExceeded):
+                c.describe_regions()
+        finally:
+            tools.DEADLINE.reset(token)
+    assert([(s.calls, s.errors) for s in r.calls.values()] == [(1, 1)])
@@ -0,0 +1,187 @@
+import json
+import aws_clutter.cube as cube
+
+RESOURCES = {
+    'us-east-1': [
+        {'Id': 'a', 'Type': 'gp2', 'MonthlyCost': 1.0,
+         'MonthlyCostUnit': 'USD', 'Tags': [{'Key': 'team', 'Value': 'x'}]},
+        {'Id': 'b', 'Type': 'gp3', 'MonthlyCost': 2.0,
+         'MonthlyCostUnit': 'USD'},
+        {'Id': 'c', 'Type': 'gp2', 'MonthlyCost': 4.0,
+         'MonthlyCostUnit': 'USD', 'Tags': [{'Key': 'team', 'Value': 'y'}]},
+    ],
+    'us-west-2': [],
+    'cn-north-1': [
+        {'Id': 'd', 'Type': 'gp2', 'MonthlyCost': 8.0,
+         'MonthlyCostUnit': 'CNY', 'Tags': [{'Key': 'team', 'Value': 'x'}]},
+    ],
+}
+
+
+def test_parse_dims():
+    dims = cube.parse_dims(' Tag:team, VolumeType,,RZCode ')
+    assert(dims == ['Tag:team', 'VolumeType', 'RZCode'])
+    assert(cube.rollup_dims(dims, ['RZCode', 'VolumeType', 'AccountId']) ==
+           ['RZCode', 'VolumeType', 'Tag:team'])
+    assert(cube.tag_keys(dims) == {'team'})
+
+
+def test_rollups():
+    c = cube.Cube(['RZCode', 'VolumeType', 'Tag:team'],
+                  {'VolumeType': 'Type'}).add_all(RESOURCES)
+    assert(len(c.rollups) == 8)
+    assert(c.rollup() == {(): (4, {'USD': 7.0, 'CNY': 8.0})})
+    assert(c.rollup('VolumeType') == {('gp2',): (3, {'USD': 5.0, 'CNY': 8.0}),
+                                      ('gp3',): (1, {'USD': 2.0})})
+    # untagged resources are left out of the tag rollups
+    assert(c.rollup('Tag:team') == {('x',): (2, {'USD': 1.0, 'CNY': 8.0}),
+                                    ('y',): (1, {'USD': 4.0})})
+    assert(c.rollup('RZCode', 'VolumeType', 'Tag:team')[
+        ('us-east-1', 'gp2', 'x')] == (1, {'USD': 1.0}))
+
+
+def test_summary():
+    summary = cube.Cube(['RZCode']).add_all(RESOURCES).summary()
+    assert(summary == {
+        'USD': {'cost': 7.0, 'count': 3, 'rzs': ['us-east-1']},
+        'CNY': {'cost': 8.0, 'count': 1, 'rzs': ['cn-north-1']},
+    })
+    assert(cube.Cube(['RZCode']).add_all({}).summary() == {})
+
+
+def test_metric_data():
+    c = cube.Cube(['RZCode', 'VolumeType'], {'VolumeType': 'Type'},
+                  resource_dims=['RZCode', 'VolumeType', 'Id'])
+    metric_data = c.add_all(RESOURCES).metric_data('Count', 'Cost', 't')
+    rows = [(d['MetricName'], [(dim['Name'], dim['Value'])
+                               for dim in d['Dimensions']], d['Value'])
+            for d in metric_data]
+    east = [('RZCode', 'us-east-1')]
+    usd = [('Currency', 'USD')]
+    assert(rows[:9] == [
+        ('Cost', usd + east + [('VolumeType', 'gp2'), ('Id', 'a')], 1.0),
+        ('Cost', usd + east + [('VolumeType', 'gp3'), ('Id', 'b')], 2.0),
+        ('Cost', usd + east + [('VolumeType', 'gp2'), ('Id', 'c')], 4.0),
+        ('Count', east, 3),
+        ('Cost', usd + east, 7.0),
+        ('Count', east + [('VolumeType', 'gp2')], 2),
+        ('Cost', usd + east + [('VolumeType', 'gp2')], 5.0),
+        ('Count', east + [('VolumeType', 'gp3')], 1),
+        ('Cost', usd + east + [('VolumeType', 'gp3')], 2.0),
+    ])
+    assert(rows[-3:] == [
+        ('Count', [], 4),
+        ('Cost', usd, 7.0),
+        ('Cost', [('Currency', 'CNY')], 8.0),
+    ])
+
+
+def test_empty():
+    metric_data = cube.Cube(['RZCode']).add_all({'us-east-1': []}) \
+        .metric_data('Count', 'Cost', 't')
+    assert([(d['MetricName'], d['Value']) for d in metric_data] ==
+           [('Count', 0)])
+
+
+def test_unpriced():
+    resources = {'eu-west-3': [
+        {'Id': 'a', 'Type': 'io2'},
+        {'Id': 'b', 'Type': 'gp2', 'MonthlyCost': 1.0,
+         'MonthlyCostUnit': 'USD'},
+    ]}
+    c = cube.Cube(['RZCode', 'VolumeType'], {'VolumeType': 'Type'},
+                  resource_dims=['RZCode', 'VolumeType', 'Id'])
+    metric_data = c.add_all(resources).metric_data('Count', 'Cost', 't')
+    assert(c.rollup() == {(): (2, {'USD': 1.0})})
+    assert(c.rollup('VolumeType')[('io2',)] == (1, {}))
+    assert(all(dim['Value'] is not None
+               for d in metric_data for dim in d['Dimensions']))
+    assert(len([d for d in metric_data if d['MetricName'] == 'Cost']) == 5)
+
+
+def test_top_resources():
+    resources = {'us-east-1': [
+        {'Id': f'v{i}', 'Type': 'gp2', 'MonthlyCost': float(i % 7),
+         'MonthlyCostUnit': 'USD'} for i in range(100)
+    ], 'us-west-2': [
+        {'Id': 'w', 'Type': 'gp3', 'MonthlyCost': 6.0,
+         'MonthlyCostUnit': 'USD'},
+    ]}
+
+    def resource_costs(**kwargs):
+        c = cube.Cube(['RZCode'], {'VolumeType': 'Type'},
+                      resource_dims=['RZCode', 'VolumeType', 'Id'], **kwargs)
+        return [([dim['Value'] for dim in d['Dimensions']], d['Value'])
+                for d in c.add_all(resources).metric_data('Count', 'Cost',
+                                                          't')
+                if d['MetricName'] == 'Cost' and len(d['Dimensions']) == 4]
+
+    assert(len(resource_costs()) == 101)
+    # the most expensive across the regions (on equal costs, of the first
+    # region by name, then the first ones), and the rest summed per region
+    assert(resource_costs(top=3) == [
+        (['USD', 'us-east-1', 'gp2', 'v6'], 6.0),
+        (['USD', 'us-east-1', 'gp2', 'v13'], 6.0),
+        (['USD', 'us-east-1', 'gp2', 'v20'], 6.0),
+        (['USD', 'us-east-1', 'gp2', 'Other'], 295.0 - 18.0),
+        (['USD', 'us-west-2', 'gp3', 'Other'], 6.0),
+    ])
+    assert(resource_costs(min_cost=6.0) == [
+        *[(['USD', 'us-east-1', 'gp2', f'v{i}'], 6.0)
+          for i in range(6, 100, 7)],
+        (['USD', 'us-east-1', 'gp2', 'Other'], 295.0 - 84.0),
+        (['USD', 'us-west-2', 'gp3', 'w'], 6.0),
+    ])
+    assert(resource_costs(top=0) == [
+        (['USD', 'us-east-1', 'gp2', 'Other'], 295.0),
+        (['USD', 'us-west-2', 'gp3', 'Other'], 6.0),
+    ])
+
+
+def test_merge():
+    dims = ['RZCode', 'VolumeType']
+    resource_dims = ['RZCode', 'VolumeType', 'Id']
+    resources = {region: [
+        {'Id': f'{region}-{i}', 'Type': f'gp{i % 3 + 1}',
+         'MonthlyCost': 0.1 * (i % 11), 'MonthlyCostUnit': 'USD'}
+        for i in range(1000)
+    ] for region in ['us-east-1', 'us-west-2', 'eu-west-1']}
+
+    def rows(c):
+        return sorted((d['MetricName'], [(dim['Name'], dim['Value'])
+                                         for dim in d['Dimensions']],
+                       d['Value'])
+                      for d in c.metric_data('Count', 'Cost', 't'))
+
+    for top in [None, 10]:
+        whole = cube.Cube(dims, {'VolumeType': 'Type'}, resource_dims, top)
+        whole.add_all(resources)
+        merged = cube.Cube(dims, {'VolumeType': 'Type'}, resource_dims, top)
+        for region in reversed([*resources]):
+            part = cube.Cube(dims, {'VolumeType': 'Type'}, resource_dims,
+                             top)
+            part.add_region(region, resources[region])
+            # through JSON, as from a Lambda invocation
+            merged.merge(json.loads(json.dumps(part.state())))
+        # exactly equal, whatever the order of the parts
+        assert(rows(merged) == rows(whole))
+
+
+def test_summation_order():
+    def usd(*costs):
+        return [{'MonthlyCost': cost, 'MonthlyCostUnit': 'USD'}
+                for cost in costs]
+
+    resources = {'us-west-2': usd(1.0), 'us-east-1': usd(*[0.1] * 10),
+                 'eu-west-1': usd(1e16)}
+    c = cube.Cube(['RZCode']).add_all(resources)
+    # left to right within a region, as ever
+    assert(c.rollup('RZCode')[('us-east-1',)] ==
+           (10, {'USD': sum([0.1] * 10)}))
+    # then the regional sums, in the order of the region names
+    assert(c.rollup()[()] == (12, {'USD': 1e16 + sum([0.1] * 10) + 1.0}))
+    assert(c.rollup()[()] != (12, {'USD': 1.0 + sum([0.1] * 10) + 1e16}))
+    # whatever the order the regions come in
+    reordered = cube.Cube(['RZCode']).add_all(dict(reversed(
+        [*resources.items()])))
+    assert(reordered.rollup() == c.rollup())
@@ -1,5 +1,7 @@
 import pytest
 import math
+import pickle
+import random
 import aws_clutter.clutter.debs as debs
 
 
@@ -81,3 +83,74 @@ def test_enrich_vol_info(test_data):
     assert(vol['MonthlyCostUnit'] == test_data['expectedMonthlyCostUnit'])
     assert(math.isclose(vol['MonthlyCost'], test_data['expectedMonthlyCost'],
                         rel_tol=0.001))
+
+
+def synthetic_volumes(n):
+    rng = random.Random(42)
+    vol_types = [*debs.COST_FUNCTIONS, 'unknown']
+    return [{
+        'VolumeId': f'vol-{i}',
+        'VolumeType': rng.choice(vol_types),
+        'Size': rng.randint(1, 16384),
+        'Iops': rng.choice([100, 3000, 3001, 16000, 32000, 32001, 64000,
+                            64001, 256000]),
+        'Throughput': rng.choice([125, 126, 1000])
+    } for i in range(n)]
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_get_costs(use_numpy, monkeypatch, capsys):
+    if use_numpy:
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(debs, 'numpy', None)
+    for region in ['us-east-1', 'eu-west-1', 'cn-north-1', 'nowhere-1']:
+        volumes = synthetic_volumes(500)
+        costs = debs.get_costs(volumes, region)
+        for volume, cost in zip(volumes, costs):
+            # reference: the per-volume get_cost_* functions
+            expected = dict(volume)
+            debs.enrich_vol_info(expected, region)
+            if 'MonthlyCost' not in expected:
+                assert(cost is None)
+            else:
+                assert(cost == (expected['MonthlyCostUnit'],
+                                expected['MonthlyCost']))
+    capsys.readouterr()
+
+
+def test_enrich_vols():
+    volumes = [{'VolumeId': 'vol-1', 'VolumeType': 'gp2', 'Size': 100}]
+    debs.enrich_vols(volumes, 'us-west-1')
+    assert(volumes[0]['RZCode'] == 'us-west-1')
+    assert(volumes[0]['MonthlyCostUnit'] == 'USD')
+    assert(math.isclose(volumes[0]['MonthlyCost'], 12.00, rel_tol=0.001))
+
+
+@pytest.mark.parametrize("compact", [True, False])
+def test_volume_collector(compact):
+    collector = debs.VolumeCollector('us-east-1', compact, batch_size=7)
+    volumes = synthetic_volumes(50)
+    for i, volume in enumerate(volumes):
+        volume['Attachments'] = [{'InstanceId': 'i-1'}] if i % 5 == 0 else []
+        collector.add(dict(volume))
+    records = collector.done()
+    assert([r['VolumeId'] for r in records] ==
+           [v['VolumeId'] for i, v in enumerate(volumes) if i % 5])
+    assert(all(isinstance(r, debs.Volume) == compact for r in records))
+    priced = {'us-east-1': [r for r in records if 'MonthlyCost' in r]}
+    metric_data = debs.aggregate(priced)
+    assert(metric_data[-2]['Value'] == len(priced['us-east-1']))
+
+
+def test_volume_pickle():
+    vol = debs.Volume({'VolumeId': 'vol-1', 'VolumeType': 'gp2',
+                       'RZCode': 'us-east-1', 'MonthlyCost': 1.5,
+                       'MonthlyCostUnit': 'USD', 'Size': 15})
+    vol['AccountId'] = '111111111111'
+    copy = pickle.loads(pickle.dumps(vol))
+    assert(copy['MonthlyCost'] == 1.5)
+    assert(copy['AccountId'] == '111111111111')
+    assert('Size' not in copy)
+    with pytest.raises(KeyError):
+        copy['Size']
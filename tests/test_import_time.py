@@ -0,0 +1,50 @@
+import os
+import sys
+import subprocess
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# cumulative import time budget of the Lambda entry point (app.handler)
+IMPORT_BUDGET_MS = int(os.getenv('CK_IMPORT_BUDGET_MS', default='250'))
+DEFERRED_MODULES = ['boto3', 'botocore.session', 'click', 'pendulum', 'numpy',
+                    'aiobotocore', 'aws_clutter.clutter.debs',
+                    'aws_clutter.clutter.ulbs', 'aws_clutter.clutter.snaps',
+                    'aws_clutter.cli']
+
+
+def import_times(module):
+    '''
+    cumulative import times (in ms) from `python -X importtime`
+    '''
+    r = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                        f'import {module}'],
+                       cwd=ROOT, capture_output=True, text=True, check=True)
+    times = {}
+    for line in r.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        times[name.strip()] = int(cumulative) / 1000
+    return times
+
+
+@pytest.fixture(scope='module')
+def app_import_times():
+    import_times('app')  # warm up the bytecode cache
+    return import_times('app')
+
+
+def test_heavy_imports_deferred(app_import_times):
+    assert([m for m in DEFERRED_MODULES if m in app_import_times] == [])
+
+
+def test_import_budget(app_import_times):
+    assert(app_import_times['app'] < IMPORT_BUDGET_MS)
+
+
+def test_shards_with_state_rejected():
+    env = dict(os.environ, CK_SHARDS='2', CK_STATE='s3://bucket/state.json')
+    r = subprocess.run([sys.executable, '-c', 'import app'], cwd=ROOT,
+                       env=env, capture_output=True, text=True)
+    assert(r.returncode != 0)
+    assert("CK_SHARDS doesn't go with CK_STATE" in r.stderr)
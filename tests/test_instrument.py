@@ -0,0 +1,62 @@
+import json
+import boto3
+import pytest
+from click.testing import CliRunner
+import aws_clutter.cli as cli
+import aws_clutter.instrument as instrument
+
+
+def test_percentile():
+    stats = instrument.CallStats()
+    for seconds, bucket in [(0.005, 0), (0.02, 1), (0.02, 1), (3.0, 8)]:
+        stats.calls += 1
+        stats.buckets[bucket] += 1
+        stats.max_seconds = max(stats.max_seconds, seconds)
+    assert(stats.percentile(50) == 0.025)
+    assert(stats.percentile(99) == 3.0)
+
+
+@pytest.mark.parametrize("backend", ['threads', 'async'])
+def test_profile(backend, stub_endpoint):
+    if backend == 'async':
+        pytest.importorskip('aiobotocore')
+    result = CliRunner().invoke(cli.cli, ['watch', 'debs', 'snaps', 'ulbs',
+                                          '--dry-run', '--profile',
+                                          '--self-metrics', '--backend',
+                                          backend])
+    assert(result.exit_code == 0)
+    assert(instrument.recorder() is None)
+    assert('[profile] discover:' in result.stderr)
+    # debs and snaps
+    assert('[profile] ec2.DescribeVolumes us-west-2: 2 calls (2 pages)'
+           in result.stderr)
+    assert('[profile] elbv2.DescribeTargetHealth us-east-1: 2 calls '
+           '(0 pages)' in result.stderr)
+    metric_data = json.loads(result.stdout)
+    calls = {tuple(d['Value'] for d in m['Dimensions']): m['Value']
+             for m in metric_data if m['MetricName'] == 'ApiCalls'}
+    assert(calls[('ec2', 'DescribeRegions')] == 1)
+    assert(calls[('ec2', 'DescribeVolumes')] == 4)
+    stages = [m['Dimensions'][0]['Value'] for m in metric_data
+              if m['MetricName'] == 'StageSeconds']
+    assert(sorted(stages) == ['aggregate', 'discover', 'enrich', 'scan'])
+
+
+def test_throttles():
+    model = boto3.client('cloudwatch', region_name='us-east-1').meta \
+        .service_model.operation_model('PutMetricData')
+    context = {'client_region': 'us-east-1'}
+    throttled = (None, {'Error': {'Code': 'Throttling'}})
+    with instrument.recording() as recorder:
+        instrument.before_call(model=model, params={}, context=context)
+        for response in [throttled, throttled, None]:
+            instrument.needs_retry(operation=model,
+                                   request_dict={'context': context},
+                                   response=response)
+        instrument.after_call_error(model=model, context=context)
+    stats = recorder.calls[('cloudwatch', 'PutMetricData', 'us-east-1')]
+    assert((stats.calls, stats.errors, stats.throttles, stats.pages) ==
+           (1, 1, 2, 0))
+    # not recording anymore
+    instrument.after_call_error(model=model, context=context)
+    assert(stats.calls == 1)
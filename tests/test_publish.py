@@ -0,0 +1,131 @@
+import datetime
+import threading
+import pytest
+import boto3
+import botocore.exceptions
+from botocore.stub import Stubber
+import aws_clutter.publish as publish
+
+TIMESTAMP = datetime.datetime(2021, 11, 1, 12, 0, 0)
+
+
+def datum(i, name='DetachedEBSMonthlyCost', dims=None):
+    return {
+        'MetricName': name,
+        'Dimensions': dims if dims is not None else [
+            {'Name': 'VolumeId', 'Value': f'vol-{i:05d}'}
+        ],
+        'Timestamp': TIMESTAMP,
+        'Unit': 'None',
+        'Value': float(i)
+    }
+
+
+def test_batches_datum_limit():
+    sizes = [len(b) for b in publish.batches([datum(i) for i in range(2500)])]
+    assert(sizes == [1000, 1000, 500])
+
+
+def test_batches_payload_limit():
+    metric_data = [dict(datum(i), Value=1.0) for i in range(100)]
+    size = publish.estimate_size(metric_data[0])
+    sizes = [len(b) for b in publish.batches(metric_data,
+                                             max_payload_bytes=size * 30)]
+    assert(sizes == [30, 30, 30, 10])
+
+
+def test_put_metric_data_stubbed():
+    client = boto3.client('cloudwatch', region_name='us-east-1',
+                          aws_access_key_id='testing',
+                          aws_secret_access_key='testing')
+    metric_data = [datum(i) for i in range(2001)]
+    with Stubber(client) as stubber:
+        for i in range(0, 2001, 1000):
+            stubber.add_response('put_metric_data', {}, {
+                'Namespace': 'CloudKeep',
+                'MetricData': metric_data[i:i+1000]
+            })
+        publish.put_metric_data(client, 'CloudKeep', metric_data,
+                                concurrency=1)
+        stubber.assert_no_pending_responses()
+
+
+class FlakyCloudWatchClient:
+    def __init__(self, failures):
+        self.failures = failures
+        self.lock = threading.Lock()
+        self.sent = []
+
+    def put_metric_data(self, Namespace, MetricData):
+        with self.lock:
+            if self.failures:
+                self.failures -= 1
+                raise botocore.exceptions.ClientError(
+                    {'Error': {'Code': 'Throttling'}}, 'PutMetricData')
+            self.sent.extend(MetricData)
+
+
+def test_put_metric_data_failed_batch():
+    # the batch still failing after the client's retries
+    client = FlakyCloudWatchClient(failures=1)
+    metric_data = [datum(i) for i in range(3500)]
+    with pytest.raises(botocore.exceptions.ClientError):
+        publish.put_metric_data(client, 'CloudKeep', metric_data,
+                                concurrency=1)
+    # the other batches are sent
+    assert(sorted(d['Value'] for d in client.sent) ==
+           [float(i) for i in range(1000, 3500)])
+
+
+def test_put_metric_data_gives_up():
+    client = FlakyCloudWatchClient(failures=100)
+    with pytest.raises(botocore.exceptions.ClientError):
+        publish.put_metric_data(client, 'CloudKeep', [datum(1)])
+
+
+def test_compact_metric_data():
+    dims = [{'Name': 'RZCode', 'Value': 'us-east-1'}]
+    metric_data = [datum(1, dims=dims), datum(1, dims=dims),
+                   datum(2, dims=dims), datum(3)]
+    compacted = publish.compact_metric_data(metric_data)
+    assert(compacted[0]['Values'] == [1.0, 2.0])
+    assert(compacted[0]['Counts'] == [2.0, 1.0])
+    assert('Value' not in compacted[0])
+    assert(compacted[1] == datum(3))
+
+
+def test_emf_events():
+    dims = [{'Name': 'RZCode', 'Value': 'us-east-1'}]
+    metric_data = ([datum(i, 'DetachedEBSCount', dims) for i in range(150)] +
+                   [datum(1, dims=dims), datum(2)] +
+                   [datum(i, f'Metric{i}', dims=[]) for i in range(120)])
+    events = [*publish.emf_events('CloudKeep', metric_data)]
+    assert(len(events) == 5)
+    assert(events[0]['_aws'] == {
+        'Timestamp': 1635768000000,
+        'CloudWatchMetrics': [{
+            'Namespace': 'CloudKeep',
+            'Dimensions': [['RZCode']],
+            'Metrics': [{'Name': 'DetachedEBSCount', 'Unit': 'None'},
+                        {'Name': 'DetachedEBSMonthlyCost', 'Unit': 'None'}]
+        }]
+    })
+    assert(events[0]['RZCode'] == 'us-east-1')
+    # the values of a metric in arrays of up to 100, single values as is
+    assert(events[0]['DetachedEBSCount'] == [float(i) for i in range(100)])
+    assert(events[0]['DetachedEBSMonthlyCost'] == 1.0)
+    assert(events[1]['DetachedEBSCount'] == [float(i)
+                                             for i in range(100, 150)])
+    assert('DetachedEBSMonthlyCost' not in events[1])
+    assert(events[2]['VolumeId'] == 'vol-00002')
+    # up to 100 metrics per event
+    assert(events[3]['_aws']['CloudWatchMetrics'][0]['Dimensions'] == [[]])
+    assert([len(e['_aws']['CloudWatchMetrics'][0]['Metrics'])
+            for e in events[3:]] == [100, 20])
+
+
+def test_emf_events_compacted():
+    metric_data = publish.compact_metric_data([datum(1), datum(1), datum(2)])
+    events = [*publish.emf_events('CloudKeep', metric_data)]
+    assert(events[0]['DetachedEBSMonthlyCost'] == [1.0, 1.0])
+    assert(events[1]['DetachedEBSMonthlyCost'] == 2.0)
@@ -0,0 +1,149 @@
+import time
+import asyncio
+import botocore.exceptions
+import aws_clutter.tools as tools
+import aws_clutter.scheduler as scheduler
+
+
+def test_regions_discovered_once(monkeypatch):
+    calls = []
+
+    def fake_list_regions():
+        calls.append(1)
+        return ['us-east-1', 'us-west-2']
+
+    def scan_region(results, region):
+        results[region] = [region]
+
+    async def run(s, debs, ulbs):
+        await asyncio.gather(s.scan(scan_region, debs),
+                             s.scan(scan_region, ulbs))
+
+    monkeypatch.setattr(scheduler, 'list_regions', fake_list_regions)
+    debs, ulbs = {}, {}
+    with scheduler.Scheduler(max_workers=2) as s:
+        asyncio.run(run(s, debs, ulbs))
+        executor = s.executor
+    assert(len(calls) == 1)
+    assert(debs == ulbs == {'us-east-1': ['us-east-1'],
+                            'us-west-2': ['us-west-2']})
+    assert(executor._shutdown)
+
+
+def test_run_scan_private_scheduler(monkeypatch):
+    results = {}
+
+    def scan_region(results, region):
+        results[region] = []
+
+    monkeypatch.setattr(scheduler, 'list_regions', lambda: ['eu-west-1'])
+    asyncio.run(scheduler.run_scan(scan_region, results))
+    assert(results == {'eu-west-1': []})
+
+
+def test_deadline(monkeypatch):
+    started = []
+
+    def scan_region(results, region):
+        started.append(region)
+        if region == 'slow-1':
+            # pages until the deadline stops it
+            while True:
+                time.sleep(0.01)
+                tools.check_deadline()
+        results[region] = [region]
+
+    async def run(s, results):
+        s.deadline = time.monotonic() + 0.5
+        await s.scan(scan_region, results, name='debs')
+
+    monkeypatch.setattr(scheduler, 'list_regions',
+                        lambda: ['us-east-1', 'slow-1', 'us-west-2'])
+    results = {}
+    with scheduler.Scheduler(max_workers=1) as s:
+        s.region_order = {'debs': ['slow-1', 'us-west-2']}
+        asyncio.run(run(s, results))
+    # the regions not in the order first
+    assert(started == ['us-east-1', 'slow-1'])
+    assert(results == {'us-east-1': ['us-east-1']})
+    assert(s.timings['debs']['unfinished'] == ['slow-1', 'us-west-2'])
+    assert(s.expired)
+
+
+def test_region_failures(monkeypatch):
+    attempts = []
+
+    def scan_region(results, region):
+        attempts.append(region)
+        if region == 'bad-1' or (region == 'flaky-1' and
+                                 attempts.count(region) == 1):
+            raise ConnectionResetError('boom')
+        results[region] = [region]
+
+    async def run(s, debs, ulbs):
+        await s.scan(scan_region, debs, name='debs')
+        await s.scan(scan_region, ulbs, name='ulbs')
+
+    monkeypatch.setattr(scheduler, 'list_regions',
+                        lambda: ['us-east-1', 'flaky-1', 'bad-1'])
+    monkeypatch.setattr(scheduler, 'REGION_ATTEMPTS', 2)
+    monkeypatch.setattr(scheduler, 'REGION_BACKOFF', 0.0)
+    debs, ulbs = {}, {}
+    with scheduler.Scheduler(max_workers=1) as s:
+        s.breaker = scheduler.CircuitBreaker(failures=2)
+        asyncio.run(run(s, debs, ulbs))
+    # retried once, then left out
+    assert(debs == {'us-east-1': ['us-east-1'], 'flaky-1': ['flaky-1']})
+    assert(s.timings['debs']['status'] == {
+        'us-east-1': 'ok', 'flaky-1': 'ok', 'bad-1': 'failed'})
+    assert(s.timings['debs']['errors'] ==
+           {'bad-1': 'ConnectionResetError: boom'})
+    # not scanned again once its breaker is open
+    assert(attempts.count('bad-1') == 2)
+    assert(sorted(ulbs) == ['flaky-1', 'us-east-1'])
+    assert(s.timings['ulbs']['errors'] == {'bad-1': 'circuit open'})
+
+
+def test_region_errors_not_retried(monkeypatch):
+    attempts = []
+
+    def scan_region(results, region):
+        attempts.append(region)
+        raise botocore.exceptions.ClientError(
+            {'Error': {'Code': 'OptInRequired'}}, 'DescribeVolumes')
+
+    monkeypatch.setattr(scheduler, 'list_regions', lambda: ['bad-1'])
+    monkeypatch.setattr(scheduler, 'REGION_ATTEMPTS', 3)
+    debs = {}
+    with scheduler.Scheduler(max_workers=1) as s:
+        asyncio.run(s.scan(scan_region, debs, name='debs'))
+    assert(attempts == ['bad-1'])
+    assert(s.timings['debs']['status'] == {'bad-1': 'failed'})
+
+
+def test_breaker_trips_concurrent_scans(monkeypatch):
+    attempts = []
+
+    async def scan_region(aio, results, region):
+        attempts.append(region)
+        # the scans of the other clutter types have all started
+        await asyncio.sleep(0)
+        raise botocore.exceptions.ClientError(
+            {'Error': {'Code': 'Throttling'}}, 'DescribeVolumes')
+
+    async def run():
+        async with scheduler.Scheduler(regions=['bad-1'],
+                                       backend='async') as s:
+            s.breaker = scheduler.CircuitBreaker(failures=3)
+            await asyncio.gather(*[s.scan(None, {}, scan_region, name=name)
+                                   for name in ['debs', 'snaps', 'ulbs']])
+        return s
+
+    monkeypatch.setattr(scheduler, 'REGION_ATTEMPTS', 5)
+    monkeypatch.setattr(scheduler, 'REGION_BACKOFF', 0.0)
+    s = asyncio.run(run())
+    # dispatched before any failure, but not retried once the breaker is open
+    assert(attempts == ['bad-1'] * 3)
+    errors = sorted(timing['errors']['bad-1'] for timing in s.timings.values())
+    assert(errors[0].startswith('ClientError:'))
+    assert(errors[1:] == ['circuit open'] * 2)
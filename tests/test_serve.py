@@ -0,0 +1,75 @@
+import asyncio
+import threading
+import urllib.error
+import urllib.request
+import pytest
+import aws_clutter.serve as serve
+
+
+def test_prometheus_text():
+    metric_data = [
+        {'MetricName': 'DetachedEBSCount', 'Value': 2,
+         'Dimensions': [{'Name': 'RZCode', 'Value': 'us-east-1'}]},
+        {'MetricName': 'DetachedEBSMonthlyCost', 'Value': 1.5,
+         'Dimensions': [{'Name': 'Currency', 'Value': 'USD'},
+                        {'Name': 'Tag:team', 'Value': 'a "b"'}]},
+        {'MetricName': 'DetachedEBSCount', 'Value': 3, 'Dimensions': []},
+    ]
+    assert(serve.prometheus_text(metric_data, 'CloudKeep').splitlines() == [
+        '# HELP cloud_keep_detached_ebs_count DetachedEBSCount',
+        '# TYPE cloud_keep_detached_ebs_count gauge',
+        'cloud_keep_detached_ebs_count{rz_code="us-east-1"} 2.0',
+        'cloud_keep_detached_ebs_count 3.0',
+        '# HELP cloud_keep_detached_ebs_monthly_cost DetachedEBSMonthlyCost',
+        '# TYPE cloud_keep_detached_ebs_monthly_cost gauge',
+        'cloud_keep_detached_ebs_monthly_cost{currency="USD",'
+        'tag_team="a \\"b\\""} 1.5',
+    ])
+
+
+def test_parse_intervals():
+    assert(serve.parse_intervals(['60', 'ulbs=3600'], ['debs', 'ulbs']) ==
+           {'debs': 60.0, 'ulbs': 3600.0})
+    assert(serve.parse_intervals([], ['debs'], default=5) == {'debs': 5})
+    for specs in (['nope=60'], ['debs=0'], ['debs=x']):
+        with pytest.raises(ValueError):
+            serve.parse_intervals(specs, ['debs'])
+
+
+def test_daemon(stub_endpoint):
+    daemon = serve.Daemon(['debs', 'ulbs'])
+    server = daemon.http_server('127.0.0.1', 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}'
+    try:
+        with urllib.request.urlopen(f'{url}/metrics') as r:
+            assert('detached_ebs_count' not in r.read().decode())
+
+        async def scan():
+            await daemon.scan('debs')
+            await daemon.scan('debs')
+        asyncio.run(scan())
+        with urllib.request.urlopen(f'{url}/metrics') as r:
+            assert(r.headers['Content-Type'].startswith('text/plain'))
+            text = r.read().decode()
+        assert('cloud_keep_detached_ebs_count 2.0' in text)
+        assert('cloud_keep_scan_failures_total{clutter_type="debs"} 0.0'
+               in text)
+        assert('unused_lb_count' not in text)
+        asyncio.run(daemon.scan('ulbs'))
+        with urllib.request.urlopen(f'{url}/metrics') as r:
+            lines = r.read().decode().splitlines()
+        assert('cloud_keep_unused_lb_count 2.0' in lines)
+        # each metric in one block, across the clutter types
+        types = [line.split()[2] for line in lines
+                 if line.startswith('# TYPE ')]
+        assert(len(types) == len(set(types)))
+        assert(len([line for line in lines
+                    if line.startswith('cloud_keep_scan_errors{')]) == 2)
+        # the regions are discovered once across the scans
+        assert(stub_endpoint.count('DescribeRegions') == 1)
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f'{url}/nope')
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,109 @@
+import io
+import json
+import asyncio
+import botocore.exceptions
+import pytest
+import aws_clutter.run as run
+import aws_clutter.shard as shard
+import aws_clutter.accounts as accounts
+import aws_clutter.clutter.debs as debs
+
+
+def untimed(metric_data):
+    # the datums of runs at different times
+    return [{k: v for k, v in d.items() if k != 'Timestamp'}
+            for d in metric_data]
+
+
+def test_split():
+    units = [[None, region, ct] for region in ['a', 'b', 'c']
+             for ct in ['debs', 'snaps']]
+    split_units = shard.split(units, 2)
+    assert(split_units == [units[:2] + units[4:], units[2:4]])
+    # no empty shards
+    assert(len(shard.split(units, 8)) == 3)
+
+
+def test_run_shard(stub_endpoint):
+    result = shard.run_shard([[None, 'us-east-1', 'debs'],
+                              [None, 'us-west-2', 'ulbs']])
+    states = result['cubes']
+    assert(result['errors'] == {'debs': {'': {}}, 'ulbs': {'': {}}})
+    assert(sorted(states) == ['debs', 'ulbs'])
+    # only the regions of the work units
+    assert(sorted(states['debs']['']) == ['us-east-1'])
+    # as sent back by a Lambda shard
+    cube = debs.new_cube().merge(json.loads(json.dumps(states['debs'][''])))
+    assert(cube.totals()[(0, ())] == (1, {'USD': 10.0}))
+
+
+def test_sharded_metric_data(stub_endpoint):
+    clutter_type = run.CLUTTER_TYPES
+    expected = asyncio.run(run.get_metric_data(clutter_type, []))
+    for shards in [1, 3]:
+        metric_data = asyncio.run(run.get_metric_data(clutter_type, [],
+                                                      shards=shards))
+        # the same datums, in the same order, to the last bit
+        assert(untimed(metric_data) == untimed(expected))
+
+
+def test_sharded_accounts(stub_endpoint):
+    arns = accounts.role_arns(['111111111111', '222222222222'])
+    expected = asyncio.run(run.get_metric_data(['debs'], [],
+                                               role_arns=arns, workers=1))
+    metric_data = asyncio.run(run.get_metric_data(['debs'], [],
+                                                  role_arns=arns, shards=3))
+    assert(untimed(metric_data) == untimed(expected))
+    assert(any(dim['Name'] == 'AccountId' for d in metric_data
+               for dim in d['Dimensions']))
+
+
+def test_lambda_executor(stub_endpoint):
+    class FakeLambda:
+        # runs the shard as the Lambda handler does
+        def invoke(self, FunctionName, Payload):
+            event = json.loads(Payload)
+            result = shard.run_shard(event['shard'], event['backend'])
+            return {'Payload': io.BytesIO(json.dumps(result).encode())}
+
+    with shard.LambdaExecutor('awsclutter') as executor:
+        executor.client = FakeLambda()
+        result = executor.submit_shard([[None, 'us-east-1', 'debs']]).result()
+    assert(sorted(result['cubes']['debs']['']) == ['us-east-1'])
+
+
+def test_lambda_executor_throttled(stub_endpoint, monkeypatch):
+    class FakeLambda:
+        def __init__(self, errors):
+            self.errors = errors
+            self.calls = 0
+
+        def invoke(self, FunctionName, Payload):
+            self.calls += 1
+            if self.errors:
+                raise self.errors.pop(0)
+            return {'Payload': io.BytesIO(b'{"cubes": {}, "errors": {}}')}
+
+    monkeypatch.setattr(shard, 'SHARD_BACKOFF', 0.0)
+    throttled = botocore.exceptions.ClientError(
+        {'Error': {'Code': 'TooManyRequestsException'}}, 'Invoke')
+    with shard.LambdaExecutor('awsclutter') as executor:
+        executor.client = FakeLambda([throttled, throttled])
+        assert(executor.invoke([]) == {'cubes': {}, 'errors': {}})
+        assert(executor.client.calls == 3)
+        # a timed out shard may still be running: not invoked again
+        executor.client = FakeLambda([
+            botocore.exceptions.ReadTimeoutError(endpoint_url='lambda')])
+        with pytest.raises(botocore.exceptions.ReadTimeoutError):
+            executor.invoke([])
+        assert(executor.client.calls == 1)
+
+
+def test_work_units(stub_endpoint):
+    arns = accounts.role_arns(['111111111111', '222222222222'])
+    units = shard.work_units(['debs'], arns)
+    # in the order of the accounts
+    assert(units == [[arn, region, 'debs'] for arn in arns
+                     for region in ['us-east-1', 'us-west-2']])
+    assert(shard.work_units(['debs'], regions=['eu-west-1']) ==
+           [[None, 'eu-west-1', 'debs']])
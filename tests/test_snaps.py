@@ -0,0 +1,95 @@
+import asyncio
+import math
+import pytest
+import aws_clutter.run as run
+import aws_clutter.clutter.snaps as snaps
+
+
+@pytest.mark.parametrize("test_data", [
+    {
+        'snap': {'VolumeSize': 100, 'StorageTier': 'standard'},
+        'rzCode': 'us-east-1',
+        'expectedMonthlyCostUnit': 'USD',
+        'expectedMonthlyCost': 5.00
+    },
+    {
+        # the full size is used over the size of the volume when known
+        'snap': {'VolumeSize': 100, 'FullSnapshotSizeInBytes': 20 * 2**30},
+        'rzCode': 'us-east-1',
+        'expectedMonthlyCostUnit': 'USD',
+        'expectedMonthlyCost': 1.00
+    },
+    {
+        'snap': {'VolumeSize': 100, 'StorageTier': 'archive'},
+        'rzCode': 'us-east-1',
+        'expectedMonthlyCostUnit': 'USD',
+        'expectedMonthlyCost': 1.25
+    },
+    {
+        'snap': {'VolumeSize': 100},
+        'rzCode': 'nowhere-1',
+        'expectedMonthlyCostUnit': None,
+        'expectedMonthlyCost': None
+    }
+])
+def test_enrich_snap_info(test_data):
+    snap = test_data['snap']
+    snaps.enrich_snap_info(snap, test_data['rzCode'])
+    assert(snap['RZCode'] == test_data['rzCode'])
+    assert(snap['StorageTier'] in ('standard', 'archive'))
+    assert(snap.get('MonthlyCostUnit') ==
+           test_data['expectedMonthlyCostUnit'])
+    if test_data['expectedMonthlyCost'] is None:
+        # unpriced: counted, but without a cost
+        assert('MonthlyCost' not in snap)
+    else:
+        assert(math.isclose(snap['MonthlyCost'],
+                            test_data['expectedMonthlyCost'], rel_tol=0.001))
+
+
+def test_orphaned():
+    volume_ids = {'vol-1'}
+    image_snapshot_ids = snaps.image_snapshots({'BlockDeviceMappings': [
+        {'DeviceName': '/dev/xvda', 'Ebs': {'SnapshotId': 'snap-2'}},
+        {'DeviceName': '/dev/xvdb', 'VirtualName': 'ephemeral0'}
+    ]})
+    assert(image_snapshot_ids == ['snap-2'])
+    assert(not snaps.orphaned({'SnapshotId': 'snap-1', 'VolumeId': 'vol-1'},
+                              volume_ids, image_snapshot_ids))
+    assert(not snaps.orphaned({'SnapshotId': 'snap-2', 'VolumeId': 'vol-2'},
+                              volume_ids, image_snapshot_ids))
+    assert(snaps.orphaned({'SnapshotId': 'snap-3', 'VolumeId': 'vol-2'},
+                          volume_ids, image_snapshot_ids))
+    # e.g., copied snapshots
+    assert(snaps.orphaned({'SnapshotId': 'snap-4'},
+                          volume_ids, image_snapshot_ids))
+
+
+@pytest.mark.parametrize("backend", ['threads', 'async'])
+def test_scan(backend, stub_endpoint):
+    if backend == 'async':
+        pytest.importorskip('aiobotocore')
+    resources = asyncio.run(run.scan(['snaps'], backend,
+                                     compact_records=True))['snaps']
+    assert(sorted(resources) == ['us-east-1', 'us-west-2'])
+    for region, rs in resources.items():
+        assert([s['SnapshotId'] for s in rs] == ['snap-orphaned'])
+        assert(isinstance(rs[0], snaps.Snapshot))
+        assert(rs[0]['RZCode'] == region)
+        assert(math.isclose(rs[0]['MonthlyCost'], 5.00, rel_tol=0.001))
+    metric_data = snaps.aggregate(resources)
+    assert(metric_data[-2]['MetricName'] == 'OrphanedSnapshotCount')
+    assert(metric_data[-2]['Value'] == 2)
+
+
+def test_report_unpriced(capsys):
+    rs = [snaps.enrich_snap_info({'VolumeSize': 100}, 'nowhere-1')
+          for _ in range(3)]
+    snaps.report_unpriced(rs, 'nowhere-1')
+    # once for the region
+    assert(capsys.readouterr().err.splitlines() == [
+        "[snaps] No snapshot price for nowhere-1 (standard): 3 orphaned "
+        "snapshots counted without a cost"])
+    snaps.report_unpriced([snaps.enrich_snap_info({'VolumeSize': 100},
+                                                  'us-east-1')], 'us-east-1')
+    assert(capsys.readouterr().err == '')
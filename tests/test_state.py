@@ -0,0 +1,156 @@
+import io
+import json
+import boto3
+from botocore.stub import Stubber
+import aws_clutter.state as state
+
+
+def volumes(*ids):
+    return [{'VolumeId': i} for i in ids]
+
+
+def test_incremental_events():
+    store = state.MemoryStore()
+    inc = state.Incremental(store)
+    events = inc.update('debs', {'us-east-1': volumes('vol-1', 'vol-2'),
+                                 'us-west-2': []}, 'VolumeId')
+    assert([(e['Event'], e['ResourceId']) for e in events]
+           == [('Added', 'vol-1'), ('Added', 'vol-2')])
+    inc.save()
+
+    inc = state.Incremental(store)
+    events = inc.update('debs', {'us-east-1': volumes('vol-2', 'vol-3'),
+                                 'us-west-2': []}, 'VolumeId')
+    assert([(e['Event'], e['ResourceId']) for e in events]
+           == [('Added', 'vol-3'), ('Removed', 'vol-1')])
+    assert(inc.added['debs'] == {'vol-3'})
+    assert(inc.run == 2)
+
+
+def test_quiet_regions_skipped():
+    store = state.MemoryStore()
+    scanned = []
+    for run in range(1, 13):
+        inc = state.Incremental(store, quiet_runs=3)
+        skip = inc.regions_to_skip('ulbs')
+        resources = {r: [] for r in ['us-east-1', 'us-west-2']
+                     if r not in skip}
+        if 'us-east-1' in resources:
+            resources['us-east-1'] = [{'LoadBalancerArn': 'arn:lb/1'}]
+        if 'us-west-2' in resources:
+            scanned.append(run)
+        inc.update('ulbs', resources, 'LoadBalancerArn', skip)
+        assert('us-east-1' not in skip)
+        inc.save()
+    # quiet after runs 1-3, then scanned every 3rd run
+    assert(scanned == [1, 2, 3, 6, 9, 12])
+
+
+def test_file_store(tmp_path):
+    store = state.open_store(str(tmp_path / 'state.json'))
+    assert(store.load() is None)
+    store.save({'run': 1, 'types': {}})
+    assert(state.open_store(f"file://{tmp_path}/state.json").load()
+           == {'run': 1, 'types': {}})
+
+
+def test_s3_store(monkeypatch):
+    client = boto3.client('s3', region_name='us-east-1',
+                          aws_access_key_id='testing',
+                          aws_secret_access_key='testing')
+    monkeypatch.setattr(state.clients, 'client', lambda service: client)
+    store = state.open_store('s3://bucket/awsclutter/state.json')
+    body = json.dumps({'run': 3, 'types': {}}).encode()
+    with Stubber(client) as stubber:
+        stubber.add_response('get_object', {'Body': io.BytesIO(body)},
+                             {'Bucket': 'bucket',
+                              'Key': 'awsclutter/state.json'})
+        stubber.add_response('put_object', {},
+                             {'Bucket': 'bucket',
+                              'Key': 'awsclutter/state.json', 'Body': body})
+        assert(store.load() == {'run': 3, 'types': {}})
+        store.save({'run': 3, 'types': {}})
+
+
+def test_dynamodb_store(monkeypatch):
+    client = boto3.client('dynamodb', region_name='us-east-1',
+                          aws_access_key_id='testing',
+                          aws_secret_access_key='testing')
+    monkeypatch.setattr(state.clients, 'client', lambda service: client)
+    store = state.open_store('dynamodb://clutter-state')
+    with Stubber(client) as stubber:
+        stubber.add_response('get_item', {}, {
+            'TableName': 'clutter-state', 'Key': {'id': {'S': 'awsclutter'}},
+            'ConsistentRead': True})
+        assert(store.load() is None)
+
+
+class FakeDynamoDB:
+    def __init__(self):
+        self.items = {}
+
+    def get_item(self, TableName, Key, ConsistentRead):
+        item = self.items.get(Key['id']['S'])
+        return {'Item': item} if item else {}
+
+    def put_item(self, TableName, Item):
+        self.items[Item['id']['S']] = Item
+
+    def delete_item(self, TableName, Key):
+        del self.items[Key['id']['S']]
+
+
+def test_dynamodb_store_chunks(monkeypatch):
+    client = FakeDynamoDB()
+    monkeypatch.setattr(state.clients, 'client', lambda service: client)
+    monkeypatch.setattr(state.DynamoDBStore, 'ITEM_CHARS', 100)
+    store = state.open_store('dynamodb://clutter-state/awsclutter')
+    big = {'run': 1, 'types': {'debs': {'us-east-1': {
+        'ids': [f'vol-{i:017x}' for i in range(20)], 'quiet_runs': 0,
+        'last_scan': 1}}}}
+    store.save(big)
+    assert(len(client.items) == 1 + len(json.dumps(big)) // 100 + 1)
+    assert(all(len(item.get('chunk', {'S': ''})['S']) <= 100
+               for item in client.items.values()))
+    assert(store.load() == big)
+    # the chunks of the previous state are deleted
+    store.save({'run': 2, 'types': {}})
+    assert(len(client.items) == 2)
+    assert(store.load() == {'run': 2, 'types': {}})
+    # a state kept in a single item is still read
+    client.items = {'awsclutter': {'id': {'S': 'awsclutter'},
+                                   'state': {'S': json.dumps(big)}}}
+    assert(store.load() == big)
+
+
+def test_unfinished_regions_carried_over():
+    store = state.MemoryStore()
+    for run in range(2):
+        inc = state.Incremental(store, quiet_runs=2)
+        inc.update('debs', {'us-east-1': volumes('vol-1'), 'us-west-2': [],
+                            'eu-west-1': volumes('vol-2', 'vol-3')},
+                   'VolumeId', seconds={'us-east-1': 2.0, 'us-west-2': 1.0,
+                                        'eu-west-1': 2.0})
+        inc.save()
+    # the slowest first, then the most cluttered
+    assert(inc.region_order('debs') == ['eu-west-1', 'us-east-1',
+                                        'us-west-2'])
+
+    inc = state.Incremental(store, quiet_runs=2)
+    skip = inc.regions_to_skip('debs')
+    assert(skip == {'us-west-2'})
+    events = inc.update('debs', {'us-east-1': [], 'us-west-2': []},
+                        'VolumeId', skip, unfinished=['eu-west-1'],
+                        seconds={'us-east-1': 1.0, 'eu-west-1': 1.0})
+    # the regions left unfinished keep their resources
+    assert([(e['Event'], e['ResourceId']) for e in events] ==
+           [('Removed', 'vol-1')])
+    inc.save()
+
+    # carried over to the next run, first
+    inc = state.Incremental(store, quiet_runs=2)
+    assert(inc.region_order('debs') == ['eu-west-1', 'us-east-1',
+                                        'us-west-2'])
+    assert('eu-west-1' not in inc.regions_to_skip('debs'))
+    assert(store.state['types']['debs']['eu-west-1']['ids'] ==
+           ['vol-2', 'vol-3'])
@@ -0,0 +1,99 @@
+import json
+import datetime
+import pytest
+import aws_clutter.tools as tools
+
+
+@pytest.mark.parametrize("dt,expected", [
+    (datetime.datetime(2021, 11, 1, 12, 0, 0), '2021-11-01T12:00:00Z'),
+    (datetime.datetime(2021, 11, 1, 12, 0, 0, 123456),
+     '2021-11-01T12:00:00.123456Z'),
+    (datetime.datetime(2021, 11, 1, 12, 0, 0, 500,
+                       tzinfo=datetime.timezone(datetime.timedelta(hours=-7))),
+     '2021-11-01T19:00:00.000500Z'),
+    (datetime.datetime(2021, 11, 1, 12, 0, 0, tzinfo=datetime.timezone.utc),
+     '2021-11-01T12:00:00Z'),
+])
+def test_datetime_json_encoder(dt, expected):
+    assert(json.dumps({'t': dt}, cls=tools.DateTimeJSONEncoder)
+           == f'{{"t": "{expected}"}}')
+
+
+DOCUMENT = {
+    'debs': {
+        'description': 'Detached EBS Volumes',
+        'resources': {
+            'us-east-1': [{
+                'VolumeId': 'vol-1',
+                'Size': 100,
+                'MonthlyCost': 8.000000000000002,
+                'Encrypted': False,
+                'CreateTime': datetime.datetime(
+                    2021, 11, 1, 12, 0, 0, 5,
+                    tzinfo=datetime.timezone(datetime.timedelta(hours=2))),
+                'Tags': [{'Key': 'Name', 'Value': 'café'}],
+                'Attachments': [],
+                'KmsKeyId': None
+            }],
+            'us-west-2': []
+        }
+    },
+    'Timestamp': datetime.datetime(2022, 1, 2, 3, 4, 5)
+}
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+@pytest.mark.parametrize("indent", [None, 1, 2, 3, 4])
+def test_dumps(use_orjson, indent, monkeypatch):
+    if use_orjson:
+        pytest.importorskip('orjson')
+    else:
+        monkeypatch.setattr(tools, 'orjson', None)
+    data = tools.dumps(DOCUMENT, indent=indent)
+    if indent is None:
+        assert(data == json.dumps(DOCUMENT, sort_keys=True,
+                                  separators=(',', ':'), ensure_ascii=False,
+                                  cls=tools.DateTimeJSONEncoder))
+    else:
+        # as ever, non-ASCII characters escaped
+        assert(data == json.dumps(DOCUMENT, sort_keys=True, indent=indent,
+                                  cls=tools.DateTimeJSONEncoder))
+        assert('caf\\u00e9' in data)
+    assert('"2021-11-01T10:00:00.000005Z"' in data)
+
+
+def test_dumps_unserializable(monkeypatch):
+    monkeypatch.setattr(tools, 'orjson', None)
+    with pytest.raises(TypeError):
+        tools.dumps({'a': object()})
+
+
+def test_token_bucket():
+    bucket = tools.TokenBucket(10, capacity=2)
+    assert(bucket.take() == 0 and bucket.take() == 0)
+    assert(0 < bucket.take() <= 0.1)
+    bucket.throttled()
+    # the calls in flight throttled together
+    bucket.throttled()
+    assert(bucket.rate == 5)
+    # doubling back every cooldown
+    bucket.last_throttled -= 0.5
+    bucket.take()
+    assert(7 < bucket.rate < 7.1)
+    bucket.last_throttled -= 0.5
+    bucket.take()
+    assert(bucket.rate == 10)
+    # unlimited
+    assert(all(tools.TokenBucket(0).take() == 0 for _ in range(100)))
+
+
+def test_token_bucket_adaptive():
+    bucket = tools.TokenBucket(0, adaptive=True)
+    assert(all(bucket.take() == 0 for _ in range(50)))
+    # limited once throttled, from the rate of the last second
+    bucket.throttled()
+    assert(bucket.rate == 25)
+    assert(bucket.take() > 0)
+    # and unlimited again once past twice that
+    bucket.last_throttled -= 2
+    assert(bucket.take() == 0 and bucket.rate == 0)
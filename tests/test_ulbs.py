@@ -0,0 +1,122 @@
+import time
+import pytest
+import aws_clutter.tools as tools
+import aws_clutter.clutter.ulbs as ulbs
+
+
+class FakeELBv2Client:
+    def __init__(self, targets):
+        self.targets = targets
+        self.calls = []
+
+    def describe_target_health(self, TargetGroupArn):
+        self.calls.append(TargetGroupArn)
+        return {'TargetHealthDescriptions': self.targets.get(TargetGroupArn,
+                                                             [])}
+
+
+TGS = [
+    {'TargetGroupArn': 'tg-1', 'LoadBalancerArns': ['lb-1']},
+    {'TargetGroupArn': 'tg-2', 'LoadBalancerArns': ['lb-1', 'lb-2']},
+    {'TargetGroupArn': 'tg-3', 'LoadBalancerArns': ['lb-2']},
+    {'TargetGroupArn': 'tg-4', 'LoadBalancerArns': []},
+]
+
+
+def test_index_lb_tgs():
+    lb_tgs = ulbs.index_lb_tgs(TGS)
+    assert(lb_tgs == {'lb-1': ['tg-1', 'tg-2'], 'lb-2': ['tg-2', 'tg-3']})
+
+
+def test_lb_unused():
+    client = FakeELBv2Client({'tg-1': [{'Target': {'Id': 'i-1'}}]})
+    lb_tgs = ulbs.index_lb_tgs(TGS)
+    tg_healths = ulbs.fetch_tg_healths(TGS, client, concurrency=1)
+    assert(not ulbs.lb_unused({'LoadBalancerArn': 'lb-1'}, lb_tgs,
+                              tg_healths))
+    assert(ulbs.lb_unused({'LoadBalancerArn': 'lb-2'}, lb_tgs, tg_healths))
+    assert(ulbs.lb_unused({'LoadBalancerArn': 'lb-3'}, lb_tgs, tg_healths))
+
+
+def test_fetch_tg_healths_probes_attached_only():
+    client = FakeELBv2Client({'tg-1': [{'Target': {'Id': 'i-1'}}]})
+    ulbs.fetch_tg_healths(TGS, client, concurrency=4)
+    assert(sorted(client.calls) == ['tg-1', 'tg-2', 'tg-3'])
+
+
+def test_fetch_tg_healths_skips_used_lbs():
+    tgs = [
+        {'TargetGroupArn': 'tg-1', 'LoadBalancerArns': ['lb-1']},
+        {'TargetGroupArn': 'tg-2', 'LoadBalancerArns': ['lb-1']},
+    ]
+    client = FakeELBv2Client({'tg-1': [{'Target': {'Id': 'i-1'}}]})
+    ulbs.fetch_tg_healths(tgs, client, concurrency=1)
+    assert(client.calls == ['tg-1'])
+
+
+def test_fetch_tg_healths_deadline():
+    client = FakeELBv2Client({})
+    # one pool for all the regions
+    assert(ulbs.tg_executor() is ulbs.tg_executor())
+    token = tools.DEADLINE.set(time.monotonic() - 1)
+    try:
+        with pytest.raises(tools.DeadlineExceeded):
+            ulbs.fetch_tg_healths(TGS, client, concurrency=2)
+    finally:
+        tools.DEADLINE.reset(token)
+    assert(client.calls == [])
+
+
+class FakeCloudWatchClient:
+    def __init__(self, values):
+        self.values = values
+        self.calls = []
+
+    def get_metric_data(self, MetricDataQueries, StartTime, EndTime):
+        self.calls.append(len(MetricDataQueries))
+        return {'MetricDataResults': [
+            {'Id': q['Id'], 'Values': self.values.get(
+                (q['MetricStat']['Metric']['Dimensions'][0]['Value'],
+                 q['MetricStat']['Metric']['MetricName']), [])}
+            for q in MetricDataQueries]}
+
+
+def test_idle_lbs():
+    lbs = [{'LoadBalancerArn': f'arn:aws:elasticloadbalancing:us-east-1:1:'
+                               f'loadbalancer/app/lb-{i}/{i}',
+            'Type': 'application'} for i in range(300)]
+    lbs.append({'LoadBalancerArn': 'arn:aws:elasticloadbalancing:us-east-1:1:'
+                                   'loadbalancer/net/nlb/1',
+                'Type': 'network'})
+    client = FakeCloudWatchClient({
+        ('app/lb-1/1', 'RequestCount'): [10.0, 5.0],
+        ('app/lb-2/2', 'ProcessedBytes'): [100.0],
+        ('net/nlb/1', 'ActiveFlowCount'): [0.0],
+    })
+    traffic = ulbs.fetch_traffic(lbs, client, days=7)
+    # 2 metrics per LB, packed 500 queries per call
+    assert(client.calls == [500, 102])
+    assert(traffic[lbs[1]['LoadBalancerArn']]['RequestCount'] == 15.0)
+    reasons = ulbs.idle_reasons(traffic)
+    assert(len(reasons) == 299)
+    assert(lbs[1]['LoadBalancerArn'] not in reasons)
+    assert(lbs[2]['LoadBalancerArn'] not in reasons)
+    assert(reasons[lbs[-1]['LoadBalancerArn']] == ulbs.REASON_IDLE)
+    reasons = ulbs.idle_reasons(traffic, {'RequestCount': 20,
+                                          'ProcessedBytes': 100})
+    assert(len(reasons) == 301)
+
+
+def test_aggregate_per_lb(monkeypatch):
+    monkeypatch.setattr(ulbs, 'ULBS_DIMS_DEFAULT', 'RZCode,LoadBalancerArn')
+    monkeypatch.setattr(ulbs.cube, 'TOP_RESOURCES', 1)
+    lbs = {'us-east-1': [
+        {'LoadBalancerArn': f'lb-{i}', 'Type': 'application',
+         'Reason': 'NoTargets', 'MonthlyCost': 16.0 + i,
+         'MonthlyCostUnit': 'USD'} for i in range(3)
+    ]}
+    per_lb = [(d['Dimensions'][-1]['Value'], d['Value'])
+              for d in ulbs.aggregate(lbs)
+              if d['Dimensions'][-1:] and
+              d['Dimensions'][-1]['Name'] == 'LoadBalancerArn']
+    assert(per_lb == [('lb-2', 18.0), ('Other', 33.0)])